@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Latency of the path queries of etl/graph.py: the time it takes to build
+# the graph, then the median and 99th percentile of --queries random
+# queries of every kind (airports picked with a fixed seed). With --sql the
+# fewest stops queries are also run as the recursive SQL they replace, on
+# the loaded DB (fewer of them, they're slow).
+#
+# python3 benchmarks/graph.py --data-dir ./data/ --queries 1000 --sql
+
+import argparse
+import random
+import sys
+from os.path import dirname, join
+from statistics import median
+from time import perf_counter
+
+sys.path.insert(0, join(dirname(__file__), '..', 'etl'))
+
+from graph import RouteGraph  # noqa: E402
+
+# fewest stops from %(src)s to %(dest)s with at most %(max_stops)s stops
+_sql = '''
+WITH RECURSIVE paths (airport_id, path) AS (
+    SELECT %(src)s, ARRAY[%(src)s]
+    UNION ALL
+    SELECT r.dest_airport_id, p.path || r.dest_airport_id
+    FROM paths p JOIN routes r ON r.src_airport_id = p.airport_id
+    WHERE cardinality(p.path) <= %(max_stops)s + 1
+        AND NOT r.dest_airport_id = ANY(p.path)
+        AND NOT %(dest)s = ANY(p.path)
+)
+SELECT path FROM paths WHERE airport_id = %(dest)s ORDER BY cardinality(path) LIMIT 1;
+'''
+
+
+def timed(queries, run):
+    ms = []
+    for q in queries:
+        t = perf_counter()
+        run(*q)
+        ms.append((perf_counter() - t) * 1000)
+    ms.sort()
+    return median(ms), ms[min(len(ms) - 1, int(len(ms) * 0.99))]
+
+
+def main(args):
+    t = perf_counter()
+    graph = RouteGraph.from_files(args.data_dir)
+    print(f'build: {perf_counter() - t:.2f}s, {len(graph)} airports, {len(graph.targets)} routes')
+
+    rnd = random.Random(args.seed)
+    # airports with routes, others are trivially unreachable
+    ids = [graph.ids[i] for i in range(len(graph)) if graph.offsets[i + 1] > graph.offsets[i]]
+    pairs = [tuple(rnd.sample(ids, 2)) for _ in range(args.queries)]
+
+    print(f'{"query":<24} {"p50 ms":>8} {"p99 ms":>8}')
+    results = [
+        ('fewest stops', timed(pairs, graph.fewest_stops)),
+        (f'fewest stops <= {args.max_stops}', timed(pairs, lambda s, d: graph.fewest_stops(s, d, args.max_stops))),
+        ('shortest distance', timed(pairs, graph.shortest)),
+        (f'reachable in {args.hops} hops', timed([(s,) for s, _ in pairs], lambda s: graph.reachable(s, args.hops))),
+    ]
+
+    if args.sql:
+        import psycopg2
+        conn = psycopg2.connect(
+            database=args.db_name,
+            host=args.db_host,
+            port=args.db_port,
+            user=args.db_user,
+            password=args.db_password
+        )
+        try:
+            with conn.cursor() as cur:
+                def _run(s, d):
+                    cur.execute(_sql, {'src': s, 'dest': d, 'max_stops': args.max_stops})
+                    cur.fetchall()
+                results.append((f'SQL fewest stops <= {args.max_stops}', timed(pairs[:args.sql_queries], _run)))
+        finally:
+            conn.close()
+
+    for name, (p50, p99) in results:
+        print(f'{name:<24} {p50:>8.2f} {p99:>8.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default='./data/')
+    parser.add_argument('--queries', default=1000, type=int)
+    parser.add_argument('--seed', default=1, type=int)
+    parser.add_argument('--max-stops', default=1, type=int)
+    parser.add_argument('--hops', default=2, type=int)
+    parser.add_argument('--sql', action='store_true',
+        help='also run the fewest stops queries as recursive SQL on the DB')
+    parser.add_argument('--sql-queries', default=20, type=int)
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-port', default='5432')
+    parser.add_argument('--db-name', default='openflights')
+    parser.add_argument('--db-user', default='postgres')
+    parser.add_argument('--db-password', default='1234')
+    main(parser.parse_args())
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# Load benchmark: loads the bundled data (optionally scaled up) into a fresh
+# DB, once per scale, and records how long each phase of main() took, rows
+# per second per table and the peak RSS of the load. The results go to a
+# JSON file, named after the commit, so runs of different commits can be
+# compared (--compare).
+#
+# By default a throwaway Postgres cluster is started from the binaries in
+# --pg-bin (or on the PATH) and removed afterwards. With --db-host an
+# existing server is used instead, with a throwaway DB that is dropped
+# afterwards. Either way the DB is created from schema/create.sql.
+#
+# Everything after -- is passed on to etl/main.py, e.g.
+#
+#   python3 benchmarks/load.py --scale 1 10 -- --engine copy
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from datetime import datetime, timezone
+from os.path import abspath, dirname, join
+
+import psycopg2
+
+ROOT = abspath(join(dirname(__file__), '..'))
+
+
+def unpack_data(dest):
+    with tarfile.open(join(ROOT, 'data', 'data.tar.gz')) as tar:
+        tar.extractall(dest)
+    # not part of the archive
+    shutil.copy(join(ROOT, 'data', 'planes.csv'), dest)
+
+
+def scale_data(src, dest, factor):
+    # Writes factor copies of the airports and routes in src to dest. Every
+    # copy gets its own airport IDs, routes of a copy only reference the
+    # airports of that copy, so FKs stay consistent (and routes unique).
+    # The other files are copied as they are.
+    os.makedirs(dest, exist_ok=True)
+    for f in os.listdir(src):
+        if f not in ('airports.dat', 'routes.dat'):
+            shutil.copy(join(src, f), dest)
+
+    with open(join(src, 'airports.dat')) as f:
+        airports = f.readlines()
+    max_id = max(int(l.split(',', 1)[0]) for l in airports)
+    offset = 10 ** len(str(max_id))
+
+    with open(join(dest, 'airports.dat'), 'w') as out:
+        for k in range(factor):
+            for l in airports:
+                ap_id, rest = l.split(',', 1)
+                out.write(f'{int(ap_id) + k * offset},{rest}')
+
+    def _id(s, k):
+        return s if s == r'\N' else str(int(s) + k * offset)
+
+    with open(join(src, 'routes.dat')) as f, open(join(dest, 'routes.dat'), 'w') as out:
+        routes = [l.split(',') for l in f]
+        for k in range(factor):
+            for r in routes:
+                r = list(r)
+                r[3] = _id(r[3], k)
+                r[5] = _id(r[5], k)
+                out.write(','.join(r))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class LocalPostgres:
+    # A throwaway Postgres cluster in a temporary directory, listening on a
+    # free port on localhost. Needs initdb and pg_ctl, which refuse to run
+    # as root.
+    def __init__(self, bin_dir=None):
+        self._bin_dir = bin_dir or dirname(shutil.which('initdb') or '')
+        if not self._bin_dir or not os.path.exists(join(self._bin_dir, 'initdb')):
+            raise RuntimeError('initdb not found, use --pg-bin or --db-host')
+
+        self.host = 'localhost'
+        self.port = str(_free_port())
+        self.user = 'postgres'
+        self.password = ''
+        self._dir = None
+
+
+    def _run(self, cmd, *args):
+        subprocess.run([join(self._bin_dir, cmd), *args], check=True, stdout=subprocess.DEVNULL)
+
+
+    def start(self):
+        self._dir = tempfile.mkdtemp(prefix='openflights-pg-')
+        data = join(self._dir, 'data')
+        self._run('initdb', '-D', data, '-U', self.user, '-A', 'trust', '-E', 'UTF8')
+        self._run(
+            'pg_ctl', '-D', data, '-l', join(self._dir, 'log'), '-w', 'start',
+            '-o', f'-p {self.port} -k {self._dir} -c listen_addresses=localhost'
+        )
+
+
+    def stop(self):
+        if self._dir:
+            self._run('pg_ctl', '-D', join(self._dir, 'data'), '-m', 'fast', '-w', 'stop')
+            shutil.rmtree(self._dir)
+            self._dir = None
+
+
+class ExistingPostgres:
+    def __init__(self, host, port, user, password):
+        self.host, self.port, self.user, self.password = host, port, user, password
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def _connect(server, db):
+    conn = psycopg2.connect(
+        database=db, host=server.host, port=server.port, user=server.user, password=server.password
+    )
+    conn.autocommit = True
+    return conn
+
+
+def create_db(server, name):
+    conn = _connect(server, 'postgres')
+    with conn.cursor() as cur:
+        cur.execute(f'DROP DATABASE IF EXISTS {name};')
+        cur.execute(f"CREATE DATABASE {name} ENCODING 'UTF8' TEMPLATE template0;")
+        version = conn.server_version
+    conn.close()
+
+    conn = _connect(server, name)
+    with conn.cursor() as cur, open(join(ROOT, 'schema', 'create.sql')) as f:
+        cur.execute(f.read())
+    conn.close()
+    return version
+
+
+def drop_db(server, name):
+    conn = _connect(server, 'postgres')
+    with conn.cursor() as cur:
+        cur.execute(f'DROP DATABASE IF EXISTS {name};')
+    conn.close()
+
+
+def run_load(main_args, out):
+    # Runs in its own process (see --child), so that the peak RSS is the
+    # one of the load only
+    sys.path.insert(0, join(ROOT, 'etl'))
+    import main as etl
+
+    logging.disable(logging.INFO)
+    args = etl.parse_args(main_args)
+    database = etl.open_database(args)
+    try:
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            phases = etl.main(args, database)
+        seconds = time.perf_counter() - t0
+    finally:
+        database.close()
+
+    tables = {}
+    for p in phases:
+        for t in p.tables:
+            s = database.table_stats[t]
+            tables[t] = {
+                'rows': s.insert_ok,
+                'errors': dict(s.insert_errors),
+                'rows_per_sec': s.insert_ok / p.duration if p.duration else None,
+            }
+
+    result = {
+        'seconds': seconds,
+        # kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'phases': {p.name: {'start': p.start, 'end': p.end, 'seconds': p.duration} for p in phases},
+        'critical_path': [p.name for p in etl.critical_path(phases)],
+        'tables': tables,
+        'metrics': database.metrics.to_dict(phases),
+    }
+    with open(out, 'w') as f:
+        json.dump(result, f)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old, new):
+    # phase timings of the runs both results have, by scale
+    old_runs = {r['scale']: r for r in old['runs']}
+    print(f'# {old["commit"]} -> {new["commit"]}')
+    for r in new['runs']:
+        o = old_runs.get(r['scale'])
+        if not o:
+            continue
+        print(f'scale {r["scale"]}: {o["seconds"]:.2f}s -> {r["seconds"]:.2f}s, '
+              f'peak RSS {o["peak_rss_kb"]} -> {r["peak_rss_kb"]} kB')
+        for name, p in r['phases'].items():
+            if name in o['phases']:
+                before = o['phases'][name]['seconds']
+                change = (p['seconds'] - before) / before * 100 if before else 0
+                print(f'  {name}: {before:.2f}s -> {p["seconds"]:.2f}s ({change:+.0f}%)')
+
+
+def main(args, main_args):
+    if args.db_host:
+        server = ExistingPostgres(args.db_host, args.db_port, args.db_user, args.db_password)
+    else:
+        server = LocalPostgres(args.pg_bin)
+
+    commit = _git_commit()
+    results = {
+        'commit': commit,
+        'started': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'main_args': main_args,
+        'runs': [],
+    }
+
+    tmp = tempfile.mkdtemp(prefix='openflights-bench-')
+    db_name = f'openflights_bench_{os.getpid()}'
+    server.start()
+    try:
+        base = join(tmp, 'x1')
+        unpack_data(base)
+
+        for factor in args.scale:
+            data_dir = base
+            if factor > 1:
+                data_dir = join(tmp, f'x{factor}')
+                scale_data(base, data_dir, factor)
+
+            results['postgres'] = create_db(server, db_name)
+            out = join(tmp, f'result-{factor}.json')
+            subprocess.run([
+                sys.executable, __file__, '--child', out, '--',
+                '--db-host', server.host,
+                '--db-port', str(server.port),
+                '--db-name', db_name,
+                '--db-user', server.user,
+                '--db-password', server.password,
+                '--data-dir', data_dir,
+                *main_args
+            ], check=True)
+            drop_db(server, db_name)
+
+            with open(out) as f:
+                run = json.load(f)
+            run['scale'] = factor
+            results['runs'].append(run)
+
+            print(f'scale {factor}: {run["seconds"]:.2f}s, peak RSS {run["peak_rss_kb"]} kB')
+            for t, s in run['tables'].items():
+                print(f'  {t}: {s["rows"]} rows, {s["rows_per_sec"] or 0:.0f} rows/s')
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+    output = args.output or join(
+        ROOT, 'benchmarks', 'results', f'{datetime.now():%Y%m%d-%H%M%S}-{commit}.json'
+    )
+    os.makedirs(dirname(abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results written to {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    main_args = []
+    if '--' in argv:
+        i = argv.index('--')
+        argv, main_args = argv[:i], argv[i + 1:]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, nargs='+', default=[1],
+        help='load the data this many times over (airports and routes), e.g. 1 10 100')
+    parser.add_argument('--pg-bin', help='directory with initdb and pg_ctl')
+    parser.add_argument('--db-host', help='use this server instead of a throwaway cluster')
+    parser.add_argument('--db-port', default='5432')
+    parser.add_argument('--db-user', default='postgres')
+    parser.add_argument('--db-password', default='1234')
+    parser.add_argument('--output', help='JSON file to write, default benchmarks/results/<time>-<commit>.json')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_load(main_args, args.child)
+    else:
+        main(args, main_args)
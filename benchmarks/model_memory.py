@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Memory taken by the row models, in bytes per row, when a whole file is
+# held in memory as a list of them. Measured with tracemalloc, so it
+# includes the strings and lists referenced by the rows.
+#
+# python3 benchmarks/model_memory.py --data-dir ./data/
+
+import argparse
+import gc
+import sys
+import tracemalloc
+from os.path import dirname, join
+
+sys.path.insert(0, join(dirname(__file__), '..', 'etl'))
+
+from extract import (read_airlines, read_airports, read_countries,  # noqa: E402
+                     read_planes, read_routes)
+from model import CityDat  # noqa: E402
+
+
+def read_cities(fname):
+    # the CityDat rows load_cities builds, one per airport
+    for ap in read_airports(fname):
+        yield CityDat(None, None, ap.country, ap.city, ap.timezone_offset, ap.daylight_saving, ap.timezone)
+
+
+def measure(read):
+    gc.collect()
+    tracemalloc.start()
+    rows = list(read())
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(rows), size
+
+
+def main(args):
+    models = [
+        ('CountryDat', read_countries, 'countries.dat'),
+        ('CityDat', read_cities, 'airports.dat'),
+        ('AirportDat', read_airports, 'airports.dat'),
+        ('AirlineDat', read_airlines, 'airlines.dat'),
+        ('PlaneDat', read_planes, 'planes.dat'),
+        ('RouteDat', read_routes, 'routes.dat'),
+    ]
+
+    print(f'{"model":<12} {"rows":>8} {"bytes":>10} {"bytes/row":>10}')
+    for name, read, fname in models:
+        n, size = measure(lambda: read(join(args.data_dir, fname)))
+        print(f'{name:<12} {n:>8} {size:>10} {size / n:>10.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default='./data/')
+    main(parser.parse_args())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# Parse throughput of airports.dat and routes.dat, scaled up like
+# benchmarks/load.py does: rows/s of read_airports and read_routes in the
+# loading process and with --workers processes (read_parallel), ordered and
+# unordered. Nothing is loaded into a DB.
+#
+# python3 benchmarks/parse.py --scale 1 100 --workers 1 2 4 8
+
+import argparse
+import os
+import sys
+import tempfile
+from os.path import dirname, join
+from time import perf_counter
+
+# benchmarks/load.py, before etl/load.py can shadow it
+from load import scale_data, unpack_data
+
+sys.path.insert(0, join(dirname(__file__), '..', 'etl'))
+
+from extract import read_airports, read_routes  # noqa: E402
+from lineparser import CsvLineParser, LineParser  # noqa: E402
+
+
+def timed(read):
+    t = perf_counter()
+    n = sum(1 for _ in read())
+    return n, perf_counter() - t
+
+
+def main(args):
+    lp = CsvLineParser if args.parser == 'csv' else LineParser
+    print(f'{os.cpu_count()} CPU(s), {args.parser} parser')
+    with tempfile.TemporaryDirectory(prefix='openflights-parse-') as tmp:
+        base = join(tmp, 'base')
+        unpack_data(base)
+        for factor in args.scale:
+            data_dir = join(tmp, f'x{factor}')
+            scale_data(base, data_dir, factor)
+            print(f'\nscale {factor}')
+            print(f'{"file":<14} {"workers":>8} {"order":>10} {"rows":>10} {"s":>8} {"rows/s":>10}')
+            for name, read in (('airports.dat', read_airports), ('routes.dat', read_routes)):
+                fname = join(data_dir, name)
+                runs = [(0, True)] + [(w, o) for w in args.workers for o in (True, False)]
+                for workers, ordered in runs:
+                    n, s = timed(lambda: read(fname, lp, workers, ordered))
+                    order = 'ordered' if ordered else 'unordered'
+                    print(f'{name:<14} {workers or "-":>8} {order:>10} {n:>10} {s:>8.2f} {n / s:>10.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 100])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--parser', choices=('regex', 'csv'), default='regex')
+    main(parser.parse_args())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Latency of the nearest airport and radius queries of etl/spatial.py
+# compared to a scan computing the distance to every airport: the median
+# and 99th percentile of --queries random locations (fixed seed), and
+# whether the index found the same airports as the scan. With --sql the
+# SQL functions of schema/spatial.sql (GiST index, run etl/main.py
+# --spatial-index first) are compared to a scan in SQL the same way.
+#
+# python3 benchmarks/spatial.py --data-dir ./data/ --queries 1000 --sql
+
+import argparse
+import random
+import sys
+from os.path import dirname, join
+from statistics import median
+from time import perf_counter
+
+sys.path.insert(0, join(dirname(__file__), '..', 'etl'))
+
+from extract import read_airports  # noqa: E402
+from spatial import AirportIndex  # noqa: E402
+
+# haversine in SQL, over every airport
+_distance_sql = '''
+    2 * 6371.0088 * asin(sqrt(
+        sin(radians(airport_geo_location[0] - %(lat)s) / 2) ^ 2 +
+        cos(radians(%(lat)s)) * cos(radians(airport_geo_location[0])) *
+        sin(radians(airport_geo_location[1] - %(lon)s) / 2) ^ 2
+    ))
+'''
+
+_queries_sql = {
+    'nearest': (
+        'SELECT airport_id, distance_km FROM airports_nearest(%(lat)s, %(lon)s, %(k)s);',
+        f'SELECT airport_id, {_distance_sql} d FROM airports WHERE airport_geo_location IS NOT NULL '
+        'ORDER BY d LIMIT %(k)s;',
+    ),
+    'within': (
+        'SELECT airport_id, distance_km FROM airports_within(%(lat)s, %(lon)s, %(km)s);',
+        f'SELECT airport_id, d FROM (SELECT airport_id, {_distance_sql} d FROM airports) a '
+        'WHERE d <= %(km)s ORDER BY d;',
+    ),
+}
+
+
+def timed(queries, run):
+    ms = []
+    results = []
+    for q in queries:
+        t = perf_counter()
+        results.append(run(*q))
+        ms.append((perf_counter() - t) * 1000)
+    ms.sort()
+    return median(ms), ms[min(len(ms) - 1, int(len(ms) * 0.99))], results
+
+
+def _ids(results):
+    return [sorted(r[0] for r in rs) for rs in results]
+
+
+def main(args):
+    t = perf_counter()
+    index = AirportIndex.from_airports(read_airports(join(args.data_dir, 'airports.dat')))
+    print(f'build: {perf_counter() - t:.2f}s, {len(index)} airports')
+
+    rnd = random.Random(args.seed)
+    # locations near airports, most queries are made from where people are
+    locations = []
+    for _ in range(args.queries):
+        i = rnd.randrange(len(index))
+        locations.append((index.lat[i] + rnd.uniform(-1, 1), index.lon[i] + rnd.uniform(-1, 1)))
+
+    k, km = args.k, args.km
+    print(f'{"query":<28} {"p50 ms":>8} {"p99 ms":>8}')
+    for name, indexed, scan in (
+        (f'{k} nearest', lambda lat, lon: index.nearest(lat, lon, k), lambda lat, lon: index.nearest_scan(lat, lon, k)),
+        (f'within {km:g} km', lambda lat, lon: index.within(lat, lon, km), lambda lat, lon: index.within_scan(lat, lon, km)),
+    ):
+        p50, p99, found = timed(locations, indexed)
+        scan_p50, scan_p99, expected = timed(locations, scan)
+        same = 'same' if _ids(found) == _ids(expected) else 'DIFFERENT'
+        print(f'{name:<28} {p50:>8.3f} {p99:>8.3f}')
+        print(f'{name + " (scan)":<28} {scan_p50:>8.3f} {scan_p99:>8.3f} {same} airports')
+
+    if args.sql:
+        import psycopg2
+        conn = psycopg2.connect(
+            database=args.db_name,
+            host=args.db_host,
+            port=args.db_port,
+            user=args.db_user,
+            password=args.db_password
+        )
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                def _run(q):
+                    def _query(lat, lon):
+                        cur.execute(q, {'lat': lat, 'lon': lon, 'k': k, 'km': km})
+                        return cur.fetchall()
+                    return _query
+
+                for name, (helper, scan) in _queries_sql.items():
+                    label = f'SQL {k} nearest' if name == 'nearest' else f'SQL within {km:g} km'
+                    p50, p99, _ = timed(locations[:args.sql_queries], _run(scan))
+                    try:
+                        helper_p50, helper_p99, _ = timed(locations[:args.sql_queries], _run(helper))
+                    except psycopg2.Error as ex:
+                        print(f'{label:<28} {"-":>8} {"-":>8} {type(ex).__name__}, see schema/spatial.sql')
+                    else:
+                        print(f'{label:<28} {helper_p50:>8.3f} {helper_p99:>8.3f}')
+                    print(f'{label + " (scan)":<28} {p50:>8.3f} {p99:>8.3f}')
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default='./data/')
+    parser.add_argument('--queries', default=1000, type=int)
+    parser.add_argument('--seed', default=1, type=int)
+    parser.add_argument('--k', default=10, type=int, help='number of airports of the nearest queries')
+    parser.add_argument('--km', default=100, type=float, help='radius of the within queries')
+    parser.add_argument('--sql', action='store_true',
+        help='also compare the SQL functions of schema/spatial.sql to a scan in SQL')
+    parser.add_argument('--sql-queries', default=100, type=int)
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-port', default='5432')
+    parser.add_argument('--db-name', default='openflights')
+    parser.add_argument('--db-user', default='postgres')
+    parser.add_argument('--db-password', default='1234')
+    main(parser.parse_args())
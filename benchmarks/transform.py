@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Transform of routes.dat, scaled up like benchmarks/load.py does: the
+# generator of read_routes (+ translate_plane per equipment code, like
+# translate_equipment) vs RouteBatch. 'transform' times the transform of fields
+# that are already parsed, 'parse+transform' the whole way from the file.
+#
+# python3 benchmarks/transform.py --scale 1 50
+
+import argparse
+import sys
+import tempfile
+from os.path import dirname, join
+from time import perf_counter
+
+# benchmarks/load.py, before etl/load.py can shadow it
+from load import scale_data, unpack_data
+
+sys.path.insert(0, join(dirname(__file__), '..', 'etl'))
+
+from batch import RouteBatch, _route_fields  # noqa: E402
+from extract import _parse_routes, read_routes  # noqa: E402
+from lineparser import LineParser  # noqa: E402
+from transform import translate_plane  # noqa: E402
+
+
+class _Parsed:
+    # parser of lines that are parsed already
+    def __init__(self, fields):
+        pass
+
+
+    def parse_lines(self, lines):
+        return lines
+
+
+def generator(routes):
+    n = 0
+    for r in routes:
+        for p in r.route_equipment_iata:
+            translate_plane(p)
+        n += 1
+    return n
+
+
+def timed(f):
+    t = perf_counter()
+    n = f()
+    return n, perf_counter() - t
+
+
+def main(args):
+    with tempfile.TemporaryDirectory(prefix='openflights-transform-') as tmp:
+        base = join(tmp, 'base')
+        unpack_data(base)
+        for factor in args.scale:
+            data_dir = join(tmp, f'x{factor}')
+            scale_data(base, data_dir, factor)
+            fname = join(data_dir, 'routes.dat')
+            with open(fname) as f:
+                rows = list(LineParser(_route_fields).parse_lines(f))
+            columns = list(zip(*rows))
+
+            print(f'\nscale {factor}')
+            print(f'{"":<16} {"":<10} {"routes":>10} {"s":>8} {"routes/s":>10}')
+            runs = (('transform', 'generator', lambda: generator(_parse_routes(rows, _Parsed))),
+                    ('transform', 'batch', lambda: len(RouteBatch(columns))),
+                    ('parse+transform', 'generator', lambda: generator(read_routes(fname))),
+                    ('parse+transform', 'batch', lambda: len(RouteBatch.from_file(fname))))
+            for what, how, f in runs:
+                n, s = min((timed(f) for _ in range(args.repeat)), key=lambda r: r[1])
+                print(f'{what:<16} {how:<10} {n:>10} {s:>8.2f} {n / s:>10.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 50])
+    parser.add_argument('--repeat', type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,146 @@
+import asyncio
+
+import asyncpg
+
+from db import CopyOpenflightsDB
+
+
+def _text(v):
+    # values are sent as text and cast by the server, like COPY does
+    if v is None or type(v) is str:
+        return v
+    if type(v) is bool:
+        return 't' if v else 'f'
+    return str(v)
+
+
+def _error_name(ex):
+    # asyncpg names its exceptions after the SQLSTATE like psycopg2 does,
+    # with an Error suffix (UniqueViolationError), which is dropped so that
+    # TableStats count the same names for every engine
+    n = type(ex).__name__
+    if isinstance(ex, asyncpg.PostgresError) and n.endswith('Error') and n != 'PostgresError':
+        return n[:-len('Error')]
+    return n
+
+
+class AsyncOpenflightsDB(CopyOpenflightsDB):
+    # Writes the buffered rows of CopyOpenflightsDB with INSERTs on a pool of
+    # asyncpg connections instead of COPY. Every flush splits the rows of a
+    # table into chunks of chunk_size rows, which are sent with executemany
+    # (all rows of a chunk pipelined, without waiting for each one) in a
+    # transaction of their own, up to one chunk per connection at a time.
+    #
+    # IDs, the NOT NULL and FK checks done before rows are sent and the key
+    # lookups work like they do for COPY, everything else (the lookups done
+    # before a flush, the incremental mode and the staged routes) goes
+    # through the psycopg2 connection of OpenflightsDB.
+    #
+    # A chunk with a bad row fails as a whole and is split in halves until
+    # the bad row is found, the halves run one after another. Rows that
+    # conflict with a row of a chunk that is in flight on another connection
+    # can fail in place of it, so which of two duplicates is kept is not
+    # always the first one.
+    def __init__(self, db_name, db_host, db_port, db_user, db_password,
+                 batch_size=10000, keys=None, connections=4, chunk_size=1000):
+        super().__init__(db_name, db_host, db_port, db_user, db_password, batch_size=batch_size, keys=keys)
+        self._connections = connections
+        self._chunk_size = chunk_size
+        # table -> INSERT statement per columns
+        self._statements = {}
+        # table -> column -> type, for the casts in the INSERTs
+        self._column_types = {}
+
+        # every instance runs its own event loop, clones are used from
+        # other threads
+        self._loop = asyncio.new_event_loop()
+        self._pool = self._loop.run_until_complete(asyncpg.create_pool(
+            database=db_name,
+            host=db_host,
+            port=db_port,
+            user=db_user,
+            password=db_password,
+            min_size=connections,
+            max_size=connections,
+            loop=self._loop,
+        ))
+
+
+    def _clone_kwargs(self):
+        # clones get a pool of their own, of the same size
+        return {**super()._clone_kwargs(), 'connections': self._connections, 'chunk_size': self._chunk_size}
+
+
+    def close(self):
+        self._loop.run_until_complete(self._pool.close())
+        self._loop.close()
+        super().close()
+
+
+    def _statement(self, table, columns):
+        key = (table, columns)
+        if key not in self._statements:
+            if table not in self._column_types:
+                with self._conn.cursor() as cur:
+                    # the internal type names (varchar, bpchar) have no
+                    # length, an explicit cast to varchar(n) would truncate
+                    # values instead of failing on them
+                    cur.execute(
+                        'SELECT attname, typname FROM pg_attribute JOIN pg_type ON pg_type.oid = atttypid '
+                        'WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped;',
+                        (table,)
+                    )
+                    self._column_types[table] = dict(cur.fetchall())
+
+            types = self._column_types[table]
+            columns = columns or tuple(types)
+            values_q = ','.join(f'${i}::text::{types[c]}' for i, c in enumerate(columns, 1))
+            self._statements[key] = f'INSERT INTO {table} ({",".join(columns)}) VALUES ({values_q});'
+        return self._statements[key]
+
+
+    def _copy(self, table, columns, rows, lines=None):
+        # returns the rows that were written
+        failed = self._missing_keys(table, columns, rows)
+        if failed:
+            rows = [r for i, r in enumerate(rows) if i not in failed]
+        if not rows:
+            return []
+
+        q = self._statement(table, columns)
+        chunks = [rows[i:i + self._chunk_size] for i in range(0, len(rows), self._chunk_size)]
+        return self._loop.run_until_complete(self._insert_chunks(table, q, chunks))
+
+
+    async def _insert_chunks(self, table, q, chunks):
+        # the pool hands out a connection per chunk, the others wait
+        async def _insert(rows):
+            async with self._pool.acquire() as conn:
+                return await self._insert_many(conn, table, q, rows)
+
+        written = await asyncio.gather(*(_insert(c) for c in chunks))
+        return [r for w in written for r in w]
+
+
+    async def _insert_many(self, conn, table, q, rows):
+        loop = self._loop
+        t = loop.time()
+        try:
+            async with conn.transaction():
+                await conn.executemany(q, [[_text(v) for v in r] for r in rows])
+        except asyncpg.PostgresError as ex:
+            error = ex
+        else:
+            self.table_stats[table].add_ok(len(rows))
+            self.table_stats[table].add_commit()
+            return rows
+        finally:
+            self.metrics.observe('insert', table, loop.time() - t)
+
+        if len(rows) == 1:
+            self.table_stats[table].add_errors(_error_name(error))
+            return []
+
+        half = len(rows) // 2
+        return (await self._insert_many(conn, table, q, rows[:half]) +
+                await self._insert_many(conn, table, q, rows[half:]))
@@ -0,0 +1,27 @@
+import unittest
+
+import asyncpg
+
+from asyncdb import AsyncOpenflightsDB, _error_name, _text
+
+
+class TestAsyncDB(unittest.TestCase):
+    def test_text(self):
+        self.assertEqual([_text(v) for v in (None, 'a', True, False, 3, 1.5)], [None, 'a', 't', 'f', '3', '1.5'])
+
+    def test_error_name(self):
+        # the same names the psycopg2 engines count
+        self.assertEqual(_error_name(asyncpg.exceptions.UniqueViolationError()), 'UniqueViolation')
+        self.assertEqual(_error_name(asyncpg.exceptions.NotNullViolationError()), 'NotNullViolation')
+        self.assertEqual(_error_name(ValueError()), 'ValueError')
+
+    def test_clone_kwargs(self):
+        # clones get a pool like the one of the instance they're made from
+        db = AsyncOpenflightsDB.__new__(AsyncOpenflightsDB)
+        db._batch_size, db.keys, db._connections, db._chunk_size = 500, object(), 2, 100
+        self.assertEqual(db._clone_kwargs(),
+                         {'batch_size': 500, 'keys': db.keys, 'connections': 2, 'chunk_size': 100})
+
+
+if __name__ == "__main__":
+    unittest.main()
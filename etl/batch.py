@@ -0,0 +1,121 @@
+import numpy as np
+
+from lineparser import LineParser
+from transform import translate_plane
+
+# The transform of read_routes and insert_route as array operations over
+# whole columns, instead of a couple of function calls per route: codes are
+# classified as IATA or ICAO by their length, stops cast to integers,
+# airline and airport IDs mapped to dense indices (0..n-1, e.g. to index
+# per-airport arrays with) and the equipment exploded into (route index,
+# plane index) pairs, with the plane codes translated like
+# translate_equipment does.
+#
+# Strings are NumPy unicode arrays, '' where the route has None. Missing
+# IDs and indices are -1, missing stops are 0 and marked in stops_valid.
+#
+# batch = RouteBatch.from_file('./data/routes.dat')
+# batch.plane_codes[batch.equipment_plane]   # plane code of every pair
+
+# the fields of a line of routes.dat, see read_routes
+_route_fields = ['nq'] * 9
+
+
+# Getting the Python strings into arrays is the only step per value. It's
+# done with a list of the values as they are, going through object arrays
+# (np.where, astype) is a couple of times slower.
+
+def _strings(col, dtype=str):
+    # column of str and None -> unicode array, None is ''
+    return np.array(['' if v is None else v for v in col], dtype=dtype)
+
+
+def _ints(col):
+    # column of numeric strings and None -> int64 array, None is -1
+    a = np.fromstring(' '.join(['-1' if v is None else v for v in col]), dtype=np.int64, sep=' ')
+    if len(a) != len(col):
+        raise ValueError('not a column of integers')
+    return a
+
+
+def _dense(ids):
+    # (distinct IDs, index of every ID into them), -1 stays -1
+    distinct, index = np.unique(ids, return_inverse=True)
+    if len(distinct) and distinct[0] == -1:
+        return distinct[1:], index.reshape(ids.shape) - 1
+    return distinct, index.reshape(ids.shape)
+
+
+def _lookup(distinct, index):
+    # the IDs of index, -1 for -1
+    return np.append(distinct, -1)[index]
+
+
+def _split_codes(codes, length):
+    # codes of the given length are IATA codes, the rest ICAO codes
+    is_iata = np.char.str_len(codes) == length
+    return np.where(is_iata, codes, ''), np.where(is_iata, '', codes)
+
+
+class RouteBatch:
+    def __init__(self, fields):
+        # fields: the 9 columns of parsed route fields (see _route_fields),
+        # each a sequence of str or None
+        (airline, airline_id, src, src_id, dest, dest_id,
+         codeshare, stops, equipment) = fields
+
+        self.airline_iata, self.airline_icao = _split_codes(_strings(airline), 2)
+        self.src_airport_iata, self.src_airport_icao = _split_codes(_strings(src), 3)
+        self.dest_airport_iata, self.dest_airport_icao = _split_codes(_strings(dest), 3)
+
+        # airline_ids[airline_idx] is the airline ID of every route
+        self.airline_ids, self.airline_idx = _dense(_ints(airline_id))
+        # source and destination share the airport indices
+        airports = np.concatenate((_ints(src_id), _ints(dest_id)))
+        self.airport_ids, airport_idx = _dense(airports)
+        self.src_airport_idx, self.dest_airport_idx = np.split(airport_idx, 2)
+
+        self.route_codeshare = np.array(codeshare, dtype=object) != None  # noqa: E711
+        stops = _ints(stops)
+        self.stops_valid = stops >= 0
+        self.route_stops = np.where(self.stops_valid, stops, 0).astype(np.int32)
+
+        # all codes in one go: every route has as many codes as it has
+        # spaces + 1 (none if it has no equipment)
+        equipment = _strings(equipment)
+        has_equipment = equipment != ''
+        counts = np.where(has_equipment, np.char.count(equipment, ' ') + 1, 0)
+        self.equipment_route = np.repeat(np.arange(len(equipment), dtype=np.int32), counts)
+        codes = np.array(' '.join(equipment[has_equipment]).split(' ') if has_equipment.any() else [], dtype=str)
+
+        # only the distinct codes are translated, translations can map two
+        # codes to the same plane
+        distinct, index = np.unique(codes, return_inverse=True)
+        translated = np.array([translate_plane(c) for c in distinct], dtype=str)
+        self.plane_codes, plane_idx = np.unique(translated, return_inverse=True)
+        self.equipment_plane = plane_idx.reshape(-1)[index.reshape(-1)].astype(np.int32)
+
+
+    @classmethod
+    def from_file(cls, fname, parser=LineParser):
+        lp = parser(_route_fields)
+        with open(fname) as f:
+            rows = list(lp.parse_lines(f))
+        return cls(list(zip(*rows)) if rows else [()] * len(_route_fields))
+
+
+    def __len__(self):
+        return len(self.route_codeshare)
+
+
+    def airline_id(self):
+        # airline ID of every route, -1 if it has none
+        return _lookup(self.airline_ids, self.airline_idx)
+
+
+    def src_airport_id(self):
+        return _lookup(self.airport_ids, self.src_airport_idx)
+
+
+    def dest_airport_id(self):
+        return _lookup(self.airport_ids, self.dest_airport_idx)
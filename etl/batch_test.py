@@ -0,0 +1,96 @@
+import tarfile
+import tempfile
+import unittest
+from os.path import dirname, isfile, join
+
+from batch import RouteBatch
+from extract import read_routes
+from transform import translate_plane
+
+routes = '''2B,410,AER,2965,KZN,2990,,0,CR2
+2B,410,ASF,2966,KZN,2990,,0,CR2 320
+AAL,\\N,ASF,\\N,UUEE,4029,Y,1,
+2B,410,CEK,2968,KZN,2990,,\\N,CR2
+KL,3090,AMS,580,KZN,2990,Y,0,73H 738
+'''
+
+data_tar = join(dirname(__file__), '..', 'data', 'data.tar.gz')
+
+
+def _id(s):
+    return int(s) if s else -1
+
+
+class TestRouteBatch(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+
+    def _file(self, content):
+        fname = join(self.dir.name, 'routes.dat')
+        with open(fname, 'w') as f:
+            f.write(content)
+        return fname
+
+
+    def assertSameRoutes(self, fname):
+        # the batch holds what read_routes and insert_route make of every route
+        want = list(read_routes(fname))
+        b = RouteBatch.from_file(fname)
+        self.assertEqual(len(b), len(want))
+
+        got = [(b.airline_iata[i] or None, b.airline_icao[i] or None, int(b.airline_id()[i]),
+                b.src_airport_iata[i] or None, b.src_airport_icao[i] or None, int(b.src_airport_id()[i]),
+                b.dest_airport_iata[i] or None, b.dest_airport_icao[i] or None, int(b.dest_airport_id()[i]),
+                bool(b.route_codeshare[i]), int(b.route_stops[i]) if b.stops_valid[i] else None)
+               for i in range(len(b))]
+        self.assertEqual(got, [(r.airline_iata, r.airline_icao, _id(r.airline_id),
+                                r.src_airport_iata, r.src_airport_icao, _id(r.src_airport_id),
+                                r.dest_airport_iata, r.dest_airport_icao, _id(r.dest_airport_id),
+                                bool(r.route_codeshare), r.route_stops)
+                               for r in want])
+
+        pairs = sorted((int(i), str(b.plane_codes[p])) for i, p in zip(b.equipment_route, b.equipment_plane))
+        self.assertEqual(pairs, sorted({(i, translate_plane(c)) for i, r in enumerate(want)
+                                        for c in r.route_equipment_iata}))
+
+
+    def test_routes(self):
+        self.assertSameRoutes(self._file(routes))
+
+
+    def test_indices(self):
+        b = RouteBatch.from_file(self._file(routes))
+        self.assertEqual(list(b.airline_ids), [410, 3090])
+        self.assertEqual(list(b.airline_idx), [0, 0, -1, 0, 1])
+        # source and destination airports share the indices
+        self.assertEqual(list(b.airport_ids), [580, 2965, 2966, 2968, 2990, 4029])
+        self.assertEqual(list(b.src_airport_idx), [1, 2, -1, 3, 0])
+        self.assertEqual(list(b.dest_airport_idx), [4, 4, 5, 4, 4])
+        self.assertEqual(list(b.equipment_route), [0, 1, 1, 3, 4, 4])
+
+
+    def test_empty(self):
+        b = RouteBatch.from_file(self._file(''))
+        self.assertEqual(len(b), 0)
+        self.assertEqual(len(b.equipment_route), 0)
+
+
+    def test_invalid_id(self):
+        with self.assertRaises(ValueError):
+            RouteBatch.from_file(self._file('2B,4x0,AER,2965,KZN,2990,,0,CR2\n'))
+
+
+    @unittest.skipUnless(isfile(data_tar), 'data/data.tar.gz not found')
+    def test_dat_file(self):
+        with tarfile.open(data_tar) as tar:
+            tar.extractall(self.dir.name, members=[tar.getmember('routes.dat')])
+        self.assertSameRoutes(join(self.dir.name, 'routes.dat'))
+
+
+if __name__ == "__main__":
+    unittest.main()
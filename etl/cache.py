@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import tempfile
+from dataclasses import fields
+from operator import attrgetter
+from os.path import abspath, dirname, expanduser, getsize, join
+
+from delta import file_hash
+
+# Cache of extracted rows on disk, so that a run whose source files didn't
+# change skips reading and parsing them (and what the readers do on top,
+# like translate_country or combine_planes).
+#
+# An entry holds the rows of one source (e.g. 'routes'), the rows read from
+# a couple of files by a reader. Its key is the hash of the source name,
+# the options of the reader (e.g. the parser), the path, size, mtime and
+# content hash of every file, and the hash of the code that produces the
+# rows (_code), so changing a reader invalidates its entries too.
+#
+# Entries are pickled (protocol 5) as the row type and one tuple per row.
+# Strings that repeat (interned by the readers) are pickled once and are
+# shared again after loading. Entries are loaded straight from an mmap of
+# the file.
+#
+# Once the entries take more than max_bytes, the ones used the longest ago
+# are removed (their mtime is set on every use).
+
+CACHE_DIR = join(expanduser(os.environ.get('XDG_CACHE_HOME', '~/.cache')), 'openflights-etl')
+
+_suffix = '.rows'
+
+# the code the cached rows depend on (combine_planes is in main.py)
+_code = [join(dirname(__file__), f) for f in ('extract.py', 'lineparser.py', 'main.py', 'model.py', 'transform.py')]
+
+
+def _file_key(fname):
+    st = os.stat(fname)
+    return f'{abspath(fname)}:{st.st_size}:{st.st_mtime_ns}:{file_hash([fname])}'
+
+
+class ExtractCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=512 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._code_hash = None
+
+
+    def key(self, name, fnames, options=''):
+        if self._code_hash is None:
+            self._code_hash = file_hash(_code)
+        h = hashlib.sha256()
+        for part in (name, options, self._code_hash, *map(_file_key, fnames)):
+            h.update(part.encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+
+    def _path(self, name, key):
+        return join(self.directory, f'{name}-{key}{_suffix}')
+
+
+    def source(self, name, read, fnames, options=''):
+        # Wraps a reader (e.g. partial(read_routes, fname)) of rows read
+        # from fnames. Calling it yields the cached rows if there's an entry
+        # for the files as they are now, otherwise the rows of read, which
+        # are stored once all of them have been read
+        def _rows():
+            path = self._path(name, self.key(name, fnames, options))
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                self.misses += 1
+                yield from self._record(name, path, read)
+                return
+
+            self.hits += 1
+            with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                row_type, rows = pickle.loads(mm)
+            os.utime(path)
+            logging.info(f'{name}: {len(rows)} rows from {path}')
+            for t in rows:
+                yield row_type(*t)
+
+        return _rows
+
+
+    def _record(self, name, path, read):
+        rows = []
+        row_type = None
+        as_tuple = None
+        for r in read():
+            if not row_type:
+                row_type = type(r)
+                as_tuple = attrgetter(*(f.name for f in fields(row_type)))
+            rows.append(as_tuple(r))
+            yield r
+
+        self._store(path, row_type, rows)
+        logging.info(f'{name}: {len(rows)} rows cached in {path}')
+
+
+    def _store(self, path, row_type, rows):
+        os.makedirs(self.directory, exist_ok=True)
+        # written to a temporary file first, a run reading the entry at the
+        # same time either finds all of it or none
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((row_type, rows), f, protocol=5)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+
+    def entries(self):
+        # (path, size, mtime) of every entry, used the longest ago first
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(_suffix)]
+        except FileNotFoundError:
+            return []
+        entries = []
+        for n in names:
+            path = join(self.directory, n)
+            try:
+                entries.append((path, getsize(path), os.stat(path).st_mtime_ns))
+            except FileNotFoundError:
+                # removed by another run
+                continue
+        return sorted(entries, key=lambda e: e[2])
+
+
+    def evict(self):
+        # removes the entries used the longest ago until the rest fit into
+        # max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+    def clear(self, names=None):
+        # removes the entries of the sources in names, or all of them.
+        # Returns the number of entries removed
+        removed = 0
+        for path, _, _ in self.entries():
+            name = os.path.basename(path).rsplit('-', 1)[0]
+            if names and name not in names:
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from os.path import join
+
+from cache import ExtractCache
+from extract import read_countries
+from model import CountryDat
+
+countries = '''"Bonaire, Saint Eustatius and Saba","BQ",""
+"Aruba","AW","AA"
+"Antigua and Barbuda","AG","AC"
+'''
+
+
+class TestExtractCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fname = join(self.dir.name, 'countries.dat')
+        with open(self.fname, 'w') as f:
+            f.write(countries)
+        self.cache = ExtractCache(join(self.dir.name, 'cache'))
+        self.reads = 0
+
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+
+    def _read(self):
+        self.reads += 1
+        return read_countries(self.fname)
+
+
+    def _source(self, name='countries', options=''):
+        return self.cache.source(name, self._read, [self.fname], options)
+
+
+    def test_hit(self):
+        want = list(read_countries(self.fname))
+        self.assertEqual(list(self._source()()), want)
+        self.assertEqual(list(self._source()()), want)
+        self.assertEqual(self.reads, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertIsInstance(next(self._source()()), CountryDat)
+
+
+    def test_partial_read(self):
+        # only rows that were read completely are stored
+        next(self._source()())
+        self.assertEqual(self.cache.entries(), [])
+
+
+    def test_invalidation(self):
+        list(self._source()())
+        with open(self.fname, 'a') as f:
+            f.write('"Austria","AT","AU"\n')
+        rows = list(self._source()())
+        self.assertEqual(rows[-1], CountryDat('Austria', 'AT', 'AU'))
+        self.assertEqual(self.reads, 2)
+
+        # same content, but touched
+        st = os.stat(self.fname)
+        os.utime(self.fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        list(self._source()())
+        self.assertEqual(self.reads, 3)
+
+        list(self._source(options='CsvLineParser')())
+        self.assertEqual(self.reads, 4)
+
+
+    def test_evict(self):
+        list(self._source('a')())
+        list(self._source('b')())
+        list(self._source('a')())
+        # b was used the longest ago
+        size = 0
+        for path, size, _ in self.cache.entries():
+            if os.path.basename(path).startswith('b-'):
+                os.utime(path, ns=(0, 10**9))
+        self.cache.max_bytes = size * 2
+        list(self._source('c')())
+        names = sorted(os.path.basename(p).split('-')[0] for p, _, _ in self.cache.entries())
+        self.assertEqual(names, ['a', 'c'])
+
+
+    def test_clear(self):
+        for name in ('a', 'b', 'c'):
+            list(self._source(name)())
+        self.assertEqual(self.cache.clear(['b']), 1)
+        self.assertEqual(len(self.cache.entries()), 2)
+        self.assertEqual(self.cache.clear(), 2)
+        self.assertEqual(self.cache.entries(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+from array import array
+from dataclasses import fields
+from operator import attrgetter
+
+from model import AirportDat, RouteDat
+
+
+class NumberColumn:
+    # Numbers in a typed array ('i': int32, 'd': float64, see the array
+    # module), which can be used as is by anything that supports the buffer
+    # protocol, e.g. numpy.frombuffer(c.data, numpy.float64).
+    # None is stored as 0 and marked in valid.
+    def __init__(self, typecode):
+        self.data = array(typecode)
+        self.valid = bytearray()
+
+    def append(self, v):
+        if v is None:
+            self.data.append(0)
+            self.valid.append(0)
+        else:
+            self.data.append(v)
+            self.valid.append(1)
+
+    def __getitem__(self, i):
+        return self.data[i] if self.valid[i] else None
+
+    def __len__(self):
+        return len(self.data)
+
+
+class IdColumn(NumberColumn):
+    # int32 storage for IDs the row type keeps as strings (RouteDat)
+    def __init__(self):
+        super().__init__('i')
+
+    def append(self, v):
+        super().append(int(v) if v is not None else None)
+
+    def __getitem__(self, i):
+        return str(self.data[i]) if self.valid[i] else None
+
+
+class BoolColumn(NumberColumn):
+    def __init__(self):
+        super().__init__('b')
+
+    def __getitem__(self, i):
+        return bool(self.data[i]) if self.valid[i] else None
+
+
+class DictColumn:
+    # Dictionary encoded strings: every distinct string is stored once in
+    # values and rows only hold its index (int32) in codes. None is -1.
+    def __init__(self):
+        self.codes = array('i')
+        self.values = []
+        self._index = {}
+
+    def encode(self, v):
+        if v is None:
+            return -1
+        code = self._index.get(v)
+        if code is None:
+            code = self._index[v] = len(self.values)
+            self.values.append(v)
+        return code
+
+    def append(self, v):
+        self.codes.append(self.encode(v))
+
+    def __getitem__(self, i):
+        code = self.codes[i]
+        return self.values[code] if code >= 0 else None
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class StrColumn(list):
+    # strings that are (mostly) unique, e.g. names, dictionary encoding
+    # wouldn't save anything
+    pass
+
+
+class ListColumn:
+    # Tuples of strings, stored like Arrow stores lists: all items one
+    # after another (dictionary encoded) and the offset of each row's first
+    # item, row i are the items offsets[i]:offsets[i + 1]
+    def __init__(self):
+        self.offsets = array('i', [0])
+        self.items = DictColumn()
+
+    def append(self, v):
+        for e in v:
+            self.items.append(e)
+        self.offsets.append(len(self.items))
+
+    def __getitem__(self, i):
+        items = self.items
+        return tuple(items[j] for j in range(self.offsets[i], self.offsets[i + 1]))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class Columns:
+    # Rows of row_type stored column by column, using the column types above
+    # instead of one dataclass per row. Subclasses set row_type and columns
+    # (one column factory per field of row_type).
+    #
+    # Iterating yields row_type instances again, one at a time, so loaders
+    # can be given Columns instead of a reader. Analytics can use the
+    # columns directly, they're attributes named like the fields.
+    row_type = None
+    columns = {}
+
+    def __init__(self, rows=()):
+        self._names = [f.name for f in fields(self.row_type)]
+        self._cols = [self.columns[n]() for n in self._names]
+        for n, c in zip(self._names, self._cols):
+            setattr(self, n, c)
+
+        self.extend(rows)
+
+    def extend(self, rows):
+        as_tuple = attrgetter(*self._names)
+        appends = [c.append for c in self._cols]
+        for r in rows:
+            for append, v in zip(appends, as_tuple(r)):
+                append(v)
+
+    def __len__(self):
+        return len(self._cols[0])
+
+    def __getitem__(self, i):
+        return self.row_type(*(c[i] for c in self._cols))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def _int32():
+    return NumberColumn('i')
+
+
+def _float64():
+    return NumberColumn('d')
+
+
+class AirportColumns(Columns):
+    row_type = AirportDat
+    columns = {
+        'airport_id': _int32,
+        'airport_name': StrColumn,
+        'city': DictColumn,
+        'country': DictColumn,
+        'airport_iata': StrColumn,
+        'airport_icao': StrColumn,
+        'latitude': _float64,
+        'longitude': _float64,
+        'altitude_ft': _int32,
+        'timezone_offset': _float64,
+        'daylight_saving': DictColumn,
+        'timezone': DictColumn,
+        'type': DictColumn,
+        'source': DictColumn,
+    }
+
+
+class RouteColumns(Columns):
+    row_type = RouteDat
+    columns = {
+        'airline_iata': DictColumn,
+        'airline_icao': DictColumn,
+        'airline_id': IdColumn,
+        'src_airport_iata': DictColumn,
+        'src_airport_icao': DictColumn,
+        'src_airport_id': IdColumn,
+        'dest_airport_iata': DictColumn,
+        'dest_airport_icao': DictColumn,
+        'dest_airport_id': IdColumn,
+        'route_codeshare': BoolColumn,
+        'route_stops': _int32,
+        'route_equipment_iata': ListColumn,
+    }
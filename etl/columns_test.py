@@ -0,0 +1,51 @@
+import unittest
+
+from columns import AirportColumns, DictColumn, ListColumn, RouteColumns
+from model import AirportDat, RouteDat
+
+airports = [
+    AirportDat(1, 'Goroka Airport', 'Goroka', 'Papua New Guinea', 'GKA', 'AYGA', -6.081689834590001, 145.391998291, 5282, 10.0, 'U', 'Port_Moresby', 'airport', 'OurAirports'),
+    AirportDat(2, 'Madang Airport', 'Madang', 'Papua New Guinea', 'MAG', 'AYMD', -5.20707988739, 145.789001465, 20, 10.0, 'U', 'Port_Moresby', 'airport', 'OurAirports'),
+    AirportDat(3, 'No City', None, 'Papua New Guinea', None, None, 0.0, 0.0, None, None, None, None, None, None),
+]
+
+routes = [
+    RouteDat('2B', None, '410', 'AER', None, '2965', 'KZN', None, '2990', False, 0, ('CR2',)),
+    RouteDat(None, 'AAL', None, 'ASF', None, None, 'KZN', None, '2990', True, 1, ()),
+    RouteDat('2B', None, '410', 'ASF', None, '2966', None, 'UUEE', '4029', False, 0, ('CR2', '320')),
+]
+
+
+class TestColumns(unittest.TestCase):
+    def test_roundtrip(self):
+        for rows, cols in ((airports, AirportColumns(airports)), (routes, RouteColumns(routes))):
+            self.assertEqual(len(cols), len(rows))
+            self.assertEqual(list(cols), rows)
+            self.assertEqual(cols[1], rows[1])
+
+    def test_typed(self):
+        cols = AirportColumns(airports)
+        self.assertEqual(cols.latitude.data.typecode, 'd')
+        self.assertEqual(cols.airport_id.data.typecode, 'i')
+        self.assertEqual(list(cols.altitude_ft.valid), [1, 1, 0])
+        self.assertEqual(cols.country.values, ['Papua New Guinea'])
+        self.assertEqual(list(cols.country.codes), [0, 0, 0])
+
+    def test_dict_column(self):
+        c = DictColumn()
+        for v in ('a', None, 'b', 'a'):
+            c.append(v)
+        self.assertEqual(list(c.codes), [0, -1, 1, 0])
+        self.assertEqual([c[i] for i in range(len(c))], ['a', None, 'b', 'a'])
+
+    def test_list_column(self):
+        c = ListColumn()
+        for v in (['CR2'], [], ['CR2', '320']):
+            c.append(v)
+        self.assertEqual(list(c.offsets), [0, 1, 1, 3])
+        self.assertEqual(c.items.values, ['CR2', '320'])
+        self.assertEqual([c[i] for i in range(len(c))], [('CR2',), (), ('CR2', '320')])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,7 @@
+import io
 import logging
+import re
+import threading
 from collections import defaultdict
 from contextlib import contextmanager
 from dataclasses import asdict, astuple, dataclass, field
@@ -6,20 +9,56 @@ from pprint import pprint
 from traceback import print_exc
 
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+from psycopg2.extras import execute_values
 
+from metrics import Metrics
 from model import PlaneDat
-from transform import translate_country, translate_plane
+from resolve import KeyResolver
+from schema import dependency_order, load_schema
+from validate import ConstraintError
+from transform import plane_translations, translate_country
 from collections import defaultdict
 from functools import partial
+from itertools import count
+from time import perf_counter
 
 @dataclass
 class TableStats:
     insert_ok : int = 0
     insert_errors : dict = field(default_factory=partial(defaultdict, int))
+    commits : int = 0
+    # incremental and upsert mode only, see delta.py and
+    # OpenflightsDB.upsert. Rows that were upserted without a change count
+    # as unchanged
+    updated : int = 0
+    deleted : int = 0
+    unchanged : int = 0
 
     def add_ok(self, i=1):
         self.insert_ok += i
 
+    def add_updated(self, i=1):
+        self.updated += i
+
+    def add_deleted(self, i=1):
+        self.deleted += i
+
+    def add_unchanged(self, i=1):
+        self.unchanged += i
+
+    def add_commit(self, i=1):
+        self.commits += i
+
+    def merge(self, other):
+        self.insert_ok += other.insert_ok
+        self.commits += other.commits
+        self.updated += other.updated
+        self.deleted += other.deleted
+        self.unchanged += other.unchanged
+        for n, i in other.insert_errors.items():
+            self.insert_errors[n] += i
+
     def add_error(self, ex):
         n = type(ex).__name__
         # if n in self.insert_errors:
@@ -28,17 +67,40 @@ class TableStats:
         #     self.insert_errors[n] = 1
         self.insert_errors[n] += 1
 
+    def add_errors(self, name, i=1):
+        # for errors that were found without raising them, by exception name
+        self.insert_errors[name] += i
+
 
 class OpenflightsDB:
-    def __init__(self, db_name, db_host, db_port, db_user, db_password):
-        self._conn = psycopg2.connect(
-            database=db_name,
-            host=db_host,
-            port=db_port,
-            user=db_user,
-            password=db_password
-        )
-        self._conn.autocommit = True
+    # columns of the tables that are inserted with positional values
+    _columns = {
+        'airports': (
+            'airport_id',
+            'airport_name',
+            'city_id',
+            'airport_iata',
+            'airport_icao',
+            'airport_geo_location',
+            'airport_altitude_ft',
+            'type',
+            'source',
+        ),
+        'route_plane': ('route_id', 'plane_id'),
+    }
+
+    def __init__(self, db_name, db_host, db_port, db_user, db_password, batch_size=1, keys=None):
+        self._conn_args = (db_name, db_host, db_port, db_user, db_password)
+        # with a batch size of 1 every row is committed on its own,
+        # otherwise batch_size rows are committed together
+        self._batch_size = batch_size
+        self._conn = self._connect()
+
+        # rows and tables in the current transaction
+        self._tx_rows = 0
+        self._tx_tables = set()
+        # prepended to every INSERT in batched mode, see _execute_insert
+        self._savepoint_q = '' if batch_size <= 1 else 'SAVEPOINT row; '
         
         self._tables_pk = {
             'airlines': 'airline_id',
@@ -51,10 +113,49 @@ class OpenflightsDB:
         }
 
         self.table_stats = defaultdict(TableStats)
+        self.metrics = Metrics()
+
+        if keys is None:
+            keys = self._load_keys()
+        self.keys = keys
+
+        # checks rows before they're sent, see set_validator
+        self.validator = None
 
-        self._plane_iata_cache = {}
-        self._country_name_cache = {}
-        self._city_name_cache = {}
+        # With upsert set, rows whose key (see _upsert_keys) is already in
+        # the DB are updated instead of failing with a UniqueViolation.
+        # Only the insert engine supports it
+        self.upsert = False
+        # (table, columns) -> INSERT ... ON CONFLICT, see _execute_upsert
+        self._upsert_q = {}
+        # (table, columns, values_q, key) -> rows waiting to be upserted
+        # together, see _buffer_upsert
+        self._upsert_rows = defaultdict(list)
+        # table -> (key columns, values) upserted so far, shared with clones
+        self._upserted = defaultdict(set)
+
+        # set on clones, see clone
+        self._parent = None
+        self._lock = threading.Lock()
+
+
+    def _connect(self):
+        db_name, db_host, db_port, db_user, db_password = self._conn_args
+        conn = psycopg2.connect(
+            database=db_name,
+            host=db_host,
+            port=db_port,
+            user=db_user,
+            password=db_password
+        )
+        conn.autocommit = self._batch_size <= 1
+        return conn
+
+
+    def _load_keys(self):
+        keys = KeyResolver()
+        keys.load(self._conn)
+        return keys
 
 
     def __enter__(self):
@@ -66,102 +167,576 @@ class OpenflightsDB:
         self._cur.close() 
 
 
+    def _execute_insert(self, table, q, values):
+        # Runs an INSERT ... RETURNING for a single row and returns the
+        # value it returned, or None if the row could not be inserted.
+        rows = self._execute(table, q, values, kind='insert')
+        if rows:
+            self.table_stats[table].add_ok()
+            if self.validator:
+                self.validator.add_id(table, rows[0][0])
+            return rows[0][0]
+
+
+    def _execute(self, table, q, values, kind='insert'):
+        # Runs a statement for a single row and returns the rows it
+        # returned, or None if it failed. Its latency is recorded in
+        # metrics under kind (insert, update, delete or lookup).
+        #
+        # In batched mode every row gets its own savepoint, set in the same
+        # round trip as the statement, so that a failing row only rolls back
+        # itself and not the rows before it in the transaction.
+        with self._conn.cursor() as cur:
+            t = perf_counter()
+            try:
+                cur.execute(self._savepoint_q + q, values)
+                rows = cur.fetchall() if cur.description else []
+            except Exception as ex:
+                self.table_stats[table].add_error(ex)
+                sent = self._rollback_row(cur)
+                rows = None
+            else:
+                sent = True
+                if self._conn.autocommit:
+                    self.table_stats[table].add_commit()
+            finally:
+                self.metrics.observe(kind, table, perf_counter() - t)
+
+        if sent:
+            self._row_done(table)
+        return rows
+
+
+    def _rollback_row(self, cur):
+        # After a statement of _execute failed in batched mode, rolls the
+        # transaction back to the savepoint set in front of it. Returns
+        # whether there was anything to roll back: errors raised before the
+        # statement was sent (e.g. a value psycopg2 can't adapt) leave the
+        # transaction as it was, without the savepoint. Rolling back then
+        # would undo the row before, or fail if there was none
+        if self._conn.autocommit or self._conn.info.transaction_status != TRANSACTION_STATUS_INERROR:
+            return False
+        cur.execute('ROLLBACK TO SAVEPOINT row;')
+        return True
+
+
+    def _row_done(self, table, n=1):
+        if self._conn.autocommit:
+            return
+
+        self._savepoint_q = 'RELEASE SAVEPOINT row; SAVEPOINT row; '
+        self._tx_tables.add(table)
+        self._tx_rows += n
+        if self._tx_rows >= self._batch_size:
+            self.commit()
+
+
+    def commit(self):
+        if self._conn.autocommit or not self._tx_rows:
+            return
+
+        with self.metrics.timed('commit', 'all'):
+            self._conn.commit()
+        for t in self._tx_tables:
+            self.table_stats[t].add_commit()
+
+        self._tx_rows = 0
+        self._tx_tables = set()
+        self._savepoint_q = 'SAVEPOINT row; '
+
+
     def _insert(self, table, values, update=False):
         pk = self._tables_pk.get(table, None)
         if not pk:
             raise ValueError(f'dont know PK for table {table}')
 
+        if not self._validate(table, self._columns[table], values):
+            return
         values_q = ','.join('%s' for _ in values)
+        if update or self.upsert:
+            return self._execute_upsert(table, self._columns[table], values_q, values, values)
         q = f'INSERT INTO {table} VALUES ({values_q}) RETURNING {pk};'
-        with self._conn.cursor() as cur:
-            try:
-                cur.execute(q, values)
-            # except psycopg2.errors.UniqueViolation as ex:
-            #     self.table_stats[table].add_error(ex)
-            #     if update:
-            #         raise NotImplementedError
-            except Exception as ex:
-                self.table_stats[table].add_error(ex)
-            else:
-                self.table_stats[table].add_ok()
-                return cur.fetchone()[0]
+        return self._execute_insert(table, q, values)
 
 
     def _insert_kv(self, table, value_dict, update=False):
         pk = self._tables_pk.get(table, None)
         if not pk:
             raise ValueError(f'dont know PK for table {table}')
+        if not self._validate(table, tuple(value_dict.keys()), tuple(value_dict.values())):
+            return
         cols_q = ','.join(value_dict.keys())
         values_q = ','.join('%s' for _ in value_dict.values())
+        if update or self.upsert:
+            values = tuple(value_dict.values())
+            return self._execute_upsert(table, tuple(value_dict.keys()), values_q, values, values)
         q = f'INSERT INTO {table} ({cols_q}) VALUES ({values_q}) RETURNING {pk};'
-        
+        return self._execute_insert(table, q, tuple(value_dict.values()))
+
+
+    # the tables of schema/create.sql, loaded on first use
+    _schema = None
+
+    def _upsert_keys(self, table, columns):
+        # The keys rows of table can be upserted on: the PK if the rows
+        # have it (e.g. airports), otherwise the unique constraints of
+        # schema/create.sql whose columns they all have (e.g. country_name)
+        if OpenflightsDB._schema is None:
+            OpenflightsDB._schema = load_schema()
+        t = OpenflightsDB._schema[table]
+        pk = t.primary_key
+        if set(pk.columns) <= set(columns):
+            return [pk.columns]
+        keys = [c.columns for c in t.constraints if c.kind == 'UNIQUE' and set(c.columns) <= set(columns)]
+        if not keys:
+            raise ValueError(f'no unique constraint of {table} is covered by {columns}')
+        return keys
+
+
+    def _upsert_conflict(self, table, columns, key):
+        # the ON CONFLICT (key) ... clause of the upserts. The IS DISTINCT
+        # FROM guard skips the update, and with it writing a new row
+        # version, if nothing changed
+        rest = [c for c in columns if c not in key]
+        if rest:
+            # point has no equality operator, its text form does
+            cast = {c: '::text' if self._schema[table].column(c).definition.startswith('point') else '' for c in rest}
+            set_q = ', '.join(f'{c} = EXCLUDED.{c}' for c in rest)
+            old_q = ', '.join(f'{table}.{c}{cast[c]}' for c in rest)
+            new_q = ', '.join(f'EXCLUDED.{c}{cast[c]}' for c in rest)
+            # ROW() also for a single column
+            conflict_q = f'DO UPDATE SET {set_q} WHERE ROW({old_q}) IS DISTINCT FROM ROW({new_q})'
+        else:
+            conflict_q = 'DO NOTHING'
+        return f'ON CONFLICT ({",".join(key)}) {conflict_q}'
+
+
+    def _upsert_query(self, table, columns, values_q, key):
+        # INSERT ... ON CONFLICT (key) for a single row that returns its PK
+        # and whether it was inserted (true), updated (false) or left as it
+        # was (NULL). Rows that weren't touched aren't returned by the
+        # INSERT, their PK is looked up by the key in the same statement
+        # (the snapshot it sees is from before the INSERT, so it only finds
+        # rows that were there)
+        pk = self._tables_pk[table]
+        key_q = ' AND '.join(f'{c} = %s' for c in key)
+        return (
+            f'WITH up AS (INSERT INTO {table} ({",".join(columns)}) VALUES ({values_q}) '
+            f'{self._upsert_conflict(table, columns, key)} RETURNING {pk}, xmax = 0 AS inserted) '
+            f'SELECT {pk}, inserted FROM up '
+            f'UNION ALL SELECT {pk}, NULL FROM {table} WHERE {key_q} AND NOT EXISTS (SELECT FROM up);'
+        )
+
+
+    def _execute_upsert(self, table, columns, values_q, values, row):
+        # Upserts a single row: values are sent for the placeholders of
+        # values_q, row has the values of columns (they differ for
+        # airport_geo_location). Returns the PK of the row, or None if it
+        # failed. It's counted as inserted, updated or unchanged
+        #
+        # The row is upserted on the first of its keys without NULLs, NULLs
+        # never conflict (e.g. planes without IATA code go by ICAO code)
+        keys = self._upsert_keys(table, columns)
+        row_keys = [(key, tuple(row[columns.index(c)] for c in key)) for key in keys]
+        row_keys = [(key, v) for key, v in row_keys if None not in v]
+        key, key_values = row_keys[0] if row_keys else (keys[0], (None,) * len(keys[0]))
+
+        # A row with a key that was upserted before in the same run fails,
+        # like it would without upserts. Otherwise the last of them would
+        # win, and every run would update the row twice
+        upserted = self._upserted[table]
+        if any(k in upserted for k in row_keys):
+            self.table_stats[table].add_errors('UniqueViolation')
+            return
+
+        if key == self._schema[table].primary_key.columns:
+            # the row has its PK, nothing has to be looked up
+            return self._buffer_upsert(table, columns, values_q, values, key, row_keys)
+
+        cache_key = (table, columns, values_q, key)
+        if cache_key not in self._upsert_q:
+            self._upsert_q[cache_key] = self._upsert_query(table, columns, values_q, key)
+        rows = self._execute(table, self._upsert_q[cache_key], tuple(values) + key_values, kind='upsert')
+        if not rows:
+            return
+        upserted.update(row_keys)
+        *pk, inserted = rows[0]
+        self._count_upsert(table, inserted)
+        return pk[0]
+
+
+    def _count_upsert(self, table, inserted):
+        # inserted as returned by _upsert_query
+        stats = self.table_stats[table]
+        if inserted:
+            stats.add_ok()
+        elif inserted is None:
+            stats.add_unchanged()
+        else:
+            stats.add_updated()
+
+
+    # rows per INSERT of _send_upserts
+    _upsert_page = 1000
+
+    def _buffer_upsert(self, table, columns, values_q, values, key, row_keys):
+        # Rows that have their PK (e.g. airports) are upserted
+        # _upsert_page at a time, with a multi-row INSERT. Returns the PK
+        # like a single row upsert would, before the row is sent. Its keys
+        # count as upserted right away, a duplicate in the same INSERT
+        # would fail it as a whole
+        self._upserted[table].update(row_keys)
+        rows = self._upsert_rows[(table, columns, values_q, key)]
+        key_values = dict(row_keys)[key]
+        rows.append((values, key_values, row_keys))
+        if len(rows) >= self._upsert_page:
+            self._send_upserts()
+        return key_values[0]
+
+
+    def _send_upserts(self):
+        for (table, columns, values_q, key), rows in self._upsert_rows.items():
+            if rows:
+                self._upsert_many(table, columns, values_q, key, rows)
+        self._upsert_rows.clear()
+
+
+    def _upsert_many(self, table, columns, values_q, key, rows):
+        # Only the rows inserted or updated are returned, the rest were
+        # unchanged. If the INSERT fails (a bad row fails all of them), the
+        # rows are upserted one by one, so that the error is counted for
+        # the rows that caused it
+        q = (
+            f'INSERT INTO {table} ({",".join(columns)}) VALUES {",".join(f"({values_q})" for _ in rows)} '
+            f'{self._upsert_conflict(table, columns, key)} RETURNING xmax = 0 AS inserted;'
+        )
         with self._conn.cursor() as cur:
+            t = perf_counter()
             try:
-                cur.execute(q, tuple(value_dict.values()))
-            except psycopg2.errors.UniqueViolation as ex:
-                self.table_stats[table].add_error(ex)
-                if update:
-                    raise NotImplementedError
-            # except psycopg2.errors.ForeignKeyViolation as ex:
-            #      self.table_stats[table].add_error(ex)
-            except Exception as ex:
-               self.table_stats[table].add_error(ex)
-            else:
-                self.table_stats[table].add_ok()
-                return cur.fetchone()[0]
+                cur.execute(self._savepoint_q + q, [v for values, _, _ in rows for v in values])
+                returned = [r[0] for r in cur.fetchall()]
+            except Exception:
+                self._rollback_row(cur)
+                returned = None
+            finally:
+                self.metrics.observe('upsert', table, perf_counter() - t)
+
+        stats = self.table_stats[table]
+        if returned is None:
+            logging.debug(f'{table}: upserting {len(rows)} rows failed, upserting them one by one')
+            upserted = self._upserted[table]
+            for _, _, row_keys in rows:
+                upserted.difference_update(row_keys)
+            cache_key = (table, columns, values_q, key)
+            if cache_key not in self._upsert_q:
+                self._upsert_q[cache_key] = self._upsert_query(table, columns, values_q, key)
+            for values, key_values, row_keys in rows:
+                result = self._execute(table, self._upsert_q[cache_key], tuple(values) + key_values, kind='upsert')
+                if result:
+                    upserted.update(row_keys)
+                    self._count_upsert(table, result[0][-1])
+            return
+
+        if self._conn.autocommit:
+            stats.add_commit()
+        self._row_done(table, len(rows))
+        inserted = sum(returned)
+        stats.add_ok(inserted)
+        stats.add_updated(len(returned) - inserted)
+        stats.add_unchanged(len(rows) - len(returned))
+
+
+    def set_validator(self, validator):
+        # Rows are checked by validator (see validate.py) before they're
+        # sent, the rows already in the DB are loaded into it first
+        validator.load(self._conn)
+        self.validator = validator
+
+
+    def _validate(self, table, columns, row):
+        # returns False if the validator rejected the row, it's counted in
+        # TableStats then
+        if not self.validator:
+            return True
+        try:
+            self.validator.check(table, columns, row)
+        except ConstraintError as ex:
+            logging.debug(f'{table}: {ex}')
+            self.table_stats[table].add_errors(ex.name)
+            self.validator.reject(table, columns, row, ex)
+            return False
+        return True
+
+
+    def _where(self, key_dict):
+        # NULLs in keys (e.g. route_stops) have to match as well
+        where_q = ' AND '.join(
+            f'{c} IS NULL' if v is None else f'{c} = %s' for c, v in key_dict.items()
+        )
+        return where_q, tuple(v for v in key_dict.values() if v is not None)
+
+
+    def _update(self, table, key_dict, value_dict):
+        # Updates the row identified by key_dict. Returns its PK, or None if
+        # there is no such row or the update failed
+        pk = self._tables_pk[table]
+        set_q = ','.join(f'{c} = %s' for c in value_dict)
+        where_q, key_values = self._where(key_dict)
+        q = f'UPDATE {table} SET {set_q} WHERE {where_q} RETURNING {pk};'
+        rows = self._execute(table, q, tuple(value_dict.values()) + key_values, kind='update')
+        if rows:
+            self.table_stats[table].add_updated()
+            return rows[0][0]
+
+
+    def _delete(self, table, key_dict):
+        # Deletes the row identified by key_dict. Returns its PK, or None if
+        # there is no such row or the delete failed
+        pk = self._tables_pk[table]
+        where_q, key_values = self._where(key_dict)
+        rows = self._execute(table, f'DELETE FROM {table} WHERE {where_q} RETURNING {pk};', key_values, kind='delete')
+        if rows:
+            self.table_stats[table].add_deleted()
+            return rows[0][0]
+
+
+    def flush(self):
+        # rows are sent as soon as they're inserted (except for upserts
+        # of rows that have their PK), only the open transaction has to be
+        # committed. Engines that buffer rows override this
+        self._send_upserts()
+        self.commit()
 
 
     def close(self):
+        # the validator is shared with the clones
+        if self.validator and not self._parent:
+            self.validator.close()
         self._conn.close()
 
 
-    def get_plane_by_iata(self, n):
-        if n in self._plane_iata_cache:
-            return self._plane_iata_cache[n]
+    def _clone_kwargs(self):
+        # the keyword arguments clones are constructed with, besides the
+        # ones of the connection
+        return {'batch_size': self._batch_size, 'keys': self.keys}
+
+
+    def clone(self):
+        # Returns a new instance with its own connection to the same DB,
+        # sharing the key lookups with this one. Clones are used to load
+        # from several threads at once, their table_stats have to be merged
+        # back using merge_stats
+        c = self.__class__(*self._conn_args, **self._clone_kwargs())
+        c._parent = self
+        c.validator = self.validator
+        c.upsert = self.upsert
+        c._upserted = self._upserted
+        return c
 
+
+    # state of the incremental mode, see delta.py. table -> hash of the
+    # source files it was last loaded from, and (table, row key) -> hash
+    # of the source row and the ID of the row it was loaded into
+    _state_ddl = (
+        'CREATE TABLE IF NOT EXISTS etl_files ('
+        ' table_name varchar(40) PRIMARY KEY,'
+        ' file_hash char(64) NOT NULL,'
+        ' loaded_at timestamp with time zone NOT NULL DEFAULT now());',
+        'CREATE TABLE IF NOT EXISTS etl_rows ('
+        ' table_name varchar(40),'
+        ' row_key text,'
+        ' row_hash char(32) NOT NULL,'
+        ' row_id integer,'
+        ' PRIMARY KEY (table_name, row_key));',
+        # state written before the IDs were kept
+        'ALTER TABLE etl_rows ADD COLUMN IF NOT EXISTS row_id integer;',
+    )
+
+    def create_state_tables(self):
+        # Once per run, before any phase. Phases may run on connections of
+        # their own at the same time (--parallel-phases), and concurrent
+        # CREATE TABLE IF NOT EXISTS of the same table can fail
+        self.commit()
         with self._conn.cursor() as cur:
-            cur.execute('SELECT plane_id FROM planes WHERE plane_iata = %s;', (n,))
-            r = cur.fetchone()
-            v = r[0] if r else None
-            if v:
-                self._plane_iata_cache[n] = v
-            return v
+            for q in self._state_ddl:
+                cur.execute(q)
+        self._state_commit()
+
+
+    def _state_cursor(self):
+        # state is written outside of the batched transactions of the data
+        self.commit()
+        return self._conn.cursor()
+
+
+    def _state_commit(self):
+        if not self._conn.autocommit:
+            self._conn.commit()
+
+
+    def get_file_hash(self, table):
+        with self._state_cursor() as cur:
+            cur.execute('SELECT file_hash FROM etl_files WHERE table_name = %s;', (table,))
+            row = cur.fetchone()
+        self._state_commit()
+        return row[0] if row else None
+
+
+    def get_row_hashes(self, table):
+        # row key -> (hash, row ID)
+        with self._state_cursor() as cur:
+            cur.execute('SELECT row_key, row_hash, row_id FROM etl_rows WHERE table_name = %s;', (table,))
+            rows = {k: (h, i) for k, h, i in cur.fetchall()}
+        self._state_commit()
+        return rows
+
+
+    def clear_file_hashes(self, tables):
+        # the tables are diffed against their rows on their next load, even
+        # if their files didn't change
+        with self._state_cursor() as cur:
+            cur.execute('DELETE FROM etl_files WHERE table_name = ANY(%s);', (list(tables),))
+        self._state_commit()
+
+
+    def existing_ids(self, table, ids):
+        # the IDs of ids that are in table
+        pk = self._tables_pk[table]
+        with self._state_cursor() as cur, self.metrics.timed('lookup', table):
+            cur.execute(f'SELECT {pk} FROM {table} WHERE {pk} = ANY(%s);', (list(ids),))
+            existing = {r[0] for r in cur.fetchall()}
+        self._state_commit()
+        return existing
+
+
+    def count_rows(self, table):
+        with self._state_cursor() as cur, self.metrics.timed('lookup', table):
+            cur.execute(f'SELECT count(*) FROM {table};')
+            n = cur.fetchone()[0]
+        self._state_commit()
+        return n
+
+
+    def save_state(self, table, file_hash, changed, deleted):
+        # changed: row key -> (hash, row ID) of new and updated rows,
+        # deleted: row keys. Without file_hash the table is diffed again on
+        # its next load
+        with self._state_cursor() as cur:
+            if deleted:
+                cur.execute(
+                    'DELETE FROM etl_rows WHERE table_name = %s AND row_key = ANY(%s);',
+                    (table, list(deleted))
+                )
+            execute_values(
+                cur,
+                'INSERT INTO etl_rows (table_name, row_key, row_hash, row_id) VALUES %s '
+                'ON CONFLICT (table_name, row_key) DO UPDATE SET row_hash = EXCLUDED.row_hash, row_id = EXCLUDED.row_id;',
+                [(table, k, h, i) for k, (h, i) in changed.items()],
+                page_size=1000
+            )
+            # last, so that the file isn't considered loaded if anything
+            # before failed
+            if file_hash is None:
+                cur.execute('DELETE FROM etl_files WHERE table_name = %s;', (table,))
+            else:
+                cur.execute(
+                    'INSERT INTO etl_files (table_name, file_hash) VALUES (%s, %s) '
+                    'ON CONFLICT (table_name) DO UPDATE SET file_hash = EXCLUDED.file_hash, loaded_at = now();',
+                    (table, file_hash)
+                )
+        self._state_commit()
+
+
+    def merge_stats(self, other):
+        for t, s in other.table_stats.items():
+            self.table_stats[t].merge(s)
+        self.metrics.merge(other.metrics)
+
+
+    def _add_key(self, table, key, row_id):
+        # make an inserted row known to the lookups
+        self.keys.add(table, key, row_id)
+
+
+    def _remove_key(self, table, key, row_id):
+        if row_id:
+            self.keys.remove(table, key, row_id)
+
+
+    def get_plane_by_iata(self, n):
+        p_id = self.keys.plane(n)
+        self.metrics.lookup('planes', p_id is not None)
+        return p_id
 
 
     def get_country_by_name(self, n):
-        if n in self._country_name_cache:
-            return self._country_name_cache[n]
-    
-        with self._conn.cursor() as cur:
-            cur.execute('SELECT country_id FROM countries WHERE country_name = %s;', (n,))
-            r = cur.fetchone() 
-            v = r[0] if r else None
-            if v:
-                self._country_name_cache[n] = v
-            return v
+        c_id = self.keys.country(n)
+        self.metrics.lookup('countries', c_id is not None)
+        return c_id
 
 
     def get_city_by_name(self, n):
-        if n in self._city_name_cache:
-            return self._city_name_cache[n]
-
-        with self._conn.cursor() as cur:
-            cur.execute('SELECT city_id FROM cities WHERE city_name = %s;', (n,))
-            r = cur.fetchone() 
-            v = r[0] if r else None
-            if v:
-                self._city_name_cache[n] = v
-            return v
+        c_id = self.keys.city(n)
+        self.metrics.lookup('cities', c_id is not None)
+        return c_id
 
 
     def insert_country(self, country):
         v = asdict(country)
-        return self._insert_kv('countries', v)
+        country_id = self._insert_kv('countries', v)
+        if country_id:
+            self._add_key('countries', country.country_name, country_id)
+        return country_id
+
+
+    def update_country(self, country):
+        v = asdict(country)
+        key = {'country_name': v.pop('country_name')}
+        return self._update('countries', key, v)
+
+
+    def delete_country(self, country_name):
+        country_id = self._delete('countries', {'country_name': country_name})
+        self._remove_key('countries', country_name, country_id)
+        return country_id
+
+
+    def _city_key(self, country_name, city_name):
+        # the keys of the incremental state can be from before
+        # cities_from_airports translated country names
+        ci = self.get_country_by_name(translate_country(country_name))
+        if not ci:
+            logging.debug(f'no country ID found for "{country_name}". Skipping.')
+            return
+        return {'city_name': city_name, 'country_id': ci}
+
+
+    def update_city(self, city):
+        key = self._city_key(city.country_name, city.city_name)
+        if not key:
+            return
+
+        v = {
+            'city_timezone_offset_utc': city.city_timezone_offset_utc,
+            'city_daylight_saving': city.city_daylight_saving,
+            'city_timezone': city.city_timezone,
+        }
+        return self._update('cities', key, v)
+
+
+    def delete_city(self, country_name, city_name):
+        key = self._city_key(country_name, city_name)
+        if not key:
+            return
+
+        city_id = self._delete('cities', key)
+        self._remove_key('cities', city_name, city_id)
+        return city_id
 
 
     def insert_city(self, city):
         v = asdict(city)
-        cn = translate_country(v.pop('country_name'))
+        cn = v.pop('country_name')
         del v['city_id']
        
         ci = self.get_country_by_name(cn)
@@ -170,7 +745,10 @@ class OpenflightsDB:
             return
 
         v['country_id'] = ci
-        return self._insert_kv('cities', v)
+        city_id = self._insert_kv('cities', v)
+        if city_id:
+            self._add_key('cities', city.city_name, city_id)
+        return city_id
         
 
     def insert_airline(self, airline):
@@ -183,6 +761,17 @@ class OpenflightsDB:
         return self._insert_kv('airlines', v)
                
 
+    def update_airline(self, airline):
+        v = asdict(airline)
+        del v['country']
+        key = {'airline_id': v.pop('airline_id')}
+        return self._update('airlines', key, v)
+
+
+    def delete_airline(self, airline_id):
+        return self._delete('airlines', {'airline_id': airline_id})
+
+
     def insert_airport(self, airport):
         cn = airport.city
         ci = self.get_city_by_name(cn)
@@ -201,32 +790,74 @@ class OpenflightsDB:
             airport.type,
             airport.source,
         )
-        q = 'INSERT INTO airports VALUES (%s,%s,%s,%s,%s,point(%s,%s),%s,%s,%s) RETURNING airport_id;'
-        
-        with self._conn.cursor() as cur:
-            try:
-                cur.execute(q, apdb)
-            except Exception as ex:
-                self.table_stats['airports'].add_error(ex)
-            else:
-                self.table_stats['airports'].add_ok()
-                return cur.fetchone()[0]
+        # the location isn't checked
+        row = apdb[:5] + ((airport.latitude, airport.longitude),) + apdb[7:]
+        if not self._validate('airports', self._columns['airports'], row):
+            return
+        values_q = '%s,%s,%s,%s,%s,point(%s,%s),%s,%s,%s'
+        if self.upsert:
+            return self._execute_upsert('airports', self._columns['airports'], values_q, apdb, row)
+        q = f'INSERT INTO airports VALUES ({values_q}) RETURNING airport_id;'
+        return self._execute_insert('airports', q, apdb)
+
+
+    def update_airport(self, airport):
+        ci = self.get_city_by_name(airport.city)
+        if not ci:
+            logging.debug(f'update_airport: no city ID found for "{airport.city}". Skipping.')
+            return
+
+        geo = None
+        if airport.latitude is not None and airport.longitude is not None:
+            geo = f'({airport.latitude},{airport.longitude})'
+
+        v = {
+            'airport_name': airport.airport_name,
+            'city_id': ci,
+            'airport_iata': airport.airport_iata,
+            'airport_icao': airport.airport_icao,
+            'airport_geo_location': geo,
+            'airport_altitude_ft': airport.altitude_ft,
+            'type': airport.type,
+            'source': airport.source,
+        }
+        return self._update('airports', {'airport_id': airport.airport_id}, v)
+
+
+    def delete_airport(self, airport_id):
+        return self._delete('airports', {'airport_id': airport_id})
 
 
     def insert_plane(self, plane):
         v = asdict(plane)
-        return self._insert_kv('planes', v)
+        plane_id = self._insert_kv('planes', v)
+        if plane_id:
+            self._add_key('planes', plane.plane_iata, plane_id)
+        return plane_id
+
+
+    def update_plane(self, plane):
+        key = {'plane_iata': plane.plane_iata, 'plane_icao': plane.plane_icao}
+        return self._update('planes', key, {'plane_name': plane.plane_name})
+
 
+    def delete_plane(self, plane_iata, plane_icao):
+        plane_id = self._delete('planes', {'plane_iata': plane_iata, 'plane_icao': plane_icao})
+        self._remove_key('planes', plane_iata, plane_id)
+        return plane_id
+
+
+    # the columns of routes' unique key, which is how routes are identified
+    _route_key = (
+        'airline_id',
+        'src_airport_id',
+        'dest_airport_id',
+        'route_codeshare',
+        'route_stops'
+    )
 
     def insert_route(self, route):
-        keep = [
-            'airline_id',
-            'src_airport_id',
-            'dest_airport_id',
-            'route_codeshare',
-            'route_stops'
-        ]
-        v = {k:v for k,v in asdict(route).items() if k in keep}
+        v = {k:getattr(route, k) for k in self._route_key}
 
         route_id = self._insert_kv('routes',v)
         if not route_id:
@@ -235,12 +866,758 @@ class OpenflightsDB:
         if route_id:
             logging.debug(f'inserted route {v}')
 
-        for p in route.route_equipment_iata:
-            p_id = self.get_plane_by_iata(translate_plane(p))
+        self._insert_route_planes(route_id, route.route_equipment_iata)
+        return route_id
+
+
+    def update_route(self, route):
+        # the only thing that can change about a route is its equipment
+        where_q, key_values = self._where({k: getattr(route, k) for k in self._route_key})
+        # a lookup, it doesn't count as a row of the batched transaction
+        with self._conn.cursor() as cur, self.metrics.timed('lookup', 'routes'):
+            cur.execute(f'SELECT route_id FROM routes WHERE {where_q};', key_values)
+            row = cur.fetchone()
+        if not row:
+            return
+
+        route_id = row[0]
+        self._execute('route_plane', 'DELETE FROM route_plane WHERE route_id = %s;', (route_id,), kind='delete')
+        self._insert_route_planes(route_id, route.route_equipment_iata)
+        self.table_stats['routes'].add_updated()
+        return route_id
+
+
+    def delete_route(self, *key):
+        return self._delete('routes', dict(zip(self._route_key, key)))
+
+
+    def _insert_route_planes(self, route_id, equipment):
+        # the codes are translated already, see translate_equipment
+        for p in equipment:
+            p_id = self.get_plane_by_iata(p)
             if not p_id:
                 # if we don't know the plane insert a DUMMY plane 
                 # so that we can still insert the route
-                p_id = self.insert_plane(PlaneDat('DUMMY', p, None))
+                p_id = self._insert_dummy_plane(p)
 
             self._insert('route_plane',(route_id, p_id))
-        return route_id
\ No newline at end of file
+
+
+    def _insert_dummy_plane(self, iata):
+        if not self._parent:
+            return self.insert_plane(PlaneDat('DUMMY', iata, None))
+
+        # Clones create DUMMY planes through the instance they were cloned
+        # from, which writes them right away. Otherwise two clones could
+        # both try to add the same plane, or reference one that is still
+        # uncommitted in another clone's transaction. The plane is only
+        # made known to the lookups once it's committed, clones look
+        # planes up without the lock
+        parent = self._parent
+        with parent._lock:
+            p_id = self.get_plane_by_iata(iata)
+            if not p_id:
+                p_id = parent._insert_kv('planes', asdict(PlaneDat('DUMMY', iata, None)))
+                parent.flush()
+                if p_id:
+                    parent._add_key('planes', iata, p_id)
+            return p_id
+
+
+    def insert_routes_staged(self, routes):
+        # Loads all routes at once instead of one by one: the routes are
+        # COPYed into an unlogged staging table and routes, route_plane and
+        # DUMMY planes are filled from there with a couple of INSERT ...
+        # SELECT. The outcome is the same as insert_route for every route,
+        # rows that would fail are found up front and counted in TableStats
+        # the same way.
+        #
+        # Everything happens in one transaction, which leaves nothing
+        # behind if it fails.
+        self.flush()
+        with self._conn.cursor() as cur:
+            if self._conn.autocommit:
+                cur.execute('BEGIN;')
+            try:
+                self._stage_routes(cur, routes)
+                with self.metrics.timed('insert', 'routes'):
+                    self._load_staged_routes(cur)
+                with self.metrics.timed('insert', 'route_plane'):
+                    self._load_staged_route_planes(cur)
+                cur.execute('DROP TABLE route_staging, route_ids, route_plane_staging, plane_translations;')
+            except Exception:
+                if self._conn.autocommit:
+                    cur.execute('ROLLBACK;')
+                else:
+                    self._conn.rollback()
+                raise
+
+            if self._conn.autocommit:
+                cur.execute('COMMIT;')
+            else:
+                self._conn.commit()
+
+
+    def _stage_routes(self, cur, routes):
+        cur.execute('''
+            DROP TABLE IF EXISTS route_staging, route_ids, route_plane_staging, plane_translations;
+            CREATE UNLOGGED TABLE route_staging (
+                line integer PRIMARY KEY,
+                airline_id integer,
+                src_airport_id integer,
+                dest_airport_id integer,
+                route_codeshare boolean,
+                route_stops integer,
+                equipment text,
+                error text
+            );
+            CREATE UNLOGGED TABLE plane_translations (
+                route_iata text PRIMARY KEY,
+                plane_iata text NOT NULL
+            );
+        ''')
+        execute_values(cur, 'INSERT INTO plane_translations VALUES %s;', list(plane_translations.items()))
+
+        buf = io.StringIO()
+        for i, r in enumerate(routes):
+            buf.write(_copy_line((
+                i,
+                r.airline_id,
+                r.src_airport_id,
+                r.dest_airport_id,
+                r.route_codeshare,
+                r.route_stops,
+                ' '.join(r.route_equipment_iata) or None,
+            )))
+        buf.seek(0)
+        with self.metrics.timed('copy', 'routes'):
+            cur.copy_expert(
+                'COPY route_staging (line, airline_id, src_airport_id, dest_airport_id, '
+                'route_codeshare, route_stops, equipment) FROM STDIN;',
+                buf
+            )
+            cur.execute('ANALYZE route_staging;')
+
+
+    def _load_staged_routes(self, cur):
+        # Mark the routes that can't be inserted, in the order the checks
+        # would fail for a single INSERT: NOT NULL columns, FKs (the rows
+        # before with the same key might have failed on those, so they're
+        # not duplicates) and the unique key (NULLs are never equal)
+        cur.execute('''
+            UPDATE route_staging SET error = 'NotNullViolation'
+            WHERE airline_id IS NULL OR src_airport_id IS NULL OR dest_airport_id IS NULL;
+
+            UPDATE route_staging s SET error = 'ForeignKeyViolation'
+            WHERE error IS NULL AND (
+                NOT EXISTS (SELECT 1 FROM airports WHERE airport_id = s.src_airport_id) OR
+                NOT EXISTS (SELECT 1 FROM airports WHERE airport_id = s.dest_airport_id)
+            );
+
+            UPDATE route_staging s SET error = 'UniqueViolation'
+            FROM (
+                SELECT line, row_number() OVER (
+                    PARTITION BY airline_id, src_airport_id, dest_airport_id, route_codeshare, route_stops
+                    ORDER BY line
+                ) n
+                FROM route_staging
+                WHERE error IS NULL AND route_codeshare IS NOT NULL AND route_stops IS NOT NULL
+            ) d
+            WHERE s.line = d.line AND d.n > 1;
+
+            UPDATE route_staging s SET error = 'UniqueViolation'
+            WHERE error IS NULL AND EXISTS (
+                SELECT 1 FROM routes r
+                WHERE r.airline_id = s.airline_id
+                    AND r.src_airport_id = s.src_airport_id
+                    AND r.dest_airport_id = s.dest_airport_id
+                    AND r.route_codeshare = s.route_codeshare
+                    AND r.route_stops = s.route_stops
+            );
+        ''')
+
+        # IDs come from the routes sequence, in file order, so that
+        # route_plane can be filled without looking them up again
+        cur.execute('''
+            CREATE UNLOGGED TABLE route_ids AS
+            SELECT line, nextval(pg_get_serial_sequence('routes', 'route_id')) route_id
+            FROM (SELECT line FROM route_staging WHERE error IS NULL ORDER BY line) o;
+
+            INSERT INTO routes (route_id, airline_id, src_airport_id, dest_airport_id, route_codeshare, route_stops)
+            SELECT i.route_id, s.airline_id, s.src_airport_id, s.dest_airport_id, s.route_codeshare, s.route_stops
+            FROM route_staging s JOIN route_ids i USING (line)
+            ORDER BY i.route_id;
+        ''')
+        stats = self.table_stats['routes']
+        stats.add_ok(cur.rowcount)
+        stats.add_commit()
+
+        cur.execute('SELECT error, count(*) FROM route_staging WHERE error IS NOT NULL GROUP BY error;')
+        for name, n in cur.fetchall():
+            stats.add_errors(name, n)
+
+
+    def _load_staged_route_planes(self, cur):
+        # one row per plane code of every inserted route. Codes are looked
+        # up translated (see translate_plane), the first plane with that
+        # IATA code wins like in KeyResolver
+        cur.execute('''
+            CREATE UNLOGGED TABLE route_plane_staging AS
+            SELECT i.route_id, e.code, e.pos, coalesce(t.plane_iata, e.code) lookup, NULL::integer plane_id
+            FROM route_staging s
+                JOIN route_ids i USING (line)
+                CROSS JOIN unnest(string_to_array(s.equipment, ' ')) WITH ORDINALITY e(code, pos)
+                LEFT JOIN plane_translations t ON t.route_iata = e.code;
+
+            UPDATE route_plane_staging s SET plane_id = p.plane_id
+            FROM (
+                SELECT DISTINCT ON (plane_iata) plane_iata::text, plane_id
+                FROM planes
+                WHERE plane_iata IS NOT NULL
+                ORDER BY plane_iata, plane_id
+            ) p
+            WHERE p.plane_iata = s.lookup;
+        ''')
+
+        # unknown planes get a DUMMY plane with the untranslated code, in the
+        # order they're first used. Codes that don't fit into plane_iata or
+        # that are taken (by a plane whose code they were translated from)
+        # can't have one, every route using them fails to insert it
+        cur.execute('''
+            SELECT code, count(*)
+            FROM route_plane_staging
+            WHERE plane_id IS NULL
+            GROUP BY code
+            ORDER BY min(ARRAY[route_id, pos]);
+        ''')
+        unknown = cur.fetchall()
+        cur.execute(
+            'SELECT rtrim(plane_iata) FROM planes WHERE plane_iata::text = ANY(%s);',
+            ([code for code, _ in unknown],)
+        )
+        taken = {r[0] for r in cur.fetchall()}
+
+        new = []
+        for code, n in unknown:
+            if len(code) > 3:
+                self.table_stats['planes'].add_errors('StringDataRightTruncation', n)
+            elif code in taken:
+                self.table_stats['planes'].add_errors('UniqueViolation', n)
+            else:
+                new.append((code,))
+
+        if new:
+            dummies = execute_values(
+                cur,
+                "INSERT INTO planes (plane_name, plane_iata) VALUES %s RETURNING rtrim(plane_iata), plane_id;",
+                new,
+                template="('DUMMY', %s)",
+                page_size=len(new),
+                fetch=True
+            )
+
+            for iata, plane_id in dummies:
+                self.keys.add('planes', iata, plane_id)
+            self.table_stats['planes'].add_ok(len(dummies))
+            self.table_stats['planes'].add_commit()
+
+            execute_values(
+                cur,
+                '''
+                UPDATE route_plane_staging s SET plane_id = d.plane_id
+                FROM (VALUES %s) d (code, plane_id)
+                WHERE s.plane_id IS NULL AND s.code = d.code;
+                ''',
+                dummies,
+                page_size=len(dummies)
+            )
+
+        cur.execute('''
+            INSERT INTO route_plane (route_id, plane_id)
+            SELECT DISTINCT ON (route_id, plane_id) route_id, plane_id
+            FROM route_plane_staging
+            WHERE plane_id IS NOT NULL
+            ORDER BY route_id, plane_id, pos;
+        ''')
+        inserted = cur.rowcount
+        stats = self.table_stats['route_plane']
+        stats.add_ok(inserted)
+        stats.add_commit()
+
+        # the rows DISTINCT ON dropped are the ones that would have
+        # violated the PK
+        cur.execute('''
+            SELECT count(*) FILTER (WHERE plane_id IS NULL), count(*) FILTER (WHERE plane_id IS NOT NULL)
+            FROM route_plane_staging;
+        ''')
+        no_plane, with_plane = cur.fetchone()
+        duplicates = with_plane - inserted
+        if no_plane:
+            stats.add_errors('NotNullViolation', no_plane)
+        if duplicates:
+            stats.add_errors('UniqueViolation', duplicates)
+
+
+    def drop_constraints(self, tables):
+        # --cold-load: drops the PKs, unique constraints and FKs of tables
+        # (name -> schema.Table), so that rows are loaded without updating
+        # indexes or checking FKs row by row. See add_constraints
+        with self._conn.cursor() as cur:
+            # FKs first, they depend on the PKs they reference
+            for t in tables.values():
+                for c in t.foreign_keys:
+                    cur.execute(f'ALTER TABLE {t.name} DROP CONSTRAINT IF EXISTS {c.name};')
+            for t in tables.values():
+                for c in t.constraints:
+                    if c.kind != 'FOREIGN KEY':
+                        cur.execute(f'ALTER TABLE {t.name} DROP CONSTRAINT IF EXISTS {c.name};')
+        self._conn.commit()
+
+
+    def rollback(self):
+        # drops the rows of the current transaction
+        if self._conn.autocommit:
+            return
+
+        self._conn.rollback()
+        self._tx_rows = 0
+        self._tx_tables = set()
+        self._savepoint_q = 'SAVEPOINT row; '
+
+
+    def missing_constraints(self, tables):
+        # table name -> the constraints of tables (name -> schema.Table)
+        # the DB doesn't have
+        with self._conn.cursor() as cur:
+            cur.execute('SELECT conrelid::regclass::text, conname FROM pg_constraint;')
+            existing = set(cur.fetchall())
+        if not self._conn.autocommit:
+            self._conn.commit()
+        missing = {}
+        for name, t in tables.items():
+            cs = [c for c in t.constraints if (name, c.name) not in existing]
+            if cs:
+                missing[name] = cs
+        return missing
+
+
+    def add_constraints(self, tables):
+        # Adds the constraints dropped by drop_constraints again, all
+        # constraints of a table with one ALTER TABLE. The rows violating
+        # them are deleted first and counted in TableStats as if they had
+        # failed to insert, in the order a single INSERT checks them:
+        #
+        #   - rows referencing a row that was deleted are deleted without
+        #     being counted, a normal load never writes them (e.g. the
+        #     route_plane rows of a duplicate route)
+        #   - rows referencing a row that doesn't exist: ForeignKeyViolation
+        #   - rows with the same key: UniqueViolation, except for the one
+        #     with the lowest ID, the first one inserted, which is also the
+        #     one KeyResolver maps the key to
+        #
+        # Tables are processed parents before children. Tables that have
+        # their constraints already are skipped, so this can run again
+        # after it failed halfway
+        deleted = defaultdict(set)
+        missing = self.missing_constraints(tables)
+        with self._conn.cursor() as cur:
+            for name in dependency_order(tables):
+                t = tables[name]
+                if name not in missing:
+                    continue
+                stats = self.table_stats[name]
+                pk = t.primary_key.columns
+                returning_q = f' RETURNING {pk[0]}' if len(pk) == 1 else ''
+
+                def _delete(q, values=None, error=None):
+                    with self.metrics.timed('delete', name):
+                        cur.execute(q + returning_q + ';', values)
+                    stats.add_ok(-cur.rowcount)
+                    if error and cur.rowcount:
+                        stats.add_errors(error, cur.rowcount)
+                    if returning_q:
+                        deleted[name].update(r[0] for r in cur.fetchall())
+
+                for fk in t.foreign_keys:
+                    col, ref_col = fk.columns[0], fk.ref_columns[0]
+                    if deleted[fk.ref_table]:
+                        _delete(f'DELETE FROM {name} WHERE {col} = ANY(%s)', (list(deleted[fk.ref_table]),))
+                    _delete(
+                        f'DELETE FROM {name} c WHERE {col} IS NOT NULL AND NOT EXISTS '
+                        f'(SELECT 1 FROM {fk.ref_table} p WHERE p.{ref_col} = c.{col})',
+                        error='ForeignKeyViolation'
+                    )
+
+                for c in t.constraints:
+                    if c.kind == 'FOREIGN KEY':
+                        continue
+                    cols = ', '.join(c.columns)
+                    # NULLs are never equal
+                    not_null_q = ' AND '.join(f'{col} IS NOT NULL' for col in c.columns)
+                    order = 'ctid' if c.columns == pk else ', '.join(pk + ('ctid',))
+                    _delete(
+                        f'DELETE FROM {name} WHERE ctid IN (SELECT ctid FROM ('
+                        f'SELECT ctid, row_number() OVER (PARTITION BY {cols} ORDER BY {order}) n '
+                        f'FROM {name} WHERE {not_null_q}) d WHERE n > 1)',
+                        error='UniqueViolation'
+                    )
+
+                # the indexes come first, the FKs of children use them
+                add_q = ', '.join(
+                    f'ADD CONSTRAINT {c.name} {c.definition()}'
+                    for c in sorted(t.constraints, key=lambda c: c.kind == 'FOREIGN KEY')
+                )
+                with self.metrics.timed('constraints', name):
+                    cur.execute(f'ALTER TABLE {name} {add_q};')
+                self._conn.commit()
+                logging.info(f'added the constraints of {name}')
+
+
+    def run_sql_file(self, fname):
+        # runs the statements of an SQL file, e.g. schema/spatial.sql
+        self.commit()
+        with open(fname) as f, self._conn.cursor() as cur:
+            cur.execute(f.read())
+        self._conn.commit()
+
+
+_copy_escapes = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+def _copy_line(row):
+    # encode a row for COPY's text format
+    return '\t'.join([
+        r'\N' if v is None else
+        v.translate(_copy_escapes) if type(v) is str else
+        ('t' if v else 'f') if type(v) is bool else
+        str(v)
+        for v in row
+    ]) + '\n'
+
+
+class CopyOpenflightsDB(OpenflightsDB):
+    # Buffers rows per table and writes them using COPY FROM STDIN instead
+    # of one INSERT ... RETURNING round trip per row. IDs are allocated client
+    # side, starting after the highest ID already in the table, so that
+    # dependent rows can reference a row before it has been written.
+    #
+    # A COPY fails as a whole if a single row is bad. Rows that can't be
+    # written because of NULLs or missing FK targets are therefore rejected
+    # before they are sent. Other bad rows are located using the line number
+    # reported by the server, or by splitting the batch if there is none, and
+    # the rest is retried. TableStats therefore still count failures per row.
+
+    # order in which buffered tables are written, parents before children
+    _copy_order = (
+        'countries',
+        'planes',
+        'cities',
+        'airports',
+        'airlines',
+        'routes',
+        'route_plane',
+    )
+
+    # NOT NULL columns from schema/create.sql. Rows with NULLs there can never
+    # be written, so they're rejected before they cost a failed COPY
+    _not_null = {
+        'countries': ('country_name',),
+        'planes': ('plane_name',),
+        'cities': ('city_name',),
+        'airports': ('airport_id', 'airport_name'),
+        'airlines': ('airline_name',),
+        'routes': ('airline_id', 'src_airport_id', 'dest_airport_id'),
+        'route_plane': ('route_id', 'plane_id'),
+    }
+
+    # FK columns from schema/create.sql and the table they reference
+    _foreign_keys = {
+        'cities': {'country_id': 'countries'},
+        'airlines': {'country_id': 'countries'},
+        'airports': {'city_id': 'cities'},
+        'routes': {'src_airport_id': 'airports', 'dest_airport_id': 'airports'},
+        'route_plane': {'route_id': 'routes', 'plane_id': 'planes'},
+    }
+
+    def __init__(self, db_name, db_host, db_port, db_user, db_password, batch_size=10000, keys=None):
+        # every COPY runs in its own transaction
+        super().__init__(db_name, db_host, db_port, db_user, db_password, keys=keys)
+        self._batch_size = batch_size
+
+        # (table, columns) -> list of rows
+        self._buffers = defaultdict(list)
+        self._buffered = 0
+
+        # table -> iterator over free IDs, shared with clones
+        self._next_id = {}
+        self._next_id_lock = threading.Lock()
+        # tables whose identity sequence has to be moved past the IDs we handed out
+        self._allocated = set()
+        # table -> IDs of rows that could not be written
+        self._failed_ids = defaultdict(set)
+        # plane IATA -> ID of planes that are buffered but not written yet
+        self._pending_planes = {}
+        # table -> IDs known to exist in the DB
+        self._known_ids = defaultdict(set)
+        # (table, columns) -> indexes of the NOT NULL columns
+        self._not_null_idx = {}
+
+
+    def clone(self):
+        c = super().clone()
+        c._next_id = self._next_id
+        c._next_id_lock = self._next_id_lock
+        return c
+
+
+    def _allocate_id(self, table):
+        with self._next_id_lock:
+            if table not in self._next_id:
+                pk = self._tables_pk[table]
+                with self._conn.cursor() as cur, self.metrics.timed('lookup', table):
+                    cur.execute(f'SELECT coalesce(max({pk}), 0) FROM {table};')
+                    self._next_id[table] = count(cur.fetchone()[0] + 1)
+
+            self._allocated.add(table)
+            return next(self._next_id[table])
+
+
+    def _buffer(self, table, columns, row):
+        # returns False if the row was rejected
+        if not self._validate(table, columns, row):
+            return False
+
+        key = (table, columns)
+        if key not in self._not_null_idx:
+            self._not_null_idx[key] = [
+                (c, columns.index(c)) for c in self._not_null.get(table, ()) if c in columns
+            ]
+
+        for c, i in self._not_null_idx[key]:
+            if row[i] is None:
+                self.table_stats[table].add_error(psycopg2.errors.NotNullViolation(
+                    f'null value in column "{c}" violates not-null constraint'
+                ))
+                return False
+
+        self._buffers[(table, columns)].append(row)
+        self._buffered += 1
+        if self._buffered >= self._batch_size:
+            self.flush()
+        return True
+
+
+    def _insert(self, table, values, update=False):
+        pk = self._tables_pk.get(table, None)
+        if not pk:
+            raise ValueError(f'dont know PK for table {table}')
+        if update or self.upsert:
+            raise ValueError('rows are buffered, upserts need the insert engine')
+
+        # values cover all columns of the table in order
+        if self._buffer(table, self._columns.get(table), tuple(values)) and ',' not in pk:
+            return values[0]
+
+
+    def _insert_kv(self, table, value_dict, update=False):
+        pk = self._tables_pk.get(table, None)
+        if not pk:
+            raise ValueError(f'dont know PK for table {table}')
+        if update or self.upsert:
+            raise ValueError('rows are buffered, upserts need the insert engine')
+
+        v = dict(value_dict)
+        if pk not in v:
+            v[pk] = self._allocate_id(table)
+
+        if self._buffer(table, tuple(v.keys()), tuple(v.values())):
+            return v[pk]
+
+
+    def insert_airport(self, airport):
+        cn = airport.city
+        ci = self.get_city_by_name(cn)
+        if not ci:
+            logging.debug(f'insert_airport: no city ID found for "{cn}". Skipping.')
+            return
+
+        apdb = (
+            airport.airport_id,
+            airport.airport_name,
+            ci,
+            airport.airport_iata,
+            airport.airport_icao,
+            self._geo(airport),
+            airport.altitude_ft,
+            airport.type,
+            airport.source,
+        )
+        if self._buffer('airports', self._columns['airports'], apdb):
+            return airport.airport_id
+
+
+    def _geo(self, airport):
+        # airport_geo_location in COPY's text format
+        if airport.latitude is not None and airport.longitude is not None:
+            return f'({airport.latitude},{airport.longitude})'
+
+
+    def _add_key(self, table, key, row_id):
+        # rows are only made known to the lookups once they've been written,
+        # see _written. DUMMY planes are the exception, they're needed right
+        # away by the routes referencing them
+        if table == 'planes' and key is not None:
+            self._pending_planes.setdefault(key, row_id)
+
+
+    def get_plane_by_iata(self, n):
+        if n in self._pending_planes:
+            self.metrics.lookup('planes', True)
+            return self._pending_planes[n]
+        return super().get_plane_by_iata(n)
+
+
+    def _failed_line(self, ex, n):
+        # errors raised while reading the COPY input report the line they
+        # happened on. Returns its index or None
+        diag = getattr(ex, 'diag', None)
+        m = re.match(r'COPY \w+, line (\d+)', (diag and diag.context) or '')
+        if not m or int(m.group(1)) > n:
+            return None
+        return int(m.group(1)) - 1
+
+
+    def _missing_keys(self, table, columns, rows):
+        # FK checks run at the end of the COPY and only report the first
+        # missing key, after all rows have been processed. Checking the keys
+        # of the batch first is much cheaper than failing on them. Only keys
+        # that weren't written by us have to be looked up.
+        # Returns the indexes of the rows referencing a missing key
+        failed = set()
+        for col, parent in self._foreign_keys.get(table, {}).items():
+            if col not in columns:
+                continue
+            col_idx = columns.index(col)
+            known = self._known_ids[parent]
+
+            unknown = list({int(r[col_idx]) for r in rows if r[col_idx] is not None} - known)
+            if unknown:
+                with self._conn.cursor() as cur, self.metrics.timed('lookup', parent):
+                    parent_pk = self._tables_pk[parent]
+                    cur.execute(
+                        f'SELECT k FROM unnest(%s::integer[]) k JOIN {parent} ON {parent_pk} = k;',
+                        (unknown,)
+                    )
+                    known.update(r[0] for r in cur.fetchall())
+
+            for i, r in enumerate(rows):
+                if i not in failed and r[col_idx] is not None and int(r[col_idx]) not in known:
+                    failed.add(i)
+                    self.table_stats[table].add_error(psycopg2.errors.ForeignKeyViolation(
+                        f'insert or update on table "{table}" violates foreign key constraint on "{col}"'
+                    ))
+
+        return failed
+
+
+    def _copy(self, table, columns, rows, lines=None):
+        # returns the rows that were written
+        if lines is None:
+            failed = self._missing_keys(table, columns, rows)
+            if failed:
+                rows = [r for i, r in enumerate(rows) if i not in failed]
+            lines = [_copy_line(r) for r in rows]
+        cols_q = f' ({",".join(columns)})' if columns else ''
+
+        written = []
+        while rows:
+            with self._conn.cursor() as cur, self.metrics.timed('copy', table):
+                try:
+                    cur.copy_expert(f'COPY {table}{cols_q} FROM STDIN;', io.StringIO(''.join(lines)))
+                except Exception as ex:
+                    error = ex
+                else:
+                    self.table_stats[table].add_ok(len(rows))
+                    self.table_stats[table].add_commit()
+                    return written + rows
+
+            if len(rows) == 1:
+                self.table_stats[table].add_error(error)
+                return written
+
+            i = self._failed_line(error, len(rows))
+            if i is None:
+                # no idea which row it was, split the batch until we find out
+                half = len(rows) // 2
+                return (written +
+                    self._copy(table, columns, rows[:half], lines[:half]) +
+                    self._copy(table, columns, rows[half:], lines[half:]))
+
+            # the COPY stopped at the bad row, the ones before it went in
+            # fine. Write them on their own and carry on after it
+            self.table_stats[table].add_error(error)
+            written += self._copy(table, columns, rows[:i], lines[:i])
+            rows, lines = rows[i+1:], lines[i+1:]
+
+        return written
+
+
+    def _written(self, table, columns, rows):
+        # register the rows that made it into the DB, so that lookups
+        # don't have to go to the server
+        pk = self._tables_pk[table]
+        if ',' in pk:
+            return
+
+        pk_idx = columns.index(pk)
+        self._known_ids[table].update(r[pk_idx] for r in rows)
+
+        if table in self.keys.key_columns:
+            key_idx = columns.index(self.keys.key_columns[table][0])
+            for r in rows:
+                self.keys.add(table, r[key_idx], r[pk_idx])
+
+
+    def flush(self):
+        pending = sorted(
+            self._buffers.items(),
+            key=lambda kv: self._copy_order.index(kv[0][0])
+        )
+        self._buffers.clear()
+        self._buffered = 0
+        self._pending_planes.clear()
+
+        for (table, columns), rows in pending:
+            if table == 'route_plane':
+                # don't try to attach planes to routes that weren't written
+                failed = self._failed_ids['routes']
+                rows = [r for r in rows if r[0] not in failed]
+                if not rows:
+                    continue
+
+            written = self._copy(table, columns, rows)
+            pk = self._tables_pk[table]
+            if len(written) != len(rows) and ',' not in pk:
+                pk_idx = columns.index(pk)
+                ok = {r[pk_idx] for r in written}
+                self._failed_ids[table].update(r[pk_idx] for r in rows if r[pk_idx] not in ok)
+
+            self._written(table, columns, written)
+
+        self._sync_sequences()
+
+
+    def _sync_sequences(self):
+        # IDs were set explicitly, so the identity sequences need to catch up
+        # for later INSERTs that rely on them
+        with self._conn.cursor() as cur:
+            for table in self._allocated:
+                pk = self._tables_pk[table]
+                cur.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', '{pk}'), max({pk})) FROM {table} HAVING max({pk}) IS NOT NULL;"
+                )
+        self._allocated.clear()
@@ -0,0 +1,274 @@
+import unittest
+from collections import defaultdict
+
+import psycopg2
+from psycopg2.extensions import (TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR,
+                                 TRANSACTION_STATUS_INTRANS)
+
+from db import CopyOpenflightsDB, OpenflightsDB, TableStats
+from metrics import Metrics
+
+
+def _db():
+    # the upsert queries don't need a connection
+    db = OpenflightsDB.__new__(OpenflightsDB)
+    db._tables_pk = {'countries': 'country_id', 'planes': 'plane_id', 'airports': 'airport_id',
+                     'route_plane': 'route_id,plane_id'}
+    return db
+
+
+class _Cursor:
+    def __init__(self, conn):
+        self._conn = conn
+        self.description = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        pass
+
+
+    def execute(self, q, values=()):
+        # psycopg2.ProgrammingError stands for values that can't be
+        # adapted, only the BEGIN of the transaction is sent then
+        info = self._conn.info
+        if q.startswith('ROLLBACK TO'):
+            assert info.transaction_status == TRANSACTION_STATUS_INERROR
+            info.transaction_status = TRANSACTION_STATUS_INTRANS
+            self._conn.queries.append((q, values))
+            return
+        if not self._conn.autocommit and info.transaction_status == TRANSACTION_STATUS_IDLE:
+            info.transaction_status = TRANSACTION_STATUS_INTRANS
+        try:
+            self._rows = self._conn.result(q, values)
+        except psycopg2.ProgrammingError:
+            raise
+        except Exception:
+            self._conn.queries.append((q, values))
+            if not self._conn.autocommit:
+                info.transaction_status = TRANSACTION_STATUS_INERROR
+            raise
+        self._conn.queries.append((q, values))
+        self.description = [()]
+
+
+    def fetchall(self):
+        return self._rows
+
+
+class _Info:
+    transaction_status = TRANSACTION_STATUS_IDLE
+
+
+class _Conn:
+    # result(q, values) returns the rows of a statement, or raises
+    def __init__(self, result, autocommit=False):
+        self.result = result
+        self.autocommit = autocommit
+        self.queries = []
+        self.commits = 0
+        self.info = _Info()
+
+
+    def cursor(self):
+        return _Cursor(self)
+
+
+    def commit(self):
+        self.commits += 1
+        self.info.transaction_status = TRANSACTION_STATUS_IDLE
+
+
+def _connected_db(result, batch_size=100):
+    db = _db()
+    db._conn = _Conn(result, autocommit=batch_size <= 1)
+    db._batch_size = batch_size
+    db._tx_rows = 0
+    db._tx_tables = set()
+    db._savepoint_q = '' if batch_size <= 1 else 'SAVEPOINT row; '
+    db.table_stats = defaultdict(TableStats)
+    db.metrics = Metrics()
+    db.validator = None
+    db.upsert = True
+    db._upsert_q = {}
+    db._upsert_rows = defaultdict(list)
+    db._upserted = defaultdict(set)
+    return db
+
+
+def _counts(stats):
+    return stats.insert_ok, stats.updated, stats.unchanged, dict(stats.insert_errors)
+
+
+class TestUpsert(unittest.TestCase):
+    def test_keys(self):
+        db = _db()
+        self.assertEqual(db._upsert_keys('countries', ('country_name', 'country_iso', 'country_dafif')),
+                         [('country_name',), ('country_iso',), ('country_dafif',)])
+        self.assertEqual(db._upsert_keys('planes', ('plane_name', 'plane_iata', 'plane_icao')),
+                         [('plane_iata',), ('plane_icao',)])
+        self.assertEqual(db._upsert_keys('airports', OpenflightsDB._columns['airports']), [('airport_id',)])
+        with self.assertRaises(ValueError):
+            db._upsert_keys('countries', ('country_id_missing',))
+
+
+    def test_query(self):
+        db = _db()
+        q = db._upsert_query('countries', ('country_name', 'country_iso'), '%s,%s', ('country_name',))
+        self.assertIn('ON CONFLICT (country_name) DO UPDATE SET country_iso = EXCLUDED.country_iso', q)
+        self.assertIn('WHERE ROW(countries.country_iso) IS DISTINCT FROM ROW(EXCLUDED.country_iso)', q)
+        self.assertIn('WHERE country_name = %s AND NOT EXISTS', q)
+
+        # point is compared as text
+        q = db._upsert_query('airports', OpenflightsDB._columns['airports'], '', ('airport_id',))
+        self.assertIn('airports.airport_geo_location::text', q)
+
+        q = db._upsert_query('route_plane', ('route_id', 'plane_id'), '%s,%s', ('route_id', 'plane_id'))
+        self.assertIn('ON CONFLICT (route_id,plane_id) DO NOTHING', q)
+        self.assertIn('RETURNING route_id,plane_id, xmax = 0 AS inserted', q)
+
+
+
+    def test_single_row(self):
+        # the rows without their PK go one by one, counted by what the
+        # query returned: inserted, updated (false) or unchanged (NULL)
+        returned = iter([[(1, True)], [(2, False)], [(3, None)]])
+        db = _connected_db(lambda q, values: next(returned))
+        columns = ('country_name', 'country_iso')
+        ids = [db._execute_upsert('countries', columns, '%s,%s', row, row)
+               for row in (('A', 'AA'), ('B', 'BB'), ('C', 'CC'))]
+        self.assertEqual(ids, [1, 2, 3])
+        self.assertEqual(_counts(db.table_stats['countries']), (1, 1, 1, {}))
+        self.assertEqual(len(db._conn.queries), 3)
+
+
+    def test_duplicate(self):
+        # a key that was upserted before in the same run fails like an
+        # insert would, on any of the keys of the row
+        db = _connected_db(lambda q, values: [(1, True)])
+        columns = ('country_name', 'country_iso')
+        self.assertEqual(db._execute_upsert('countries', columns, '%s,%s', ('A', 'AA'), ('A', 'AA')), 1)
+        self.assertIsNone(db._execute_upsert('countries', columns, '%s,%s', ('B', 'AA'), ('B', 'AA')))
+        self.assertIsNone(db._execute_upsert('countries', columns, '%s,%s', ('A', None), ('A', None)))
+        self.assertEqual(_counts(db.table_stats['countries']), (1, 0, 0, {'UniqueViolation': 2}))
+        self.assertEqual(len(db._conn.queries), 1)
+
+        # the same for rows that are sent together
+        db._execute_upsert('route_plane', ('route_id', 'plane_id'), '%s,%s', (1, 2), (1, 2))
+        self.assertIsNone(db._execute_upsert('route_plane', ('route_id', 'plane_id'), '%s,%s', (1, 2), (1, 2)))
+        self.assertEqual(db.table_stats['route_plane'].insert_errors['UniqueViolation'], 1)
+
+
+    def test_many(self):
+        # rows that have their PK are sent together on flush, only the
+        # rows inserted or updated are returned
+        db = _connected_db(lambda q, values: [(True,), (False,), (True,)])
+        columns = ('route_id', 'plane_id')
+        rows = [(1, 2), (1, 3), (2, 2), (3, 2), (3, 3)]
+        ids = [db._execute_upsert('route_plane', columns, '%s,%s', row, row) for row in rows]
+        self.assertEqual(ids, [1, 1, 2, 3, 3])
+        self.assertEqual(db._conn.queries, [])
+
+        db.flush()
+        (q, values), = db._conn.queries
+        self.assertIn('VALUES (%s,%s),(%s,%s),(%s,%s),(%s,%s),(%s,%s) ON CONFLICT', q)
+        self.assertEqual(values, [v for row in rows for v in row])
+        self.assertEqual(_counts(db.table_stats['route_plane']), (2, 1, 2, {}))
+        self.assertEqual(db._conn.commits, 1)
+        self.assertEqual(db.table_stats['route_plane'].commits, 1)
+
+
+    def test_many_page(self):
+        db = _connected_db(lambda q, values: [])
+        db._upsert_page = 2
+        for row in [(1, 2), (1, 3), (2, 2)]:
+            db._execute_upsert('route_plane', ('route_id', 'plane_id'), '%s,%s', row, row)
+        self.assertEqual(len(db._conn.queries), 1)
+        db.flush()
+        self.assertEqual(len(db._conn.queries), 2)
+        self.assertEqual(_counts(db.table_stats['route_plane']), (0, 0, 3, {}))
+
+
+    def test_many_failed(self):
+        # a bad row fails the INSERT of all of them, they're upserted one
+        # by one to find it
+        class ForeignKeyViolation(Exception):
+            pass
+
+        def result(q, values):
+            if 'WITH up' not in q or values[1] == 9:
+                raise ForeignKeyViolation()
+            return [(values[0], values[1], True)]
+
+        db = _connected_db(result)
+        columns = ('route_id', 'plane_id')
+        for row in [(1, 2), (1, 9), (2, 2)]:
+            db._execute_upsert('route_plane', columns, '%s,%s', row, row)
+        db.flush()
+        self.assertEqual(_counts(db.table_stats['route_plane']), (2, 0, 0, {'ForeignKeyViolation': 1}))
+        self.assertEqual([q for q, _ in db._conn.queries if q.startswith('ROLLBACK')],
+                         ['ROLLBACK TO SAVEPOINT row;'] * 2)
+        # the rows that failed can be upserted again, the others not
+        self.assertNotIn((columns, (1, 9)), db._upserted['route_plane'])
+        self.assertIn((columns, (1, 2)), db._upserted['route_plane'])
+
+
+
+
+    def test_copy(self):
+        # the copy engine buffers rows, it can't tell whether they're there
+        db = CopyOpenflightsDB.__new__(CopyOpenflightsDB)
+        db._tables_pk = {'countries': 'country_id'}
+        db.upsert = True
+        with self.assertRaises(ValueError):
+            db._insert('countries', (1, 'Papua New Guinea', 'PG', 'PP'))
+        with self.assertRaises(ValueError):
+            db._insert_kv('countries', {'country_name': 'Papua New Guinea'})
+
+
+class TestExecute(unittest.TestCase):
+    def test_failed(self):
+        # a row that fails in the DB is rolled back to its savepoint, the
+        # next one releases it and sets its own
+        def result(q, values):
+            if values == (2,):
+                raise psycopg2.errors.UniqueViolation()
+            return [(values[0],)]
+
+        db = _connected_db(result)
+        self.assertEqual([db._execute('planes', 'q', (i,)) for i in (1, 2, 3)], [[(1,)], None, [(3,)]])
+        self.assertEqual([q for q, _ in db._conn.queries], [
+            'SAVEPOINT row; q',
+            'RELEASE SAVEPOINT row; SAVEPOINT row; q',
+            'ROLLBACK TO SAVEPOINT row;',
+            'RELEASE SAVEPOINT row; SAVEPOINT row; q',
+        ])
+        self.assertEqual(db._tx_rows, 3)
+
+
+    def test_not_sent(self):
+        # a row that fails before it's sent has no savepoint to roll back
+        # to, and doesn't count as a row of the transaction
+        def result(q, values):
+            if values == (None,):
+                raise psycopg2.ProgrammingError("can't adapt type")
+            return [(values[0],)]
+
+        db = _connected_db(result)
+        self.assertIsNone(db._execute('planes', 'q', (None,)))
+        self.assertEqual(db._execute('planes', 'q', (1,)), [(1,)])
+        self.assertIsNone(db._execute('planes', 'q', (None,)))
+        self.assertEqual(db._execute('planes', 'q', (2,)), [(2,)])
+        self.assertEqual([q for q, _ in db._conn.queries], [
+            'SAVEPOINT row; q',
+            'RELEASE SAVEPOINT row; SAVEPOINT row; q',
+        ])
+        self.assertEqual(db._tx_rows, 2)
+        self.assertEqual(dict(db.table_stats['planes'].insert_errors), {'ProgrammingError': 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+from operator import attrgetter
+
+from schema import load_schema
+
+# Incremental loading: instead of inserting every row again, only the
+# rows that changed since the last run are applied to the DB.
+#
+# For every table the DB keeps a hash of the source files it was loaded
+# from and a hash per row, by the row's key (see OpenflightsDB.save_state).
+# If the files didn't change, the table is skipped without even reading
+# them. Otherwise the rows are diffed against the stored hashes: new keys
+# are inserted, rows whose hash changed updated and keys that are gone
+# deleted.
+#
+# Only rows that were applied are recorded, with the ID of their row in
+# the DB. Rows that failed (e.g. a route whose airport isn't there yet)
+# are new again on the next diff of their table. Rows whose ID is gone
+# from the DB are loaded again too, which is what happens to the rows
+# deleted by ON DELETE CASCADE. A table is diffed when its files changed,
+# or when rows of a table it references (see dependents) were applied or
+# deleted, which is what can make its failed rows work or delete rows of
+# it.
+#
+# If the DB has rows the state doesn't know of (e.g. it was loaded without
+# --incremental before), new rows update the row with their key if there
+# is one instead of inserting.
+
+# table -> key of a row, the same as the PKs and unique constraints in
+# schema/create.sql (cities and planes by the names the other rows use)
+row_keys = {
+    'countries': attrgetter('country_name'),
+    'cities': attrgetter('country_name', 'city_name'),
+    'airports': attrgetter('airport_id'),
+    'airlines': attrgetter('airline_id'),
+    'planes': attrgetter('plane_iata', 'plane_icao'),
+    'routes': attrgetter('airline_id', 'src_airport_id', 'dest_airport_id', 'route_codeshare', 'route_stops'),
+}
+
+# table -> name used by the OpenflightsDB insert_/update_/delete_ methods
+_entities = {
+    'countries': 'country',
+    'cities': 'city',
+    'airports': 'airport',
+    'airlines': 'airline',
+    'planes': 'plane',
+    'routes': 'route',
+}
+
+
+def dependents(schema, table):
+    # the tables of row_keys referencing table (schema.Table by name),
+    # directly or through other tables
+    found = set()
+    todo = [table]
+    while todo:
+        t = todo.pop()
+        for name, st in schema.items():
+            if name not in found and any(fk.ref_table == t for fk in st.foreign_keys):
+                found.add(name)
+                todo.append(name)
+    return {t for t in found if t in row_keys}
+
+
+def file_hash(fnames):
+    h = hashlib.sha256()
+    for fname in fnames:
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def row_hash(row):
+    # the repr of a dataclass has all its fields
+    return hashlib.blake2b(repr(row).encode(), digest_size=16).hexdigest()
+
+
+def _key_text(key):
+    return json.dumps(key)
+
+
+def diff(rows, key, stored):
+    # Returns (new rows, updated rows, deleted keys, row key -> hash of the
+    # new and updated rows) given the current rows and the stored row key ->
+    # hash. Rows with a key that was already seen are ignored, like the
+    # unique constraints would.
+    seen = set()
+    new, updated = [], []
+    hashes = {}
+    for r in rows:
+        k = _key_text(key(r))
+        if k in seen:
+            continue
+        seen.add(k)
+
+        h = row_hash(r)
+        old = stored.get(k)
+        if old == h:
+            continue
+
+        (new if old is None else updated).append(r)
+        hashes[k] = h
+
+    deleted = [k for k in stored if k not in seen]
+    return new, updated, deleted, hashes
+
+
+def load_delta(table, rows, fnames, db):
+    # Loads the rows returned by rows() into table, applying only what
+    # changed since the last run. fnames are the files the rows are read
+    # from. Works with any OpenflightsDB, db is flushed before the state
+    # is saved.
+    fh = file_hash(fnames)
+    if db.get_file_hash(table) == fh:
+        logging.info(f'{table}: source files unchanged, skipping')
+        return
+
+    stored = db.get_row_hashes(table)
+    ids = {k: i for k, (_, i) in stored.items() if i is not None}
+    existing = db.existing_ids(table, ids.values())
+    gone = [k for k, i in ids.items() if i not in existing]
+    if gone:
+        logging.info(f'{table}: {len(gone)} rows are gone from the DB, loading them again')
+    hashes = {k: h for k, (h, _) in stored.items() if k not in gone}
+    seed = db.count_rows(table) > len(existing)
+
+    key = row_keys[table]
+    new, updated, deleted, _ = diff(db.metrics.extract(rows()), key, hashes)
+    db.table_stats[table].add_unchanged(len(hashes) - len(updated) - len(deleted))
+    logging.info(f'{table}: {len(new)} new, {len(updated)} updated, {len(deleted)} deleted rows')
+
+    entity = _entities[table]
+    insert = getattr(db, f'insert_{entity}')
+    update = getattr(db, f'update_{entity}')
+    delete = getattr(db, f'delete_{entity}')
+
+    # deletes first, a new row might take the unique key of a deleted one
+    for k in deleted:
+        k_ = json.loads(k)
+        if isinstance(k_, list):
+            delete(*k_)
+        else:
+            delete(k_)
+
+    # row key -> (hash, ID) of the rows applied
+    applied = {}
+    for r in new:
+        # a row the state doesn't know of might be in the DB already
+        i = seed and _apply(update, r) or _apply(insert, r)
+        applied[_key_text(key(r))] = (row_hash(r), i)
+
+    for r in updated:
+        # rows that aren't in the DB anymore are inserted again
+        i = _apply(update, r) or _apply(insert, r)
+        applied[_key_text(key(r))] = (row_hash(r), i)
+
+    db.flush()
+    # buffering engines return the ID of a row before it's written
+    written = db.existing_ids(table, [i for _, i in applied.values() if i is not None])
+    changed = {k: (h, i) for k, (h, i) in applied.items() if i in written}
+    # rows that couldn't be deleted keep their state
+    remaining = db.existing_ids(table, [ids[k] for k in deleted if k in ids])
+    kept = [k for k in deleted if ids.get(k) in remaining]
+    removed = [k for k in deleted if k not in kept] + [k for k in gone if k not in changed]
+
+    if len(changed) < len(applied):
+        logging.info(f'{table}: {len(applied) - len(changed)} rows failed, they are tried again once the files '
+                     f'or the tables they reference change')
+    # deletes that failed are tried again on the next run
+    db.save_state(table, None if kept else fh, changed, removed)
+
+    if changed or len(deleted) > len(kept):
+        # failed rows of these might reference the new rows now, or rows
+        # of them were deleted by ON DELETE CASCADE
+        db.clear_file_hashes(dependents(load_schema(), table))
+
+
+def _apply(f, row):
+    # Returns the ID of the row, None if it failed. Route inserts raise on
+    # some bad rows, see load_routes
+    try:
+        return f(row)
+    except Exception as ex:
+        logging.debug(f'could not apply {row}: {ex}')
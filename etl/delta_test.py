@@ -0,0 +1,171 @@
+import os
+import tempfile
+import unittest
+from collections import defaultdict
+
+from db import TableStats
+from delta import _key_text, dependents, diff, load_delta, row_hash, row_keys
+from metrics import Metrics
+from model import CountryDat
+from schema import load_schema
+
+
+class _DB:
+    # the parts of OpenflightsDB load_delta uses, countries only. Countries
+    # with iso 'XX' fail to insert
+    def __init__(self):
+        self.countries = {}
+        self.next_id = 1
+        self.files = {}
+        self.rows = {}
+        self.cleared = set()
+        self.table_stats = defaultdict(TableStats)
+        self.metrics = Metrics()
+
+
+    def get_file_hash(self, table):
+        return self.files.get(table)
+
+
+    def get_row_hashes(self, table):
+        return dict(self.rows)
+
+
+    def clear_file_hashes(self, tables):
+        self.cleared.update(tables)
+
+
+    def existing_ids(self, table, ids):
+        return set(ids) & set(self.countries.values())
+
+
+    def count_rows(self, table):
+        return len(self.countries)
+
+
+    def save_state(self, table, file_hash, changed, deleted):
+        self.rows.update(changed)
+        for k in deleted:
+            del self.rows[k]
+        self.files[table] = file_hash
+
+
+    def insert_country(self, c):
+        if c.country_iso == 'XX' or c.country_name in self.countries:
+            return
+        self.countries[c.country_name] = self.next_id
+        self.next_id += 1
+        return self.countries[c.country_name]
+
+
+    def update_country(self, c):
+        return self.countries.get(c.country_name)
+
+
+    def delete_country(self, name):
+        return self.countries.pop(name, None)
+
+
+    def flush(self):
+        pass
+
+
+class TestDiff(unittest.TestCase):
+    def test_diff(self):
+        key = row_keys['countries']
+        old = [
+            CountryDat('Kept', 'KE', None),
+            CountryDat('Changed', 'CH', None),
+            CountryDat('Deleted', 'DE', None),
+        ]
+        stored = {_key_text(key(r)): row_hash(r) for r in old}
+
+        rows = [
+            CountryDat('Kept', 'KE', None),
+            CountryDat('Changed', 'CX', None),
+            CountryDat('New', 'NE', None),
+            # duplicate keys are ignored
+            CountryDat('New', 'N2', None),
+        ]
+        new, updated, deleted, hashes = diff(rows, key, stored)
+
+        self.assertEqual(new, [rows[2]])
+        self.assertEqual(updated, [rows[1]])
+        self.assertEqual(deleted, [_key_text('Deleted')])
+        self.assertEqual(hashes, {_key_text('Changed'): row_hash(rows[1]), _key_text('New'): row_hash(rows[2])})
+
+    def test_unchanged(self):
+        rows = [CountryDat('Kept', 'KE', None)]
+        stored = {_key_text('Kept'): row_hash(rows[0])}
+        self.assertEqual(diff(rows, row_keys['countries'], stored), ([], [], [], {}))
+
+
+
+class TestLoadDelta(unittest.TestCase):
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp()
+        os.close(fd)
+        self.db = _DB()
+
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+
+    def _load(self, *rows):
+        with open(self.fname, 'w') as f:
+            f.write(repr(rows))
+        load_delta('countries', lambda: iter(rows), [self.fname], self.db)
+
+
+    def test_failed_rows(self):
+        # only rows that applied are recorded, the file isn't considered
+        # loaded until they do
+        self._load(CountryDat('A', 'AA', None), CountryDat('B', 'XX', None))
+        self.assertEqual(set(self.db.rows), {_key_text('A')})
+        self.assertEqual(self.db.rows[_key_text('A')][1], self.db.countries['A'])
+
+        self._load(CountryDat('A', 'AA', None), CountryDat('B', 'BB', None))
+        self.assertEqual(set(self.db.countries), {'A', 'B'})
+        self.assertEqual(set(self.db.rows), {_key_text('A'), _key_text('B')})
+
+
+    def test_gone_rows(self):
+        # rows deleted in the DB (e.g. by ON DELETE CASCADE) are loaded again
+        rows = (CountryDat('A', 'AA', None), CountryDat('B', 'BB', None))
+        self._load(*rows)
+        del self.db.countries['A']
+        self.db.files.clear()
+        self._load(*rows)
+        self.assertEqual(set(self.db.countries), {'A', 'B'})
+        self.assertEqual(self.db.rows[_key_text('A')][1], self.db.countries['A'])
+
+
+    def test_seed(self):
+        # rows in the DB the state doesn't know of are updated, not inserted
+        self.db.countries['A'] = 7
+        self._load(CountryDat('A', 'AA', None))
+        self.assertEqual(self.db.rows[_key_text('A')][1], 7)
+        self.assertEqual(self.db.next_id, 1)
+
+
+    def test_deleted(self):
+        self._load(CountryDat('A', 'AA', None), CountryDat('B', 'BB', None))
+        self.db.cleared.clear()
+        self._load(CountryDat('B', 'BB', None))
+        self.assertEqual(set(self.db.countries), {'B'})
+        self.assertEqual(set(self.db.rows), {_key_text('B')})
+        # rows of these referenced the deleted country
+        self.assertEqual(self.db.cleared, {'cities', 'airlines', 'airports', 'routes'})
+
+
+class TestDependents(unittest.TestCase):
+    def test_dependents(self):
+        schema = load_schema()
+        self.assertEqual(dependents(schema, 'airports'), {'routes'})
+        self.assertEqual(dependents(schema, 'cities'), {'airports', 'routes'})
+        self.assertEqual(dependents(schema, 'routes'), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
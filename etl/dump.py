@@ -0,0 +1,207 @@
+import gzip
+import io
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import psycopg2
+
+from schema import dependency_order, load_schema
+
+# Dumps the loaded DB to a gzipped SQL file in the layout pg_dump uses, which
+# psql can load as is (zcat dump.sql.gz | psql openflights):
+#
+#   1. the tables, without any constraints but NOT NULL
+#   2. the rows of every table as a COPY, parents before children
+#   3. the identity sequences, set to the highest ID of their table
+#   4. the PKs and unique constraints, which build the indexes
+#   5. the FKs, added NOT VALID and validated afterwards
+#
+# Loading rows into tables without indexes and creating the indexes
+# afterwards is a lot cheaper than updating them row by row. restore does
+# the same as psql, but COPYs the tables and builds the indexes of
+# different tables in parallel, each on its own connection.
+
+_header = '''--
+-- openflights dump, written by etl/main.py dump
+--
+
+SET client_encoding = 'UTF8';
+SET standard_conforming_strings = on;
+SET client_min_messages = warning;
+'''
+
+
+def _connect(conn_args):
+    db_name, db_host, db_port, db_user, db_password = conn_args
+    return psycopg2.connect(
+        database=db_name,
+        host=db_host,
+        port=db_port,
+        user=db_user,
+        password=db_password
+    )
+
+
+def dump(conn_args, schema_file, out):
+    tables = load_schema(schema_file)
+    order = dependency_order(tables)
+
+    conn = _connect(conn_args)
+    # one snapshot for all tables, so that the FKs hold in the dump
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        with gzip.open(out, 'wt', encoding='utf-8') as f, conn.cursor() as cur:
+            f.write(_header)
+
+            for name in order:
+                columns = ',\n'.join(f'    {c.name} {c.definition}' for c in tables[name].columns)
+                f.write(f'\nCREATE TABLE {name} (\n{columns}\n);\n')
+
+            for name in order:
+                t0 = perf_counter()
+                cols = ', '.join(c.name for c in tables[name].columns)
+                f.write(f'\nCOPY {name} ({cols}) FROM stdin;\n')
+                cur.copy_expert(f'COPY {name} ({cols}) TO STDOUT;', f)
+                f.write('\\.\n')
+                logging.info(f'dumped {name} in {perf_counter() - t0:.2f}s')
+
+            f.write('\n')
+            for name in order:
+                for c in tables[name].columns:
+                    if c.identity:
+                        cur.execute(f'SELECT max({c.name}) FROM {name};')
+                        max_id = cur.fetchone()[0]
+                        is_called = 'true' if max_id else 'false'
+                        f.write(
+                            f"SELECT pg_catalog.setval(pg_get_serial_sequence('{name}', '{c.name}'), "
+                            f'{max_id or 1}, {is_called});\n'
+                        )
+
+            f.write('\n')
+            for name in order:
+                for c in tables[name].constraints:
+                    if c.kind != 'FOREIGN KEY':
+                        f.write(f'ALTER TABLE ONLY {name} ADD CONSTRAINT {c.name} {c.definition()};\n')
+
+            f.write('\n')
+            for name in order:
+                for c in tables[name].foreign_keys:
+                    f.write(f'ALTER TABLE ONLY {name} ADD CONSTRAINT {c.name} {c.definition()} NOT VALID;\n')
+            for name in order:
+                for c in tables[name].foreign_keys:
+                    f.write(f'ALTER TABLE ONLY {name} VALIDATE CONSTRAINT {c.name};\n')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+_copy = re.compile(r'COPY (\w+) ')
+_alter = re.compile(r'ALTER TABLE ONLY (\w+) ')
+
+
+def _statements(f):
+    # Reads a dump written by dump. Yields (statement, None) for statements
+    # and (COPY statement, data) for the rows of a table
+    stmt = []
+    lines = iter(f)
+    for l in lines:
+        if not stmt and (not l.strip() or l.startswith('--')):
+            continue
+        stmt.append(l)
+        if not l.rstrip().endswith(';'):
+            continue
+
+        s = ''.join(stmt)
+        stmt = []
+        if s.startswith('COPY ') and s.rstrip().endswith('FROM stdin;'):
+            data = io.StringIO()
+            for row in lines:
+                if row == '\\.\n':
+                    break
+                data.write(row)
+            data.seek(0)
+            yield s, data
+        else:
+            yield s, None
+
+
+def restore(conn_args, dump_file, jobs=4):
+    # Loads a dump written by dump into an empty DB. The rows of all tables
+    # are read into memory first, so that they can be COPYed in parallel
+    pre, copies, sequences, indexes, add_fks, validate_fks = [], [], [], [], [], []
+    with gzip.open(dump_file, 'rt', encoding='utf-8') as f:
+        for s, data in _statements(f):
+            if data is not None:
+                copies.append((_copy.match(s).group(1), s, data))
+            elif 'VALIDATE CONSTRAINT' in s:
+                validate_fks.append(s)
+            elif 'FOREIGN KEY' in s:
+                add_fks.append(s)
+            elif s.startswith('ALTER TABLE'):
+                indexes.append(s)
+            elif copies:
+                sequences.append(s)
+            else:
+                pre.append(s)
+
+    conn = _connect(conn_args)
+    conn.autocommit = True
+    t0 = perf_counter()
+    try:
+        with conn.cursor() as cur:
+            for s in pre:
+                cur.execute(s)
+
+        # the settings of the dump (e.g. the encoding) apply to every connection
+        settings = [s for s in pre if s.startswith('SET ')]
+
+        def _run(name, statements, copy_data=None):
+            c = _connect(conn_args)
+            c.autocommit = True
+            try:
+                t = perf_counter()
+                with c.cursor() as cur:
+                    for s in settings:
+                        cur.execute(s)
+                    for s in statements:
+                        if copy_data is not None:
+                            cur.copy_expert(s, copy_data)
+                        else:
+                            cur.execute(s)
+                logging.info(f'{name}: {perf_counter() - t:.2f}s')
+            finally:
+                c.close()
+
+        def _parallel(tasks):
+            with ThreadPoolExecutor(jobs) as pool:
+                for f in [pool.submit(_run, *t) for t in tasks]:
+                    f.result()
+
+        # tables have no constraints yet, so their order doesn't matter
+        _parallel([(f'COPY {name}', [s], data) for name, s, data in copies])
+
+        with conn.cursor() as cur:
+            for s in sequences:
+                cur.execute(s)
+
+        # the constraints of a table are added one after another, they all
+        # need an exclusive lock on it
+        by_table = {}
+        for s in indexes:
+            by_table.setdefault(_alter.match(s).group(1), []).append(s)
+        _parallel([(f'indexes of {name}', stmts) for name, stmts in by_table.items()])
+
+        # adding a FK NOT VALID only takes a moment, validating it scans
+        # the table, which doesn't block the other validations
+        with conn.cursor() as cur:
+            for s in add_fks:
+                cur.execute(s)
+        _parallel([(s.split()[-1].rstrip(';'), [s]) for s in validate_fks])
+
+        with conn.cursor() as cur:
+            cur.execute('ANALYZE;')
+    finally:
+        conn.close()
+    logging.info(f'restored {dump_file} in {perf_counter() - t0:.2f}s')
@@ -0,0 +1,278 @@
+import logging
+import os
+import threading
+from itertools import count
+from time import perf_counter
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from db import CopyOpenflightsDB
+from resolve import KeyResolver
+from validate import ConstraintError, _convert
+
+# Writes the normalized tables of schema/create.sql to Parquet or Arrow IPC
+# files instead of loading them into Postgres. The rows go through the same
+# extract, transform and key lookups as for the DB, and the constraints of
+# the schema are checked in memory, so the files hold the rows the DB would
+# and the TableStats count the failed ones the same way.
+#
+# Parquet files are compressed (zstd) with dictionary encoded columns,
+# Arrow IPC files are uncompressed so they can be memory mapped, e.g.
+# pyarrow.ipc.open_file(pyarrow.memory_map('routes.arrow')).
+
+# table -> columns in the order of schema/create.sql: (name, type, max
+# length of strings)
+_columns = {
+    'countries': (
+        ('country_id', 'int', None),
+        ('country_name', 'str', 40),
+        ('country_iso', 'str', 2),
+        ('country_dafif', 'str', 2),
+    ),
+    'planes': (
+        ('plane_id', 'int', None),
+        ('plane_name', 'str', 80),
+        ('plane_iata', 'str', 3),
+        ('plane_icao', 'str', 4),
+    ),
+    'cities': (
+        ('city_id', 'int', None),
+        ('city_name', 'str', 40),
+        ('country_id', 'int', None),
+        ('city_timezone_offset_utc', 'float', None),
+        ('city_daylight_saving', 'str', 1),
+        ('city_timezone', 'str', 40),
+    ),
+    'airlines': (
+        ('airline_id', 'int', None),
+        ('airline_name', 'str', 90),
+        ('airline_alias', 'str', 40),
+        ('airline_iata', 'str', 2),
+        ('airline_icao', 'str', 3),
+        ('airline_callsign', 'str', 40),
+        ('country_id', 'int', None),
+        ('airline_active', 'bool', None),
+    ),
+    'airports': (
+        ('airport_id', 'int', None),
+        ('airport_name', 'str', 80),
+        ('city_id', 'int', None),
+        ('airport_iata', 'str', 3),
+        ('airport_icao', 'str', 4),
+        ('airport_geo_location', 'point', None),
+        ('airport_altitude_ft', 'int', None),
+        ('type', 'str', 40),
+        ('source', 'str', 40),
+    ),
+    'routes': (
+        ('route_id', 'int', None),
+        ('airline_id', 'int', None),
+        ('src_airport_id', 'int', None),
+        ('dest_airport_id', 'int', None),
+        ('route_codeshare', 'bool', None),
+        ('route_stops', 'int', None),
+    ),
+    'route_plane': (
+        ('route_id', 'int', None),
+        ('plane_id', 'int', None),
+    ),
+}
+
+# PKs and unique constraints, in the order Postgres checks them
+_unique = {
+    'countries': (('country_id',), ('country_name',), ('country_iso',), ('country_dafif',)),
+    'planes': (('plane_id',), ('plane_iata',), ('plane_icao',)),
+    'cities': (('city_id',), ('city_name', 'country_id')),
+    'airlines': (('airline_id',), ('airline_name', 'airline_alias')),
+    'airports': (('airport_id',),),
+    'routes': (
+        ('route_id',),
+        ('airline_id', 'src_airport_id', 'dest_airport_id', 'route_codeshare', 'route_stops'),
+    ),
+    'route_plane': (('route_id', 'plane_id'),),
+}
+
+_arrow_types = {
+    'int': pa.int32(),
+    'float': pa.float64(),
+    'bool': pa.bool_(),
+    'str': pa.string(),
+    'point': pa.struct([('x', pa.float64()), ('y', pa.float64())]),
+}
+
+
+class _Table:
+    # the rows of one table that passed all constraints, written to path
+    # one record batch (Arrow) or row group (Parquet) at a time
+    def __init__(self, name, path, fmt, row_group_size):
+        self.name = name
+        self._columns = _columns[name]
+        self._names = [c[0] for c in self._columns]
+        self._schema = pa.schema([(c, _arrow_types[k]) for c, k, _ in self._columns])
+        self._row_group_size = row_group_size
+
+        self._unique = [[self._names.index(c) for c in u] for u in _unique[name]]
+        self._keys = [set() for _ in self._unique]
+
+        self._data = [[] for _ in self._columns]
+        # clones write to the same tables
+        self.lock = threading.Lock()
+        if fmt == 'parquet':
+            self._writer = pq.ParquetWriter(path, self._schema, compression='zstd', use_dictionary=True)
+        else:
+            self._sink = pa.OSFile(path, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, self._schema)
+
+
+    def add(self, columns, row, not_null, references):
+        # Checks row (values for columns, all of them if None) against the
+        # constraints and keeps it if it passes. Raises ConstraintError
+        # otherwise. references: column -> IDs the column may reference
+        values = dict(zip(columns or self._names, row))
+        r = [_convert(k, l, values.get(c)) for c, k, l in self._columns]
+
+        for c in not_null:
+            if r[self._names.index(c)] is None:
+                raise ConstraintError('NotNullViolation', f'null value in column "{c}" violates not-null constraint')
+
+        unique_keys = []
+        for idx, keys in zip(self._unique, self._keys):
+            k = tuple(r[i] for i in idx)
+            # NULLs are never equal
+            if None in k:
+                continue
+            if k in keys:
+                raise ConstraintError('UniqueViolation', f'duplicate key value {k} in {self.name}')
+            unique_keys.append((keys, k))
+
+        for c, ids in references.items():
+            v = r[self._names.index(c)]
+            if v is not None and v not in ids:
+                raise ConstraintError(
+                    'ForeignKeyViolation', f'insert or update on table "{self.name}" violates foreign key constraint on "{c}"'
+                )
+
+        for keys, k in unique_keys:
+            keys.add(k)
+        for d, v in zip(self._data, r):
+            d.append(v)
+        if len(self._data[0]) >= self._row_group_size:
+            self._write()
+
+
+    def _write(self):
+        if not self._data[0]:
+            return
+        arrays = []
+        for (c, k, _), d in zip(self._columns, self._data):
+            if k == 'point':
+                d = [None if v is None else {'x': v[0], 'y': v[1]} for v in d]
+            arrays.append(pa.array(d, _arrow_types[k]))
+        self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self._schema))
+        self._data = [[] for _ in self._columns]
+
+
+    def close(self):
+        self._write()
+        self._writer.close()
+        if hasattr(self, '_sink'):
+            self._sink.close()
+
+
+class ExportOpenflightsDB(CopyOpenflightsDB):
+    # Buffers rows like CopyOpenflightsDB, but every flush checks them and
+    # appends them to the files of their tables in out_dir, one file per
+    # table (<table>.parquet or <table>.arrow). IDs are allocated from 1.
+    # The files are complete once the instance is closed.
+    def __init__(self, out_dir, fmt='parquet', batch_size=10000, row_group_size=65536, keys=None, tables=None):
+        self._out_dir = out_dir
+        self._fmt = fmt
+        self._row_group_size = row_group_size
+        super().__init__(None, None, None, None, None, batch_size=batch_size, keys=keys)
+
+        if tables is None:
+            os.makedirs(out_dir, exist_ok=True)
+            ext = 'parquet' if fmt == 'parquet' else 'arrow'
+            tables = {
+                t: _Table(t, os.path.join(out_dir, f'{t}.{ext}'), fmt, row_group_size) for t in _columns
+            }
+        # table -> _Table, shared with clones
+        self._tables = tables
+
+
+    def _connect(self):
+        return None
+
+
+    def _load_keys(self):
+        return KeyResolver()
+
+
+    def clone(self):
+        c = self.__class__(
+            self._out_dir,
+            self._fmt,
+            batch_size=self._batch_size,
+            row_group_size=self._row_group_size,
+            keys=self.keys,
+            tables=self._tables
+        )
+        # the FKs of rows written by clones have to be known to all of them
+        c._known_ids = self._known_ids
+        c._next_id = self._next_id
+        c._next_id_lock = self._next_id_lock
+        c._parent = self
+        return c
+
+
+    def close(self):
+        # only the instance the clones were made from owns the files
+        if not self._parent:
+            for t in self._tables.values():
+                t.close()
+
+
+    def _allocate_id(self, table):
+        with self._next_id_lock:
+            if table not in self._next_id:
+                self._next_id[table] = count(1)
+            return next(self._next_id[table])
+
+
+    def _geo(self, airport):
+        if airport.latitude is not None and airport.longitude is not None:
+            return (airport.latitude, airport.longitude)
+
+
+    def _copy(self, table, columns, rows, lines=None):
+        # returns the rows that were written
+        t = self._tables[table]
+        not_null = self._not_null.get(table, ())
+        references = {c: self._known_ids[p] for c, p in self._foreign_keys.get(table, {}).items()}
+        stats = self.table_stats[table]
+
+        written = []
+        start = perf_counter()
+        with t.lock:
+            for r in rows:
+                try:
+                    t.add(columns, r, not_null, references)
+                except ConstraintError as ex:
+                    logging.debug(f'{table}: {ex}')
+                    stats.add_errors(ex.name)
+                else:
+                    written.append(r)
+        self.metrics.observe('write', table, perf_counter() - start)
+
+        stats.add_ok(len(written))
+        stats.add_commit()
+        return written
+
+
+    def _sync_sequences(self):
+        pass
+
+
+    def insert_routes_staged(self, routes):
+        raise ValueError('staged routes need a DB')
@@ -0,0 +1,81 @@
+import tempfile
+import unittest
+from os.path import join
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from export import ConstraintError, ExportOpenflightsDB, _convert
+from model import AirportDat, CityDat, CountryDat, PlaneDat, RouteDat
+
+
+class TestConvert(unittest.TestCase):
+    def test_convert(self):
+        self.assertEqual(_convert('int', None, '410'), 410)
+        self.assertEqual(_convert('bool', None, 'Y'), True)
+        self.assertEqual(_convert('str', 2, 'AB  '), 'AB')
+        self.assertIsNone(_convert('int', None, None))
+
+    def test_errors(self):
+        for kind, length, v, name in (
+            ('int', None, 'x', 'InvalidTextRepresentation'),
+            ('int', None, str(2**31), 'NumericValueOutOfRange'),
+            ('bool', None, 'maybe', 'InvalidTextRepresentation'),
+            ('str', 2, 'ABC', 'StringDataRightTruncation'),
+        ):
+            with self.subTest(v=v), self.assertRaises(ConstraintError) as cm:
+                _convert(kind, length, v)
+            self.assertEqual(cm.exception.name, name)
+
+
+class TestExport(unittest.TestCase):
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as d:
+            db = ExportOpenflightsDB(d, 'parquet')
+            db.insert_country(CountryDat('Papua New Guinea', 'PG', 'PP'))
+            db.insert_country(CountryDat('Papua New Guinea', 'PX', 'PX'))
+            db.flush()
+            db.insert_city(CityDat(None, None, 'Papua New Guinea', 'Goroka', 10.0, 'U', 'Port_Moresby'))
+            db.flush()
+            db.insert_airport(AirportDat(1, 'Goroka Airport', 'Goroka', 'Papua New Guinea', 'GKA', 'AYGA', -6.08, 145.39, 5282, 10.0, 'U', 'Port_Moresby', 'airport', 'OurAirports'))
+            db.insert_plane(PlaneDat('Canadair Regional Jet 200', 'CR2', 'CRJ2'))
+            db.flush()
+            db.insert_route(RouteDat('2B', None, '410', 'GKA', None, '1', 'GKA', None, '1', False, 0, ('CR2', 'XXX')))
+            # unknown airport
+            db.insert_route(RouteDat('2B', None, '410', 'GKA', None, '1', 'AER', None, '2965', False, 0, ()))
+            db.flush()
+            db.close()
+
+            self.assertEqual(dict(db.table_stats['countries'].insert_errors), {'UniqueViolation': 1})
+            self.assertEqual(dict(db.table_stats['routes'].insert_errors), {'ForeignKeyViolation': 1})
+
+            airports = pq.read_table(join(d, 'airports.parquet')).to_pylist()
+            self.assertEqual(airports[0]['city_id'], 1)
+            self.assertEqual(airports[0]['airport_geo_location'], {'x': -6.08, 'y': 145.39})
+
+            planes = pq.read_table(join(d, 'planes.parquet')).to_pylist()
+            self.assertEqual([p['plane_name'] for p in planes], ['Canadair Regional Jet 200', 'DUMMY'])
+            route_plane = pq.read_table(join(d, 'route_plane.parquet')).to_pylist()
+            self.assertEqual(route_plane, [{'route_id': 1, 'plane_id': 1}, {'route_id': 1, 'plane_id': 2}])
+
+    def test_arrow(self):
+        with tempfile.TemporaryDirectory() as d:
+            db = ExportOpenflightsDB(d, 'arrow')
+            db.insert_country(CountryDat('Papua New Guinea', 'PG', 'PP'))
+            db.flush()
+            db.close()
+
+            t = pa.ipc.open_file(pa.memory_map(join(d, 'countries.arrow'))).read_all()
+            self.assertEqual(t.to_pylist(), [{'country_id': 1, 'country_name': 'Papua New Guinea', 'country_iso': 'PG', 'country_dafif': 'PP'}])
+
+
+    def test_staged_routes(self):
+        with tempfile.TemporaryDirectory() as d:
+            db = ExportOpenflightsDB(d, 'parquet')
+            with self.assertRaises(ValueError):
+                db.insert_routes_staged([])
+            db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,26 +1,231 @@
 import csv
+import io
+import logging
+import mmap
+import os
+import pickle
 import re
-
+import sys
+import tempfile
+import threading
+import weakref
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import fields
+from itertools import islice
+from operator import attrgetter
+
+from columns import AirportColumns, RouteColumns
 from lineparser import LineParser
 from model import AirlineDat, AirportDat, CountryDat, PlaneDat, RouteDat
 from transform import convert_if_exists, translate_country
 
-
-def read_countries(fname):
-    lp = LineParser([
+# file name -> number of times it was opened
+open_counts = Counter()
+
+
+def _open(fname):
+    open_counts[fname] += 1
+    return open(fname)
+
+
+class SharedSource:
+    # Wraps a reader (e.g. partial(read_airports, fname)) so that the file is
+    # only read and parsed once, no matter how many loaders consume it.
+    #
+    # The first iteration streams the rows from the reader and keeps a copy,
+    # later ones replay that copy. Rows are kept as plain tuples, which take
+    # a lot less memory than the dataclasses. Past max_rows they're spilled
+    # to a temporary file in chunks of max_rows rows.
+    def __init__(self, read, max_rows=500000):
+        self._read = read
+        self._max_rows = max_rows
+        self._lock = threading.Lock()
+
+        self._complete = False
+        self._type = None
+        self._rows = []
+        self._spill = None
+
+
+    def __call__(self):
+        if self._complete:
+            return self._replay()
+        return self._record()
+
+
+    def _record(self):
+        rows = []
+        spill = None
+        row_type = None
+        as_tuple = None
+        for r in self._read():
+            if not row_type:
+                row_type = type(r)
+                as_tuple = attrgetter(*(f.name for f in fields(row_type)))
+
+            rows.append(as_tuple(r))
+            if len(rows) >= self._max_rows:
+                if not spill:
+                    fd, spill = tempfile.mkstemp(prefix='openflights-')
+                    os.close(fd)
+                    weakref.finalize(self, os.remove, spill)
+                with open(spill, 'ab') as f:
+                    pickle.dump(rows, f, pickle.HIGHEST_PROTOCOL)
+                rows = []
+
+            yield r
+
+        # if another consumer got here first, its copy is just as good
+        with self._lock:
+            if not self._complete:
+                self._type, self._rows, self._spill = row_type, rows, spill
+                self._complete = True
+
+
+    def _replay(self):
+        if self._spill:
+            with open(self._spill, 'rb') as f:
+                while True:
+                    try:
+                        chunk = pickle.load(f)
+                    except EOFError:
+                        break
+                    for t in chunk:
+                        yield self._type(*t)
+
+        for t in self._rows:
+            yield self._type(*t)
+
+
+def _intern(s):
+    # strings that repeat a lot (countries, cities, codes) are interned, so
+    # all rows share one copy instead of holding one each
+    return sys.intern(s) if s is not None else None
+
+
+def log_open_counts():
+    for fname, n in sorted(open_counts.items()):
+        logging.info(f'{fname} was opened {n} time(s)')
+
+
+def _read(parse, fname, parser):
+    with _open(fname) as f:
+        yield from parse(f, parser)
+
+
+def _chunks(fname, chunk_size):
+    # (start, end) byte offsets of the chunks of fname, about chunk_size
+    # bytes each. Every chunk ends after a newline (or at the end of the
+    # file), so no line is split
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            chunks = []
+            start = 0
+            while start < size:
+                end = mm.find(b'\n', min(start + chunk_size, size) - 1)
+                end = size if end < 0 else end + 1
+                chunks.append((start, end))
+                start = end
+    return chunks
+
+
+def _values(*v):
+    return v
+
+
+def _parse_chunk(parse, fname, start, end, parser):
+    # Runs in the worker processes. Rows are sent back as plain tuples,
+    # which are a lot cheaper to pickle than the dataclasses
+    with open(fname, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # decoded with universal newlines, like _open does
+        lines = io.TextIOWrapper(io.BytesIO(mm[start:end]))
+        return list(parse(lines, parser, row=_values))
+
+
+def _sharing(row_type, shared):
+    # Strings and tuples are pickled chunk by chunk, so rows from different
+    # chunks don't share the ones the parse function shares (_intern, the
+    # equipment tuples of _parse_routes). Returns a function that shares
+    # the fields named in shared again, through a dict of the values seen
+    # so far (strings interned, tuples of interned strings)
+    idx = [i for i, f in enumerate(fields(row_type)) if f.name in shared]
+    seen = {None: None}
+
+    def _share(t):
+        t = list(t)
+        for i in idx:
+            v = t[i]
+            s = seen.get(v)
+            if s is None and v is not None:
+                s = seen[v] = tuple(map(_intern, v)) if type(v) is tuple else sys.intern(v)
+            t[i] = s
+        return t
+
+    return _share
+
+
+def read_parallel(parse, row_type, fname, parser=LineParser, workers=None, chunk_size=1 << 20, ordered=True,
+                  shared=()):
+    # Parses fname with parse (e.g. _parse_routes, which yields row_type
+    # rows) in a pool of workers processes (default: one per core). The
+    # file is mmapped and split at newlines into chunks of about chunk_size
+    # bytes, every worker parses one chunk at a time.
+    #
+    # Rows are yielded in the order of the file, or with ordered=False
+    # chunk by chunk as they're done. At most two chunks per worker are
+    # parsed ahead of the consumer, so memory stays bounded for files of
+    # any size.
+    #
+    # shared: the fields of row_type parse shares between rows, see
+    # _sharing
+    open_counts[fname] += 1
+    workers = workers or os.cpu_count()
+    chunks = iter(_chunks(fname, chunk_size))
+    pool = ProcessPoolExecutor(workers)
+    pending = []
+    share = _sharing(row_type, shared)
+
+    def _submit():
+        for start, end in islice(chunks, 2 * workers - len(pending)):
+            pending.append(pool.submit(_parse_chunk, parse, fname, start, end, parser))
+
+    try:
+        _submit()
+        while pending:
+            if ordered:
+                done = pending.pop(0)
+            else:
+                done = next(iter(wait(pending, return_when=FIRST_COMPLETED).done))
+                pending.remove(done)
+            rows = done.result()
+            # keep the workers busy while the rows are consumed
+            _submit()
+            for t in rows:
+                yield row_type(*share(t))
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def read_countries(fname, parser=LineParser):
+    lp = parser([
         'q',    # name
         'q',    # iso
         'q',    # dafif_code
     ])
-    with open(fname) as f:
-        for l in f:
-            v = lp.parse(l)
-
+    with _open(fname) as f:
+        for v in lp.parse_lines(f):
             yield CountryDat(*v)
 
 
-def read_airports(fname):
-    lp = LineParser([
+_leading_quotes = re.compile(r'""([^,])')
+_trailing_quotes = re.compile(r'([^,])""')
+
+def _parse_airports(lines, parser, row=AirportDat):
+    lp = parser([
         'nq',   # id
         'q',    # name
         'q',    # city
@@ -36,35 +241,55 @@ def read_airports(fname):
         'q',    # type
         'q'     # source
     ])
-    with open(fname) as f:
+
+    def _lines(f):
         for l in f:
             # replace double double-quotes with a single '
             # it's like that in the source file but it would
             # be a bit of a hassle to adapt LineParser to handle
             # this case correctly. So I won't
-            leading_quotes_converted = re.sub(r'""([^,])', r"'\1", l)
-            l = re.sub(r'([^,])""', r"\1'", leading_quotes_converted)
-
-            v = lp.parse(l)
-            ai = convert_if_exists(v[0], int)
-            an = v[1]
-            cy = v[2]
-            ct = v[3]
-            iata = v[4]
-            icao = v[5]
-            lat = convert_if_exists(v[6], float)
-            lon = convert_if_exists(v[7], float)
-            alt = convert_if_exists(v[8], int)
-            tzo = convert_if_exists(v[9], float)
-            dst = v[10]
-            tzn = v[11]
-            tp = v[12]
-            src = v[13]
-
-            yield AirportDat(ai, an, cy, ct, iata, icao, lat, lon, alt, tzo, dst, tzn, tp, src)
-
-
-def read_airlines(fname):
+            if '""' in l:
+                l = _trailing_quotes.sub(r"\1'", _leading_quotes.sub(r"'\1", l))
+            yield l
+
+    # CsvLineParser handles them and returns the names as they are
+    for v in lp.parse_lines(lines if lp.doubled_quotes else _lines(lines)):
+        ai = convert_if_exists(v[0], int)
+        an = v[1]
+        cy = _intern(v[2])
+        ct = _intern(v[3])
+        iata = v[4]
+        icao = v[5]
+        lat = convert_if_exists(v[6], float)
+        lon = convert_if_exists(v[7], float)
+        alt = convert_if_exists(v[8], int)
+        tzo = convert_if_exists(v[9], float)
+        dst = _intern(v[10])
+        tzn = _intern(v[11])
+        tp = _intern(v[12])
+        src = _intern(v[13])
+
+        yield row(ai, an, cy, ct, iata, icao, lat, lon, alt, tzo, dst, tzn, tp, src)
+
+
+# the fields _parse_airports interns
+_airport_shared = ('city', 'country', 'daylight_saving', 'timezone', 'type', 'source')
+
+def read_airports(fname, parser=LineParser, workers=0, ordered=True):
+    # with workers, the file is parsed by that many processes (see
+    # read_parallel)
+    if workers:
+        return read_parallel(_parse_airports, AirportDat, fname, parser, workers, ordered=ordered,
+                             shared=_airport_shared)
+    return _read(_parse_airports, fname, parser)
+
+
+def read_airports_columns(fname, parser=LineParser, workers=0):
+    # Same rows as read_airports, as AirportColumns
+    return AirportColumns(read_airports(fname, parser, workers))
+
+
+def read_airlines(fname, parser=LineParser):
     def _sanitize(s):
         # remove some uglyness from source data, replacing with None
         nones = ('N/A', '-', '', r"\\'", r"\\'\\")
@@ -73,7 +298,7 @@ def read_airlines(fname):
         return s
 
 
-    lp = LineParser([
+    lp = parser([
         'nq',   # id
         'q',    # name
         'q',    # alias
@@ -84,15 +309,15 @@ def read_airlines(fname):
         'q',    # active
     ])
     
-    with open(fname) as f:
-        for l in f:
-            v = [_sanitize(v) for v in lp.parse(l)]
+    with _open(fname) as f:
+        for v in lp.parse_lines(f):
+            v = [_sanitize(e) for e in v]
             if v[0] == '-1':
                 # skip the "Unknown" airline
                 continue
 
             v[0] = int(v[0])
-            v[6] = translate_country(v[6])
+            v[6] = _intern(translate_country(v[6]))
 
             yield AirlineDat(*v)
 
@@ -112,7 +337,7 @@ def read_planes_csv(fname):
         return s
 
 
-    with open(fname) as f:
+    with _open(fname) as f:
         reader = csv.reader(f)
         # discard header
         _ = next(reader)
@@ -123,16 +348,15 @@ def read_planes_csv(fname):
             yield PlaneDat(rs[2],rs[0], rs[1]) 
 
 
-def read_planes(fname):
-    lp = LineParser([
+def read_planes(fname, parser=LineParser):
+    lp = parser([
         'q',    # name
         'q',    # iata
         'q',    # icao
     ])
     
-    with open(fname) as f:
-        for l in f:
-            v = lp.parse(l)
+    with _open(fname) as f:
+        for v in lp.parse_lines(f):
             yield PlaneDat(*v)
 
 
@@ -147,16 +371,22 @@ def read_planes(fname):
         yield PlaneDat(name, iata, None)
 
 
-def read_routes(fname):
+def _parse_routes(lines, parser, row=RouteDat):
     def _airline_iata_icao(s):
+        s = _intern(s)
         return (s,None) if len(s) == 2 else (None, s)
 
     def _airport_iata_icao(s):
+        s = _intern(s)
         return (s,None) if len(s) == 3 else (None, s)
 
+    # equipment column -> tuple of plane codes. There are only a couple of
+    # hundred distinct ones, so routes share the tuples
+    equipment = {None: ()}
 
 
-    lp = LineParser([
+
+    lp = parser([
         'nq',    # airline icao
         'nq',    # airline id (openflights)
         'nq',    # source airport, iata (3) or icao (4)
@@ -168,30 +398,52 @@ def read_routes(fname):
         'nq'    # equipment
     ])
 
-    with open(fname) as f:
-        for l in f:
-            v = lp.parse(l)
-            al_iata, al_icao = _airline_iata_icao(v[0])
-            al_id = v[1]
-            src_ap_iata, src_ap_icao = _airport_iata_icao(v[2])
-            src_ap_id = v[3]
-            dest_ap_iata, dest_ap_icao = _airport_iata_icao(v[4])
-            dest_ap_id = v[5]
-            cs = True if v[6] else False
-            st = convert_if_exists(v[7], int)
-            eq = v[8].split(' ') if v[8] else []
-
-            yield RouteDat(
-                al_iata,
-                al_icao,
-                al_id,
-                src_ap_iata,
-                src_ap_icao,
-                src_ap_id,
-                dest_ap_iata,
-                dest_ap_icao,
-                dest_ap_id,
-                cs,
-                st,
-                eq
-            )
+    for v in lp.parse_lines(lines):
+        al_iata, al_icao = _airline_iata_icao(v[0])
+        al_id = _intern(v[1])
+        src_ap_iata, src_ap_icao = _airport_iata_icao(v[2])
+        src_ap_id = _intern(v[3])
+        dest_ap_iata, dest_ap_icao = _airport_iata_icao(v[4])
+        dest_ap_id = _intern(v[5])
+        cs = True if v[6] else False
+        st = convert_if_exists(v[7], int)
+        eq = equipment.get(v[8])
+        if eq is None:
+            eq = equipment[v[8]] = tuple(_intern(p) for p in v[8].split(' '))
+
+        yield row(
+            al_iata,
+            al_icao,
+            al_id,
+            src_ap_iata,
+            src_ap_icao,
+            src_ap_id,
+            dest_ap_iata,
+            dest_ap_icao,
+            dest_ap_id,
+            cs,
+            st,
+            eq
+        )
+
+
+# the fields _parse_routes interns or shares
+_route_shared = (
+    'airline_iata', 'airline_icao', 'airline_id',
+    'src_airport_iata', 'src_airport_icao', 'src_airport_id',
+    'dest_airport_iata', 'dest_airport_icao', 'dest_airport_id',
+    'route_equipment_iata',
+)
+
+def read_routes(fname, parser=LineParser, workers=0, ordered=True):
+    # with workers, the file is parsed by that many processes (see
+    # read_parallel)
+    if workers:
+        return read_parallel(_parse_routes, RouteDat, fname, parser, workers, ordered=ordered,
+                             shared=_route_shared)
+    return _read(_parse_routes, fname, parser)
+
+
+def read_routes_columns(fname, parser=LineParser, workers=0):
+    # Same rows as read_routes, as RouteColumns
+    return RouteColumns(read_routes(fname, parser, workers))
@@ -0,0 +1,111 @@
+import os
+import tarfile
+import tempfile
+import unittest
+from os.path import dirname, isfile, join
+
+from extract import (_chunks, _parse_airports, _parse_routes, _route_shared,
+                     read_airports, read_parallel, read_routes)
+from lineparser import CsvLineParser, LineParser
+from model import AirportDat, RouteDat
+
+airports = '''1,"Goroka Airport","Goroka","Papua New Guinea","GKA","AYGA",-6.081689834590001,145.391998291,5282,10,"U","Pacific/Port_Moresby","airport","OurAirports"
+2,"Madang Airport","Madang","Papua New Guinea","MAG","AYMD",-5.20707988739,145.789001465,20,10,"U","Pacific/Port_Moresby","airport","OurAirports"
+3,"Mount ""Hagen"" Kagamuga Airport","Mount Hagen","Papua New Guinea","HGU","AYMH",-5.826789855957031,144.29600524902344,5388,10,"U","Pacific/Port_Moresby","airport","OurAirports"
+4,"Nadzab Airport","Nadzab","Papua New Guinea","LAE","AYNZ",-6.569803,146.725977,239,10,"U","Pacific/Port_Moresby","airport","OurAirports"
+'''
+
+routes = '''2B,410,AER,2965,KZN,2990,,0,CR2
+2B,410,ASF,2966,KZN,2990,,0,CR2 320
+AAL,\\N,ASF,\\N,UUEE,4029,Y,1,
+2B,410,CEK,2968,KZN,2990,,0,CR2
+'''
+
+data_tar = join(dirname(__file__), '..', 'data', 'data.tar.gz')
+
+
+class TestReadParallel(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.files = {}
+        for name, content in (('airports.dat', airports), ('routes.dat', routes)):
+            self.files[name] = join(self.dir.name, name)
+            with open(self.files[name], 'w') as f:
+                # more lines than chunks, even with tiny chunks
+                f.write(content * 50)
+
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+
+    def test_chunks(self):
+        fname = self.files['routes.dat']
+        size = os.path.getsize(fname)
+        with open(fname, 'rb') as f:
+            data = f.read()
+        for chunk_size in (1, 10, 100, size, size * 2):
+            with self.subTest(chunk_size=chunk_size):
+                chunks = _chunks(fname, chunk_size)
+                self.assertEqual(chunks[0][0], 0)
+                self.assertEqual(chunks[-1][1], size)
+                for (_, end), (start, _) in zip(chunks, chunks[1:]):
+                    self.assertEqual(end, start)
+                    self.assertEqual(data[end - 1:end], b'\n')
+
+
+    def test_empty(self):
+        fname = join(self.dir.name, 'empty.dat')
+        open(fname, 'w').close()
+        self.assertEqual(list(read_parallel(_parse_routes, RouteDat, fname, workers=2)), [])
+
+
+    def test_same_rows(self):
+        for read, parse, row_type, name in (
+            (read_airports, _parse_airports, AirportDat, 'airports.dat'),
+            (read_routes, _parse_routes, RouteDat, 'routes.dat'),
+        ):
+            for parser in (LineParser, CsvLineParser):
+                with self.subTest(name=name, parser=parser.__name__):
+                    fname = self.files[name]
+                    want = list(read(fname, parser))
+                    got = list(read(fname, parser, workers=2))
+                    self.assertEqual(got, want)
+                    got = list(read_parallel(parse, row_type, fname, parser, 2, chunk_size=100))
+                    self.assertEqual(got, want)
+
+
+    def test_shared(self):
+        # strings and equipment tuples are shared across chunks, like
+        # read_routes shares them without workers
+        fname = self.files['routes.dat']
+        rows = list(read_parallel(_parse_routes, RouteDat, fname, workers=2, chunk_size=100,
+                                  shared=_route_shared))
+        for f in ('src_airport_iata', 'dest_airport_id', 'route_equipment_iata'):
+            with self.subTest(f):
+                values = [getattr(r, f) for r in rows]
+                self.assertEqual(len({id(v) for v in values}), len(set(values)))
+        codes = [p for r in rows for p in r.route_equipment_iata]
+        self.assertEqual(len({id(p) for p in codes}), len(set(codes)))
+
+
+    def test_unordered(self):
+        fname = self.files['airports.dat']
+        want = list(read_airports(fname))
+        got = list(read_airports(fname, workers=2, ordered=False))
+        key = lambda ap: (ap.airport_id, ap.airport_name)
+        self.assertEqual(sorted(got, key=key), sorted(want, key=key))
+
+
+    @unittest.skipUnless(isfile(data_tar), 'data/data.tar.gz not found')
+    def test_dat_files(self):
+        with tarfile.open(data_tar) as tar:
+            tar.extractall(self.dir.name, members=[tar.getmember('airports.dat'), tar.getmember('routes.dat')])
+        for read, name in ((read_airports, 'airports.dat'), (read_routes, 'routes.dat')):
+            with self.subTest(name):
+                fname = join(self.dir.name, name)
+                self.assertEqual(list(read(fname, workers=2)), list(read(fname)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+import argparse
+import heapq
+import logging
+from array import array
+from collections import deque
+from math import asin, cos, inf, radians, sin, sqrt
+from os.path import join
+from time import perf_counter
+
+from extract import read_airports, read_routes
+
+# The routes as a directed graph of airports, for path queries that take
+# ages as recursive SQL over routes. Airports are numbered 0..n-1 and the
+# edges are kept in CSR form (like ListColumn keeps lists): the edges of
+# airport i are offsets[i]:offsets[i + 1] of targets (index of the
+# destination), airlines (airline ID, -1 if unknown) and distances (great
+# circle distance in km, inf if an airport has no location). Routes flown
+# by several airlines are one edge per airline.
+#
+# python3 etl/graph.py --data-dir ./data/ stops GKA LHR --max-stops 3
+# python3 etl/graph.py --data-dir ./data/ distance GKA LHR
+# python3 etl/graph.py --data-dir ./data/ reach GKA --hops 2
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # great circle distance in km
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(a))
+
+
+def _int(v):
+    return int(v) if v is not None else None
+
+
+class RouteGraph:
+    def __init__(self, airports, edges):
+        # airports: (airport ID, code, latitude, longitude), edges: (source
+        # airport ID, destination airport ID, airline ID). Edges between
+        # unknown airports are left out
+        self.ids = array('i')
+        # IATA code, or ICAO if there is none
+        self.codes = []
+        self.index = {}
+        locations = []
+        for airport_id, code, lat, lon in airports:
+            if airport_id is None or airport_id in self.index:
+                continue
+            self.index[airport_id] = len(self.ids)
+            self.ids.append(airport_id)
+            self.codes.append(code)
+            locations.append((lat, lon) if lat is not None and lon is not None else None)
+        self._by_code = {c: i for i, c in reversed(list(enumerate(self.codes))) if c}
+
+        # counting sort of the edges by source
+        index = self.index
+        resolved = [
+            (index[s], index[d], -1 if a is None else a)
+            for s, d, a in edges if s in index and d in index
+        ]
+        n = len(self.ids)
+        self.offsets = array('i', bytes(4 * (n + 1)))
+        for s, _, _ in resolved:
+            self.offsets[s + 1] += 1
+        for i in range(n):
+            self.offsets[i + 1] += self.offsets[i]
+
+        pos = array('i', self.offsets[:-1])
+        self.targets = array('i', bytes(4 * len(resolved)))
+        self.airlines = array('i', bytes(4 * len(resolved)))
+        self.distances = array('d', bytes(8 * len(resolved)))
+        for s, d, a in resolved:
+            e = pos[s]
+            pos[s] += 1
+            self.targets[e] = d
+            self.airlines[e] = a
+            ls, ld = locations[s], locations[d]
+            self.distances[e] = haversine(*ls, *ld) if ls and ld else inf
+
+
+    @classmethod
+    def from_files(cls, data_dir, parser=None):
+        kw = {'parser': parser} if parser else {}
+        airports = (
+            (ap.airport_id, ap.airport_iata or ap.airport_icao, ap.latitude, ap.longitude)
+            for ap in read_airports(join(data_dir, 'airports.dat'), **kw)
+        )
+        edges = (
+            (_int(r.src_airport_id), _int(r.dest_airport_id), _int(r.airline_id))
+            for r in read_routes(join(data_dir, 'routes.dat'), **kw)
+        )
+        return cls(airports, edges)
+
+
+    @classmethod
+    def from_db(cls, conn):
+        # airport_geo_location is (latitude, longitude)
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT airport_id, rtrim(coalesce(airport_iata, airport_icao)), '
+                'airport_geo_location[0], airport_geo_location[1] FROM airports ORDER BY airport_id;'
+            )
+            airports = cur.fetchall()
+            cur.execute('SELECT src_airport_id, dest_airport_id, airline_id FROM routes ORDER BY route_id;')
+            edges = cur.fetchall()
+        return cls(airports, edges)
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def airport(self, key):
+        # index of an airport by ID or code, KeyError if there's no such airport
+        if isinstance(key, int):
+            return self.index[key]
+        if key.isdigit():
+            return self.index[int(key)]
+        return self._by_code[key.upper()]
+
+
+    def _edges(self, i, airlines):
+        # (target, distance) of the edges leaving i
+        targets, distances = self.targets, self.distances
+        r = range(self.offsets[i], self.offsets[i + 1])
+        if airlines is None:
+            return ((targets[e], distances[e]) for e in r)
+        return ((targets[e], distances[e]) for e in r if self.airlines[e] in airlines)
+
+
+    def _path(self, prev, dest):
+        path = [dest]
+        while prev[path[-1]] >= 0:
+            path.append(prev[path[-1]])
+        return [self.ids[i] for i in reversed(path)]
+
+
+    def fewest_stops(self, src, dest, max_stops=None, airlines=None):
+        # BFS. Returns the airport IDs of a path from src to dest with as
+        # few stops as possible (at most max_stops), or None
+        s, d = self.airport(src), self.airport(dest)
+        if s == d:
+            return [self.ids[s]]
+        prev = array('i', [-1]) * len(self)
+        hops = {s: 0}
+        queue = deque([s])
+        while queue:
+            i = queue.popleft()
+            if max_stops is not None and hops[i] > max_stops:
+                # the flights from here would need another stop
+                continue
+            for t, _ in self._edges(i, airlines):
+                if t not in hops:
+                    hops[t] = hops[i] + 1
+                    prev[t] = i
+                    # every airport is reached with the fewest flights first
+                    if t == d:
+                        return self._path(prev, d)
+                    queue.append(t)
+        return None
+
+
+    def shortest(self, src, dest, airlines=None):
+        # Dijkstra. Returns (km, airport IDs of the path) for the shortest
+        # path by distance flown, or (inf, None)
+        s, d = self.airport(src), self.airport(dest)
+        dist = array('d', [inf]) * len(self)
+        prev = array('i', [-1]) * len(self)
+        dist[s] = 0.0
+        heap = [(0.0, s)]
+        while heap:
+            km, i = heapq.heappop(heap)
+            if i == d:
+                return km, self._path(prev, d)
+            if km > dist[i]:
+                continue
+            for t, w in self._edges(i, airlines):
+                nd = km + w
+                if nd < dist[t]:
+                    dist[t] = nd
+                    prev[t] = i
+                    heapq.heappush(heap, (nd, t))
+        return inf, None
+
+
+    def reachable(self, src, hops, airlines=None):
+        # airport ID -> number of flights for every airport that can be
+        # reached from src with at most hops flights
+        s = self.airport(src)
+        seen = {s: 0}
+        frontier = [s]
+        for h in range(1, hops + 1):
+            nxt = []
+            for i in frontier:
+                for t, _ in self._edges(i, airlines):
+                    if t not in seen:
+                        seen[t] = h
+                        nxt.append(t)
+            frontier = nxt
+        del seen[s]
+        return {self.ids[i]: h for i, h in seen.items()}
+
+
+def _format(graph, path):
+    return ' -> '.join(graph.codes[graph.index[a]] or str(a) for a in path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='path queries over the routes')
+    parser.add_argument('--data-dir', default='./data/')
+    parser.add_argument('--from-db', action='store_true',
+        help='read the airports and routes from the DB instead of --data-dir')
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-port', default='5432')
+    parser.add_argument('--db-name', default='openflights')
+    parser.add_argument('--db-user', default='postgres')
+    parser.add_argument('--db-password', default='1234')
+    parser.add_argument('--airline', type=int, action='append',
+        help='only use routes of this airline ID, can be given more than once')
+    commands = parser.add_subparsers(dest='command', required=True)
+    stops = commands.add_parser('stops', help='path with the fewest stops')
+    stops.add_argument('src')
+    stops.add_argument('dest')
+    stops.add_argument('--max-stops', type=int)
+    distance = commands.add_parser('distance', help='shortest path by distance flown')
+    distance.add_argument('src')
+    distance.add_argument('dest')
+    reach = commands.add_parser('reach', help='airports reachable within --hops flights')
+    reach.add_argument('src')
+    reach.add_argument('--hops', type=int, default=1)
+    args = parser.parse_args()
+
+    t = perf_counter()
+    if args.from_db:
+        import psycopg2
+        conn = psycopg2.connect(
+            database=args.db_name,
+            host=args.db_host,
+            port=args.db_port,
+            user=args.db_user,
+            password=args.db_password
+        )
+        try:
+            graph = RouteGraph.from_db(conn)
+        finally:
+            conn.close()
+    else:
+        graph = RouteGraph.from_files(args.data_dir)
+    logging.info(f'{len(graph)} airports, {len(graph.targets)} routes, built in {perf_counter() - t:.2f}s')
+
+    for code in (args.src, getattr(args, 'dest', None)):
+        try:
+            if code is not None:
+                graph.airport(code)
+        except KeyError:
+            parser.error(f'unknown airport: {code}')
+
+    airlines = set(args.airline) if args.airline else None
+    t = perf_counter()
+    if args.command == 'stops':
+        path = graph.fewest_stops(args.src, args.dest, args.max_stops, airlines)
+        print(f'{len(path) - 2} stop(s): {_format(graph, path)}' if path else 'no path')
+    elif args.command == 'distance':
+        km, path = graph.shortest(args.src, args.dest, airlines)
+        print(f'{km:.0f} km: {_format(graph, path)}' if path else 'no path')
+    else:
+        reached = graph.reachable(args.src, args.hops, airlines)
+        by_hops = {}
+        for a, h in reached.items():
+            by_hops.setdefault(h, []).append(graph.codes[graph.index[a]] or str(a))
+        for h, codes in sorted(by_hops.items()):
+            print(f'{h} flight(s): {len(codes)} airports: {" ".join(sorted(codes))}')
+    logging.info(f'query took {(perf_counter() - t) * 1000:.1f}ms')
@@ -0,0 +1,65 @@
+import unittest
+from math import inf
+
+from graph import RouteGraph, haversine
+
+airports = [
+    (1, 'AAA', 0.0, 0.0),
+    (2, 'BBB', 0.0, 10.0),
+    (3, 'CCC', 0.0, 20.0),
+    (4, 'DDD', 0.0, 30.0),
+    (5, 'EEE', None, None),
+]
+
+edges = [
+    (1, 4, 10),
+    (1, 2, 20),
+    (2, 3, 20),
+    (3, 4, 20),
+    (4, 5, 10),
+    # unknown airport
+    (1, 99, 10),
+]
+
+
+class TestRouteGraph(unittest.TestCase):
+    def setUp(self):
+        self.g = RouteGraph(airports, edges)
+
+    def test_csr(self):
+        self.assertEqual(len(self.g.targets), 5)
+        self.assertEqual(list(self.g.offsets), [0, 2, 3, 4, 5, 5])
+        self.assertEqual(self.g.distances[-1], inf)
+
+    def test_fewest_stops(self):
+        self.assertEqual(self.g.fewest_stops('AAA', 'DDD'), [1, 4])
+        self.assertEqual(self.g.fewest_stops(1, 3), [1, 2, 3])
+        self.assertIsNone(self.g.fewest_stops(1, 3, max_stops=0))
+        self.assertEqual(self.g.fewest_stops(1, 4, airlines={20}), [1, 2, 3, 4])
+        self.assertIsNone(self.g.fewest_stops('DDD', 'AAA'))
+
+    def test_shortest(self):
+        # the direct flight is as long as the one with stops
+        km, path = self.g.shortest('AAA', 'DDD')
+        self.assertAlmostEqual(km, haversine(0, 0, 0, 30))
+        self.assertEqual(path[0], 1)
+        self.assertEqual(self.g.shortest('EEE', 'AAA'), (inf, None))
+
+    def test_reachable(self):
+        self.assertEqual(self.g.reachable('AAA', 1), {4: 1, 2: 1})
+        self.assertEqual(self.g.reachable('AAA', 2), {4: 1, 2: 1, 3: 2, 5: 2})
+
+    def test_airport(self):
+        self.assertEqual(self.g.airport('bbb'), self.g.airport(2))
+        self.assertEqual(self.g.airport('2'), self.g.airport(2))
+        for key in ('XXX', '99', 99):
+            with self.assertRaises(KeyError):
+                self.g.airport(key)
+
+    def test_haversine(self):
+        # a degree of longitude at the equator
+        self.assertAlmostEqual(haversine(0, 0, 0, 1), 111.195, places=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
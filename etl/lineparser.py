@@ -1,6 +1,10 @@
+import csv
 import re
 
 class LineParser:
+    # LineParser can't handle doubled quotes ("") inside quoted strings
+    doubled_quotes = False
+
     def __init__(self, tokens):
         self._re = self._build_regex(tokens)
 
@@ -11,6 +15,10 @@ class LineParser:
 
         return [e if e != '' else None for e in m.groups()]
 
+    def parse_lines(self, lines):
+        for l in lines:
+            yield self.parse(l)
+
     def _build_regex(self, fmt):
         def _re_parts():
             for f in fmt:
@@ -25,3 +33,109 @@ class LineParser:
 
         return re.compile(','.join(_re_parts()))
 
+
+class OpenflightsDialect(csv.Dialect):
+    delimiter = ','
+    quotechar = '"'
+    doublequote = True
+    skipinitialspace = False
+    lineterminator = '\n'
+    quoting = csv.QUOTE_MINIMAL
+    strict = True
+
+
+class CsvLineParser:
+    # Drop-in replacement for LineParser that splits lines using str.split or,
+    # if there are quotes in the line, the csv module instead of a regex.
+    # It also handles doubled quotes ("") inside quoted strings.
+    #
+    # Like LineParser, \N and empty strings are returned as None, extra
+    # fields at the end of a line are ignored and 'q' fields have to be
+    # quoted (or \N), otherwise ValueError is raised.
+    #
+    # The csv module doesn't tell whether a field was quoted. A line is
+    # usually the fields put back together with the 'q' fields quoted
+    # (_template, \N isn't quoted), otherwise the fields are walked along
+    # the line to tell.
+    doubled_quotes = True
+
+    def __init__(self, tokens):
+        for t in tokens:
+            if t not in ('q', 'nq'):
+                raise NotImplementedError()
+
+        self._n = len(tokens)
+        self._q = [t == 'q' for t in tokens]
+        # \0 marks where the quotes of the 'q' fields go
+        self._template = ','.join('\0%s\0' if t == 'q' else '%s' for t in tokens)
+
+    def _quoted(self, fields):
+        # the line fields are read from if the 'q' fields were quoted
+        return (self._template % tuple(fields)).replace('\0\\N\0', r'\N').replace('\0', '"')
+
+    def _check_quoting(self, line, fields):
+        # fields: the first _n fields of line, as the csv module read them
+        if '\0' not in line:
+            s = self._quoted(fields)
+            if line == s or line.startswith(s + ','):
+                return
+
+        pos = 0
+        for v, q in zip(fields, self._q):
+            if line.startswith('"', pos):
+                pos += len(v) + 2 + v.count('"')
+            else:
+                if q and v != r'\N':
+                    raise ValueError('line does not match expected format')
+                pos += len(v)
+            pos += 1
+
+    def parse(self, line):
+        return next(self.parse_lines((line,)))
+
+    def parse_lines(self, lines):
+        n = self._n
+        q = any(self._q)
+        check = self._check_quoting
+        template = self._template
+
+        # lines with quotes go through a single csv.reader, one at a time
+        def _next():
+            l = box[0]
+            box[0] = None
+            return l
+
+        box = [None]
+        reader = csv.reader(iter(_next, None), OpenflightsDialect)
+
+        for line in lines:
+            line = line.strip()
+            if '"' not in line:
+                fields = line.split(',', n)
+                if len(fields) != n:
+                    if len(fields) < n:
+                        raise ValueError('line does not match expected format')
+                    del fields[n:]
+                if q:
+                    check(line, fields)
+            else:
+                box[0] = line
+                try:
+                    fields = next(reader)
+                except (csv.Error, StopIteration) as ex:
+                    raise ValueError('line does not match expected format') from ex
+                if len(fields) != n:
+                    if len(fields) < n:
+                        raise ValueError('line does not match expected format')
+                    del fields[n:]
+                # _check_quoting, with its common case inlined
+                if line != (template % tuple(fields)).replace('\0\\N\0', r'\N').replace('\0', '"'):
+                    check(line, fields)
+
+            # most rows have no or only a few empty fields, replacing
+            # them in place is a lot cheaper than building a new list
+            while '' in fields:
+                fields[fields.index('')] = None
+            while r'\N' in fields:
+                fields[fields.index(r'\N')] = None
+            yield fields
@@ -1,14 +1,48 @@
+import io
+import re
+import tarfile
 import unittest
-from lineparser import LineParser
+from os.path import dirname, isfile, join
+
+from lineparser import CsvLineParser, LineParser
+
+cases = [
+    (r'-1,"Unknown",\N,"-","N/A",\N,\N,"Y"', ('nq', 'q', 'q', 'q', 'q', 'nq', 'nq', 'q'), ['-1', 'Unknown', None, '-', 'N/A', None, None, 'Y'], None),
+    (r'123,"SN","SG"', ('q', 'q', 'q'), [], ValueError),
+    (r'0,"A long string, which also contains commas","SG",\N', ('nq', 'q', 'q', 'q'), ['0', 'A long string, which also contains commas', 'SG', None], None),
+    (r'abcdef,"ghijkl",\N,"12345"', ('nq', 'q', 'nq', 'q'), ['abcdef', 'ghijkl', None, '12345'], None),
+    # the quoted value appears in the line, but not where the field is
+    ('"a",a', ('q', 'q'), [], ValueError),
+    ('a,"a"', ('q', 'q'), [], ValueError),
+    (r'\N,"b",""', ('q', 'q', 'q'), [None, 'b', None], None),
+    ('1,2', ('nq', 'q'), [], ValueError),
+]
+
+# doubled quotes, which only CsvLineParser handles
+doubled_quote_cases = [
+    ('332,"Magdeburg ""City"" Airport","Magdeburg"', ('nq', 'q', 'q'), ['332', 'Magdeburg "City" Airport', 'Magdeburg'], None),
+    ('1,"""Quoted""",""', ('nq', 'q', 'q'), ['1', '"Quoted"', None], None),
+    ('1,"a ""b"" c",d', ('nq', 'q', 'q'), [], ValueError),
+    ('1,"a ""b"" c","d"",e', ('nq', 'q', 'q'), [], ValueError),
+    ('"a ""b""",a ""b""', ('q', 'q'), [], ValueError),
+]
+
+# formats of the .dat files, see extract.py
+dat_formats = {
+    'airlines.dat': ['nq'] + ['q'] * 7,
+    'airports.dat': ['nq'] + ['q'] * 5 + ['nq'] * 4 + ['q'] * 4,
+    'countries.dat': ['q'] * 3,
+    'planes.dat': ['q'] * 3,
+    'routes.dat': ['nq'] * 9,
+}
+
+_doubled = re.compile(r'(?<=[^,])""')
+
+data_tar = join(dirname(__file__), '..', 'data', 'data.tar.gz')
+
 
 class TestLineParser(unittest.TestCase):
     def test_parse(self):
-        cases = [
-            (r'-1,"Unknown",\N,"-","N/A",\N,\N,"Y"', ('nq', 'q', 'q', 'q', 'q', 'nq', 'nq', 'q'), ['-1', 'Unknown', None, '-', 'N/A', None, None, 'Y'], None),
-            (r'123,"SN","SG"', ('q', 'q', 'q'), [], ValueError),
-            (r'0,"A long string, which also contains commas","SG",\N', ('nq', 'q', 'q', 'q'), ['0', 'A long string, which also contains commas', 'SG', None], None),
-            (r'abcdef,"ghijkl",\N,"12345"', ('nq', 'q', 'nq', 'q'), ['abcdef', 'ghijkl', None, '12345'], None),
-        ]
 
         for l, fmt, want, want_ex in cases:
             lp = LineParser(fmt)
@@ -19,5 +53,56 @@ class TestLineParser(unittest.TestCase):
                 self.assertEqual(lp.parse(l), want)
 
 
+class TestCsvLineParser(unittest.TestCase):
+    def test_parse(self):
+        for l, fmt, want, want_ex in cases:
+            lp = CsvLineParser(fmt)
+            if want_ex:
+                with self.assertRaises(want_ex):
+                    lp.parse(l)
+                with self.assertRaises(want_ex):
+                    list(lp.parse_lines([l]))
+            else:
+                self.assertEqual(lp.parse(l), want)
+                self.assertEqual(list(lp.parse_lines([l])), [want])
+
+    def test_doubled_quotes(self):
+        for l, fmt, want, want_ex in doubled_quote_cases:
+            with self.subTest(l):
+                lp = CsvLineParser(fmt)
+                if want_ex:
+                    with self.assertRaises(want_ex):
+                        lp.parse(l)
+                    with self.assertRaises(want_ex):
+                        list(lp.parse_lines([l]))
+                else:
+                    self.assertEqual(lp.parse(l + '\n'), want)
+                    self.assertEqual(list(lp.parse_lines([l + '\n'])), [want])
+
+    def test_extra_fields(self):
+        for l in ('1,2,3,4', '1,"2",3,"4"'):
+            lp = CsvLineParser(('nq', 'nq', 'nq'))
+            self.assertEqual(lp.parse(l), ['1', '2', '3'])
+            self.assertEqual(list(lp.parse_lines([l])), [['1', '2', '3']])
+
+    @unittest.skipUnless(isfile(data_tar), 'data/data.tar.gz not found')
+    def test_dat_files(self):
+        # Same output as LineParser for every line. LineParser gets the
+        # doubled quotes inside quoted strings as \1 (the ones of "" fields
+        # follow a comma) and they're put back as a quote afterwards
+        def _regex_parse(fmt, lines):
+            for l in lines:
+                v = LineParser(fmt).parse(_doubled.sub('\1', l))
+                yield [f.replace('\1', '"') if f else f for f in v]
+
+        with tarfile.open(data_tar) as tar:
+            for name, fmt in dat_formats.items():
+                with self.subTest(name):
+                    lines = io.TextIOWrapper(tar.extractfile(name), encoding='utf-8').readlines()
+                    want = list(_regex_parse(fmt, lines))
+                    self.assertEqual(list(CsvLineParser(fmt).parse_lines(lines)), want)
+                    self.assertEqual([CsvLineParser(fmt).parse(l) for l in lines], want)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,5 +1,5 @@
 import logging
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import astuple, replace
 from time import sleep
 
@@ -18,9 +18,13 @@ def load_airlines(airlines, db):
         db.insert_airline(al)
 
 
-def load_cities(airports, db):
-    # Cities are extracted from the airport list (for normalization)
-    cities = defaultdict(list)
+def cities_from_airports(airports):
+    # Cities are extracted from the airport list (for normalization).
+    # Only the first airport of every city is used, even if there are
+    # more, in the hope that this one has good data...
+    # Country names are translated to the ones of the countries table here,
+    # like read_airlines does, insert_city takes them as they are
+    seen = set()
     for ap in airports:
         if ap.airport_name == 'Powidz Military Air Base':
             ap = replace(ap, city='Powidz')
@@ -29,29 +33,30 @@ def load_cities(airports, db):
             logging.debug(f'load_cities: airport "{ap.airport_name}" does not have a city. Skipping.')
             continue
 
-        cities[f'{ap.country}/{ap.city}'].append(
-            CityDat(
-                None, 
-                None,
-                ap.country,
-                ap.city,
-                ap.timezone_offset,
-                ap.daylight_saving,
-                ap.timezone
-            ))
-
-    # keep a list of cities where we're not able to find
-    # a matching country in the countries table
-    no_country_id = []
-    for _,v in cities.items():
-        # get the first entry even if there are more
-        # and hope that this one has good data...
-        city = v[0]
-        db.insert_city(city)
+        country = translate_country(ap.country)
+        key = (country, ap.city)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        yield CityDat(
+            None,
+            None,
+            country,
+            ap.city,
+            ap.timezone_offset,
+            ap.daylight_saving,
+            ap.timezone
+        )
+
+
+def load_cities(airports, db):
+    load_city_rows(cities_from_airports(airports), db)
 
-       
 
-    no_country_id.sort()
+def load_city_rows(cities, db):
+    for city in cities:
+        db.insert_city(city)
 
 
 def load_airports(airports, db):
@@ -72,3 +77,57 @@ def load_routes(routes, db):
             db.insert_route(r)
         except Exception as ex:
             logging.debug(f'could not add route: {ex}')
+
+
+def load_routes_staged(routes, db):
+    # all routes in one go, see OpenflightsDB.insert_routes_staged
+    db.insert_routes_staged(routes)
+
+
+def _route_key(r):
+    # the columns of unq_route, see schema/create.sql
+    return (r.airline_id, r.src_airport_id, r.dest_airport_id, r.route_codeshare, r.route_stops)
+
+
+def load_routes_parallel(routes, db, workers, chunk_size=1000):
+    # Once airports, airlines and planes are loaded, routes are independent
+    # of each other. Chunks of them are therefore loaded concurrently, each
+    # worker thread using its own connection (see OpenflightsDB.clone).
+    #
+    # Routes are split between the workers by their unique key, so that
+    # duplicates go to the same connection and fail there with a
+    # UniqueViolation. Otherwise the second one would wait for the
+    # transaction of the other worker, and two workers waiting for each
+    # other would deadlock. Every worker has one chunk in flight, the next
+    # one is collected meanwhile.
+    clones = [db.clone() for _ in range(workers)]
+    chunks = [[] for _ in range(workers)]
+    running = [None] * workers
+
+    def _submit(pool, i):
+        if running[i]:
+            running[i].result()
+        running[i] = pool.submit(load_routes, chunks[i], clones[i])
+        chunks[i] = []
+
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            for r in routes:
+                i = hash(_route_key(r)) % workers
+                chunks[i].append(r)
+                if len(chunks[i]) >= chunk_size:
+                    _submit(pool, i)
+
+            for i in range(workers):
+                if chunks[i]:
+                    _submit(pool, i)
+            for f in running:
+                if f:
+                    f.result()
+
+        for c in clones:
+            c.flush()
+            db.merge_stats(c)
+    finally:
+        for c in clones:
+            c.close()
@@ -0,0 +1,91 @@
+import unittest
+from collections import Counter
+from unittest import mock
+
+from load import cities_from_airports, load_routes_parallel
+from model import AirportDat, RouteDat
+
+
+def _route(airline_id, src, dest):
+    return RouteDat(None, None, airline_id, src, None, None, dest, None, None, None, 0, ())
+
+
+class _DB:
+    # the parts of OpenflightsDB load_routes_parallel uses. Clones record
+    # the routes they were given
+    def __init__(self):
+        self.clones = []
+        self.routes = []
+        self.flushed = self.merged = self.closed = False
+
+
+    def clone(self):
+        c = _DB()
+        self.clones.append(c)
+        return c
+
+
+    def insert_route(self, route):
+        self.routes.append(route)
+
+
+    def flush(self):
+        self.flushed = True
+
+
+    def merge_stats(self, other):
+        other.merged = True
+
+
+    def close(self):
+        self.closed = True
+
+
+class TestLoadRoutesParallel(unittest.TestCase):
+    def test_duplicates(self):
+        # duplicates in different chunks go to the same connection
+        routes = [_route(str(a), 'AAA', dest) for a in range(20) for dest in ('BBB', 'CCC')] * 3
+        db = _DB()
+        load_routes_parallel(routes, db, 3, chunk_size=4)
+
+        self.assertEqual(len(db.clones), 3)
+        self.assertEqual(Counter(r for c in db.clones for r in c.routes), Counter(routes))
+        for c in db.clones:
+            self.assertTrue(c.flushed and c.merged and c.closed)
+        key_clones = {}
+        for c in db.clones:
+            for r in c.routes:
+                self.assertIs(key_clones.setdefault(r, c), c)
+            # every key has its 3 rows on the same clone
+            self.assertEqual(len(c.routes), 3 * len(set(c.routes)))
+
+
+    def test_error(self):
+        # load_routes only logs the rows that fail, errors of the
+        # connection itself end the load
+        db = _DB()
+        with mock.patch('load.load_routes', side_effect=RuntimeError('connection lost')):
+            with self.assertRaises(RuntimeError):
+                load_routes_parallel([_route('1', 'AAA', 'BBB')] * 10, db, 2, chunk_size=2)
+        for c in db.clones:
+            self.assertTrue(c.closed)
+
+
+
+def _airport(airport_id, city, country):
+    return AirportDat(airport_id, f'airport {airport_id}', city, country, None, None, 0.0, 0.0, 0,
+                      1.0, 'E', 'Europe/Berlin', 'airport', 'OurAirports')
+
+
+class TestCitiesFromAirports(unittest.TestCase):
+    def test_translated(self):
+        # the first airport of every city, with the country name of the
+        # countries table
+        airports = [_airport(1, 'Yangon', 'Burma'), _airport(2, 'Yangon', 'Myanmar'),
+                    _airport(3, 'Berlin', 'Germany'), _airport(4, None, 'Germany')]
+        self.assertEqual([(c.country_name, c.city_name) for c in cities_from_airports(airports)],
+                         [('Myanmar', 'Yangon'), ('Germany', 'Berlin')])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,21 +2,37 @@
 
 import argparse
 import logging
-from functools import partial
+import sys
+from functools import cache, partial
+from itertools import chain
 from operator import attrgetter
 from os.path import isdir, join
 from traceback import print_exc
 
-from db import OpenflightsDB
-from extract import (read_airlines, read_airports, read_countries, read_planes,
+from cache import CACHE_DIR, ExtractCache
+from columns import AirportColumns, RouteColumns
+from db import CopyOpenflightsDB, OpenflightsDB
+from delta import load_delta
+from dump import dump, restore
+from extract import (SharedSource, log_open_counts, read_airlines,
+                     read_airports, read_countries, read_planes,
                      read_planes_csv, read_routes)
-from load import (load_airlines, load_airports, load_cities, load_countries,
-                  load_planes, load_routes)
+from lineparser import CsvLineParser, LineParser
+from load import (cities_from_airports, load_airlines, load_airports,
+                  load_city_rows, load_countries, load_planes, load_routes,
+                  load_routes_parallel, load_routes_staged)
+from phases import Phase, critical_path, run_phases
+from pipeline import Pipeline
+from resolve import KeyResolver
+from schema import load_schema
+from spatial import SPATIAL_SQL
+from transform import translate_equipment
+from validate import Validator
 
 logging.basicConfig(level=logging.INFO)
 
 
-def parse_args():
+def parse_args(argv=None):
     def dir_path(d):
         if isdir(d):
             return d
@@ -30,14 +46,109 @@ def parse_args():
     parser.add_argument('--db-user', default='postgres')
     parser.add_argument('--db-password', default='1234')
     parser.add_argument('--data-dir', default='./data/', type=dir_path)
-    return parser.parse_args()
+    parser.add_argument('--engine', choices=('insert', 'copy', 'async'), default='insert',
+        help='insert: one INSERT per row, copy: buffer rows and bulk load them using COPY, '
+             'async: buffer rows and send them with pipelined INSERTs over several connections')
+    parser.add_argument('--mode', choices=('insert', 'upsert'), default='insert',
+        help='insert: rows that are already there fail with a UniqueViolation, upsert: they\'re '
+             'updated if they changed (insert engine only)')
+    parser.add_argument('--connections', default=4, type=int,
+        help='number of connections the async engine sends INSERTs over at the same time')
+    parser.add_argument('--batch-size', default=10000, type=int,
+        help='number of rows per transaction (insert engine) or per COPY (copy engine). '
+             'With 1 every row is committed on its own')
+    parser.add_argument('--workers', default=1, type=int,
+        help='number of connections routes are loaded over in parallel')
+    parser.add_argument('--staged-routes', action='store_true',
+        help='load routes through a staging table with a couple of set based statements '
+             'instead of row by row (--workers is ignored then)')
+    parser.add_argument('--parallel-phases', action='store_true',
+        help='load tables that don\'t depend on each other at the same time')
+    parser.add_argument('--parser', choices=('regex', 'csv'), default='regex',
+        help='regex: LineParser, csv: CsvLineParser, which is faster on routes.dat '
+             'and keeps doubled quotes in airport names instead of replacing them with \'')
+    parser.add_argument('--parse-workers', default=0, type=int,
+        help='parse airports.dat and routes.dat in this many processes, chunk by chunk '
+             '(0: in the loading process). Pays off for files a lot bigger than the sample data')
+    parser.add_argument('--extract-cache', metavar='DIR', nargs='?', const=CACHE_DIR,
+        help=f'keep the rows read from the source files in DIR (default {CACHE_DIR}), later runs '
+             'read them from there instead of parsing files that didn\'t change')
+    parser.add_argument('--cache-size', default=512, type=int,
+        help='MB the extract cache may take, beyond that the entries used the longest ago are removed')
+    parser.add_argument('--columnar', action='store_true',
+        help='keep airports and routes in memory column by column (see columns.py), '
+             'which takes a lot less memory than rows')
+    parser.add_argument('--incremental', action='store_true',
+        help='only apply the rows that changed since the last run with --incremental, '
+             'tables whose source files didn\'t change are skipped')
+    parser.add_argument('--pipeline', action='store_true',
+        help='read and transform the rows of each phase in threads of their own, '
+             'overlapping with loading them (ignored with --incremental)')
+    parser.add_argument('--queue-size', default=4, type=int,
+        help='number of batches of rows that can be waiting between pipeline steps')
+    parser.add_argument('--cold-load', action='store_true',
+        help='drop the PKs, unique constraints and FKs before loading and add them again at the end, '
+             'rows violating them are deleted then')
+    parser.add_argument('--spatial-index', action='store_true',
+        help='after loading, add a GiST index on the airport locations and the SQL functions of '
+             'schema/spatial.sql (needs the earthdistance extension)')
+    parser.add_argument('--validate', action='store_true',
+        help='check rows against the unique constraints and FKs in memory and drop the ones that would fail '
+             'before they\'re sent to the DB')
+    parser.add_argument('--quarantine', metavar='FILE',
+        help='with --validate, write the dropped rows to this file, one JSON object per line')
+    parser.add_argument('--export', metavar='DIR',
+        help='write the tables to files in DIR instead of loading them into the DB')
+    parser.add_argument('--export-format', choices=('parquet', 'arrow'), default='parquet',
+        help='parquet: compressed Parquet files, arrow: Arrow IPC files that can be memory mapped')
+    parser.add_argument('--metrics-out',
+        help='write the statement latencies, key lookups and phase timings to this file')
+    parser.add_argument('--metrics-format', choices=('json', 'prometheus'), default='json',
+        help='format of --metrics-out, prometheus: the Prometheus text format')
+
+    # without a command the data is loaded
+    commands = parser.add_subparsers(dest='command')
+    dump_parser = commands.add_parser('dump',
+        help='dump the DB to a gzipped SQL file: the tables, their rows as COPY, then the constraints')
+    dump_parser.add_argument('--out', default='./dump/dump.sql.gz')
+    dump_parser.add_argument('--schema', default='./schema/create.sql',
+        help='the constraints in the dump are taken from this file')
+    restore_parser = commands.add_parser('restore',
+        help='load a dump written by dump into an empty DB, COPYing tables and building indexes in parallel')
+    restore_parser.add_argument('file')
+    restore_parser.add_argument('--jobs', default=4, type=int,
+        help='number of tables COPYed or indexed at the same time')
+    clear_parser = commands.add_parser('clear-cache',
+        help='remove the entries of the extract cache (see --extract-cache)')
+    clear_parser.add_argument('sources', nargs='*',
+        help='only remove the entries of these sources (airlines, airports, countries, planes, routes)')
+    clear_parser.add_argument('--dir', default=CACHE_DIR)
+
+    args = parser.parse_args(argv)
+    if args.export and (args.incremental or args.staged_routes):
+        parser.error('--export can\'t be combined with --incremental or --staged-routes')
+    if args.cold_load and (args.export or args.incremental):
+        parser.error('--cold-load can\'t be combined with --export or --incremental')
+    if args.validate and (args.export or args.incremental):
+        parser.error('--validate can\'t be combined with --export (which validates anyway) or --incremental')
+    if args.spatial_index and args.export:
+        parser.error('--spatial-index can\'t be combined with --export')
+    if args.quarantine and not args.validate:
+        parser.error('--quarantine requires --validate')
+    if args.mode == 'upsert' and (args.engine != 'insert' or args.export or args.incremental or
+                                  args.cold_load or args.validate or args.staged_routes):
+        parser.error('--mode upsert requires --engine insert and can\'t be combined with --export, '
+                     '--incremental, --cold-load, --validate or --staged-routes')
+    return args
 
 
 def combine_planes(p1, p2):
-    planes_all = set(p1) | set(p2)
-    planes_all_iata_icao = zip([f'{p.plane_iata}{p.plane_icao}' for p in planes_all], planes_all)
+    # the planes of p1, then those of p2, the first one per IATA and ICAO
+    # code wins. In the order of the files, so that it's the same one
+    # every run
     inserted = set()
-    for iata_icao, p in planes_all_iata_icao:
+    for p in chain(p1, p2):
+        iata_icao = f'{p.plane_iata}{p.plane_icao}'
         if iata_icao in inserted:
             continue
 
@@ -45,61 +156,282 @@ def combine_planes(p1, p2):
         yield(p)
 
 
-def display_table_stats(t, s):
+def read_all_planes(planes_dat, planes_csv, parser=LineParser):
+    return combine_planes(read_planes(planes_dat, parser), read_planes_csv(planes_csv))
+
+
+def display_table_stats(t, s, metrics=None):
     print(f'# Stats for {t}')
     print(f'rows inserted: {s.insert_ok}')
+    print(f'commits: {s.commits}')
+    if s.updated or s.deleted or s.unchanged:
+        print(f'rows updated: {s.updated}')
+        print(f'rows deleted: {s.deleted}')
+        print(f'rows unchanged: {s.unchanged}')
 
     total_failed = sum(s.insert_errors.values())
     print(f'rows failed: {total_failed}')
     for ex, num in s.insert_errors.items():
         print(f'  - {ex}: {num}')
+
+    if metrics:
+        for (kind, table), h in sorted(metrics.latencies.items()):
+            if table == t and h.count:
+                print(f'{kind} statements: {h.count}, avg {h.sum / h.count * 1000:.2f}ms, '
+                      f'p50 <= {h.quantile(0.5) * 1000:g}ms, p99 <= {h.quantile(0.99) * 1000:g}ms')
+    print()
+
+
+def display_phase_times(phases):
+    print('# Phase timings')
+    for p in sorted(phases, key=attrgetter('start')):
+        print(f'{p.name}: {p.duration:.2f}s ({p.start:.2f}s - {p.end:.2f}s)')
+
+    cp = critical_path(phases)
+    total = max(p.end for p in phases)
+    print(f'critical path: {" -> ".join(p.name for p in cp)}, '
+          f'{sum(p.duration for p in cp):.2f}s of {total:.2f}s')
+    print()
+
+
+def display_metrics(metrics, phases):
+    print('# Time spent (extract / transform / db)')
+    for p in sorted(phases, key=attrgetter('start')):
+        t = p.times
+        print(f'{p.name}: {t["extract"]:.2f}s / {t["transform"]:.2f}s / {t["db"]:.2f}s')
+    print()
+
+    print('# Key lookups (hits / misses)')
+    for t, (hits, misses) in sorted(metrics.lookups.items()):
+        print(f'{t}: {hits} / {misses}')
+    print()
+
+
+def display_pipelines(pipelines):
+    print('# Pipeline steps (busy / waiting for input / waiting for output)')
+    for name, p in pipelines.items():
+        print(f'{name}: {p.seconds:.2f}s')
+        for s in p.stages:
+            print(f'  {s.name}: {s.busy:.2f}s ({s.utilization(p.seconds):.0%}) / '
+                  f'{s.waiting_input:.2f}s / {s.waiting_output:.2f}s')
     print()
 
 
-def main(args):
-    airlines = partial(read_airlines, join(args.data_dir, 'airlines.dat'))
-    airports = partial(read_airports, join(args.data_dir, 'airports.dat'))
-    countries = partial(read_countries, join(args.data_dir, 'countries.dat'))
-    planes = partial(read_planes, join(args.data_dir, 'planes.dat'))
-    planes_csv = partial(read_planes_csv, join(args.data_dir, 'planes.csv'))
-    routes = partial(read_routes, join(args.data_dir, 'routes.dat'))
+def restore_constraints(database, schema):
+    # A --cold-load that failed or was interrupted must not leave the tables
+    # without their constraints, later runs would write duplicates without
+    # anyone noticing
+    logging.error('cold load failed, adding the dropped constraints again')
+    try:
+        database.rollback()
+        database.add_constraints(schema)
+        return
+    except BaseException:
+        print_exc()
+
+    try:
+        database.rollback()
+        missing = database.missing_constraints(schema)
+    except BaseException:
+        # e.g. the connection is gone, any of them may be missing
+        missing = {name: t.constraints for name, t in schema.items()}
+    logging.critical(
+        'constraints dropped by --cold-load are still missing, later loads will write duplicates '
+        'until they are added again, once the tables are free of duplicates:'
+    )
+    for name, cs in missing.items():
+        for c in cs:
+            logging.critical(f'  ALTER TABLE {name} ADD CONSTRAINT {c.name} {c.definition()};')
 
 
-    load_countries(countries(), database)
-    display_table_stats('countries', database.table_stats['countries'])
+def main(args, database):
+    lp = CsvLineParser if args.parser == 'csv' else LineParser
+    extract_cache = ExtractCache(args.extract_cache, args.cache_size << 20) if args.extract_cache else None
 
+    def _reader(name, read, files, **kw):
+        fnames = [join(args.data_dir, f) for f in files]
+        read = partial(read, *fnames, **kw)
+        if extract_cache:
+            # the parser decides what some of the rows look like
+            read = extract_cache.source(name, read, fnames, options=lp.__name__)
+        return read
 
-    load_cities(airports(), database)
-    display_table_stats('cities', database.table_stats['cities'])
+    # every file is only read and parsed once. airports.dat is the only
+    # one that several phases use (cities and airports), the rows of the
+    # others aren't kept
+    airlines = _reader('airlines', read_airlines, ['airlines.dat'], parser=lp)
+    airports = SharedSource(_reader('airports', read_airports, ['airports.dat'], parser=lp, workers=args.parse_workers))
+    countries = _reader('countries', read_countries, ['countries.dat'], parser=lp)
+    planes = _reader('planes', read_all_planes, ['planes.dat', 'planes.csv'], parser=lp)
+    routes = _reader('routes', read_routes, ['routes.dat'], parser=lp, workers=args.parse_workers)
+    if args.columnar:
+        # read on first use, the Columns can be iterated as often as needed
+        read_airports_rows = _reader('airports', read_airports, ['airports.dat'], parser=lp, workers=args.parse_workers)
+        read_routes_rows = _reader('routes', read_routes, ['routes.dat'], parser=lp, workers=args.parse_workers)
+        airports = cache(lambda: AirportColumns(read_airports_rows()))
+        routes = cache(lambda: RouteColumns(read_routes_rows()))
 
-    load_airports(airports(), database)
-    display_table_stats('airports', database.table_stats['airports'])
+    # phase name -> Pipeline, with --pipeline
+    pipelines = {}
+
+    def _rows(name, source, db, transforms=()):
+        # The rows a phase loads, with transforms applied. The time spent
+        # reading them counts as extract time. With --pipeline they're read
+        # and transformed in threads of their own
+        extract = lambda: db.metrics.extract(source())
+        if args.pipeline:
+            p = pipelines[name] = Pipeline(extract, transforms, maxsize=args.queue_size)
+            return iter(p)
+
+        rows = extract()
+        for t in transforms:
+            rows = t(rows)
+        return rows
+
+    def _load_routes(db):
+        rows = _rows('routes', routes, db, (translate_equipment,))
+        if args.staged_routes:
+            load_routes_staged(rows, db)
+        elif args.workers > 1:
+            load_routes_parallel(rows, db, args.workers)
+        else:
+            load_routes(rows, db)
 
-    load_airlines(airlines(), database)
-    display_table_stats('airlines', database.table_stats['airlines'])
+    # the tables each phase requires follow the FKs in schema/create.sql
+    # and the lookups done while inserting (e.g. cities by name for airports)
+    phases = [
+        Phase('countries', lambda db: load_countries(_rows('countries', countries, db), db), ('countries',)),
+        Phase('cities',
+            lambda db: load_city_rows(_rows('cities', airports, db, (cities_from_airports,)), db),
+            ('cities',), ('countries',)),
+        Phase('airports', lambda db: load_airports(_rows('airports', airports, db), db), ('airports',), ('cities',)),
+        Phase('airlines', lambda db: load_airlines(_rows('airlines', airlines, db), db), ('airlines',), ('countries',)),
+        Phase('planes',
+            lambda db: load_planes(_rows('planes', planes, db), db),
+            ('planes',)),
+        Phase('routes', _load_routes, ('routes', 'route_plane'), ('airports', 'planes')),
+    ]
 
-    load_planes(combine_planes(planes(), planes_csv()), database)
-    display_table_stats('planes', database.table_stats['planes'])
+    if args.incremental:
+        database.create_state_tables()
+        # phase -> rows and the files they're read from
+        sources = {
+            'countries': (countries, ('countries.dat',)),
+            'cities': (lambda: cities_from_airports(airports()), ('airports.dat',)),
+            'airports': (airports, ('airports.dat',)),
+            'airlines': (airlines, ('airlines.dat',)),
+            'planes': (planes, ('planes.dat', 'planes.csv')),
+            'routes': (lambda: translate_equipment(routes()), ('routes.dat',)),
+        }
+        for p in phases:
+            rows, files = sources[p.name]
+            p.load = partial(load_delta, p.name, rows, [join(args.data_dir, f) for f in files])
 
-    logging.basicConfig(level=logging.DEBUG)
+    if args.cold_load:
+        # The constraints are added once every table is loaded. Tables
+        # looked up by key while loading (see KeyResolver) keep theirs,
+        # which of their rows are rejected decides what later rows
+        # reference (e.g. routes get a DUMMY plane for a code whose plane
+        # was a duplicate). They're small anyway
+        schema = {t: s for t, s in load_schema().items() if t not in KeyResolver.key_columns}
+        database.drop_constraints(schema)
+        phases.append(Phase(
+            'constraints', lambda db: db.add_constraints(schema), (), tuple(t for p in phases for t in p.tables)
+        ))
 
-    load_routes(routes(), database)
-    display_table_stats('routes', database.table_stats['routes'])
-    display_table_stats('route_plane', database.table_stats['route_plane'])
+    def _display_phase_stats(p):
+        for t in p.tables:
+            display_table_stats(t, database.table_stats[t], database.metrics)
+
+    # with --cold-load the stats are only final once the constraints are added
+    done = None if args.cold_load else _display_phase_stats
+    try:
+        run_phases(phases, database, parallel=args.parallel_phases, done=done)
+    except BaseException:
+        if args.cold_load:
+            restore_constraints(database, schema)
+        raise
+    if args.cold_load:
+        for p in phases:
+            _display_phase_stats(p)
+    if args.spatial_index:
+        database.run_sql_file(SPATIAL_SQL)
+        logging.info(f'ran {SPATIAL_SQL}')
+    display_phase_times(phases)
+    display_metrics(database.metrics, phases)
+    if pipelines:
+        display_pipelines(pipelines)
+    log_open_counts()
+    if extract_cache:
+        logging.info(f'extract cache: {extract_cache.hits} hit(s), {extract_cache.misses} miss(es)')
+
+    if args.metrics_out:
+        with open(args.metrics_out, 'w') as f:
+            if args.metrics_format == 'prometheus':
+                f.write(database.metrics.to_prometheus(phases))
+            else:
+                f.write(database.metrics.to_json(phases))
+    return phases
   
 
+def open_database(args):
+    if args.export:
+        # pyarrow is only needed for exports
+        from export import ExportOpenflightsDB
+        return ExportOpenflightsDB(args.export, args.export_format, batch_size=args.batch_size)
+    elif args.engine == 'async':
+        # asyncpg is only needed for this engine
+        from asyncdb import AsyncOpenflightsDB
+        return AsyncOpenflightsDB(
+            args.db_name,
+            args.db_host,
+            args.db_port,
+            args.db_user,
+            args.db_password,
+            batch_size=args.batch_size,
+            connections=args.connections
+        )
+    elif args.engine == 'copy':
+        return CopyOpenflightsDB(
+            args.db_name,
+            args.db_host,
+            args.db_port,
+            args.db_user,
+            args.db_password,
+            batch_size=args.batch_size
+        )
+    else:
+        return OpenflightsDB(
+            args.db_name,
+            args.db_host,
+            args.db_port,
+            args.db_user,
+            args.db_password,
+            batch_size=args.batch_size
+        )
+
+
 if __name__ == "__main__":
     args = parse_args()
-    database = OpenflightsDB(
-        args.db_name,
-        args.db_host,
-        args.db_port,
-        args.db_user,
-        args.db_password
-    )
-    
+    conn_args = (args.db_name, args.db_host, args.db_port, args.db_user, args.db_password)
+    if args.command == 'dump':
+        dump(conn_args, args.schema, args.out)
+        sys.exit()
+    elif args.command == 'restore':
+        restore(conn_args, args.file, jobs=args.jobs)
+        sys.exit()
+    elif args.command == 'clear-cache':
+        removed = ExtractCache(args.dir).clear(args.sources)
+        print(f'removed {removed} entries from {args.dir}')
+        sys.exit()
+
+    database = open_database(args)
+    database.upsert = args.mode == 'upsert'
+    if args.validate:
+        database.set_validator(Validator(load_schema(), quarantine=args.quarantine))
+
     try:
-        main(args)
+        main(args, database)
     except KeyboardInterrupt:
         logging.debug('Ctrl-C. Bye.')
     except:
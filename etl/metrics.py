@@ -0,0 +1,193 @@
+import json
+from bisect import bisect_left
+from collections import defaultdict
+from time import perf_counter
+
+# Instrumentation of a load: latency histograms of the statements sent to
+# the DB (by kind of statement and table), hits and misses of the key
+# lookups (see KeyResolver) and the time spent reading the source files.
+# Every OpenflightsDB has its own Metrics, clones are merged back like the
+# TableStats (see OpenflightsDB.merge_stats).
+#
+# Recording is a bisect and a couple of additions, cheap enough compared to
+# a round trip to the server to be always on.
+
+# upper bounds of the histogram buckets in seconds, the last one catches
+# everything else
+BUCKETS = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0,
+    10.0, float('inf'),
+)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        # upper bound of the bucket the q quantile falls into
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+
+class Metrics:
+    def __init__(self):
+        # (statement kind, table) -> Histogram
+        self.latencies = defaultdict(Histogram)
+        # table -> [hits, misses] of the key lookups
+        self.lookups = defaultdict(lambda: [0, 0])
+        # seconds spent reading and parsing source rows
+        self.extract_time = 0.0
+        # seconds spent waiting for the DB, the sum of all latencies
+        self.db_time = 0.0
+
+
+    def observe(self, kind, table, seconds):
+        self.latencies[(kind, table)].observe(seconds)
+        self.db_time += seconds
+
+
+    def lookup(self, table, hit):
+        self.lookups[table][0 if hit else 1] += 1
+
+
+    def timed(self, kind, table):
+        # context manager timing a statement
+        return _Timer(self, kind, table)
+
+
+    def extract(self, rows):
+        # Passes rows through, adding the time spent getting each row from
+        # rows to extract_time. Only the time inside rows is counted, not
+        # the time the consumer takes between rows
+        spent = 0.0
+        t = perf_counter()
+        try:
+            for r in rows:
+                spent += perf_counter() - t
+                yield r
+                t = perf_counter()
+            spent += perf_counter() - t
+        finally:
+            self.extract_time += spent
+
+
+    def merge(self, other):
+        for k, h in other.latencies.items():
+            self.latencies[k].merge(h)
+        for t, (hits, misses) in other.lookups.items():
+            self.lookups[t][0] += hits
+            self.lookups[t][1] += misses
+        self.extract_time += other.extract_time
+        self.db_time += other.db_time
+
+
+    def times(self):
+        return {'extract': self.extract_time, 'db': self.db_time}
+
+
+    def to_dict(self, phases=()):
+        return {
+            'latencies': [
+                {
+                    'kind': kind,
+                    'table': table,
+                    'count': h.count,
+                    'sum': h.sum,
+                    'buckets': {str(b): n for b, n in zip(BUCKETS, h.counts)},
+                }
+                for (kind, table), h in sorted(self.latencies.items())
+            ],
+            'lookups': {t: {'hits': hits, 'misses': misses} for t, (hits, misses) in sorted(self.lookups.items())},
+            'times': self.times(),
+            'phases': {p.name: dict(p.times, seconds=p.duration) for p in phases if p.times},
+        }
+
+
+    def to_json(self, phases=()):
+        return json.dumps(self.to_dict(phases), indent=2)
+
+
+    def to_prometheus(self, phases=()):
+        # Prometheus text exposition format
+        lines = [
+            '# HELP openflights_statement_seconds Latency of the statements sent to the DB',
+            '# TYPE openflights_statement_seconds histogram',
+        ]
+        for (kind, table), h in sorted(self.latencies.items()):
+            labels = f'kind="{kind}",table="{table}"'
+            cumulative = 0
+            for b, n in zip(BUCKETS, h.counts):
+                cumulative += n
+                le = '+Inf' if b == float('inf') else repr(b)
+                lines.append(f'openflights_statement_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'openflights_statement_seconds_sum{{{labels}}} {h.sum}')
+            lines.append(f'openflights_statement_seconds_count{{{labels}}} {h.count}')
+
+        lines += [
+            '# HELP openflights_key_lookups_total Lookups of natural keys',
+            '# TYPE openflights_key_lookups_total counter',
+        ]
+        for t, (hits, misses) in sorted(self.lookups.items()):
+            lines.append(f'openflights_key_lookups_total{{table="{t}",result="hit"}} {hits}')
+            lines.append(f'openflights_key_lookups_total{{table="{t}",result="miss"}} {misses}')
+
+        lines += [
+            '# HELP openflights_phase_seconds Time spent per phase, by stage',
+            '# TYPE openflights_phase_seconds gauge',
+        ]
+        for p in phases:
+            for stage, s in (p.times or {}).items():
+                lines.append(f'openflights_phase_seconds{{phase="{p.name}",stage="{stage}"}} {s}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer:
+    __slots__ = ('_metrics', '_kind', '_table', '_t')
+
+    def __init__(self, metrics, kind, table):
+        self._metrics = metrics
+        self._kind = kind
+        self._table = table
+
+    def __enter__(self):
+        self._t = perf_counter()
+
+    def __exit__(self, *args):
+        self._metrics.observe(self._kind, self._table, perf_counter() - self._t)
+
+
+def phase_times(before, after, duration):
+    # Splits the duration of a phase into extract, transform and db given
+    # Metrics.times() before and after it. Transform is everything that's
+    # neither, i.e. turning rows into statements. DB time of parallel
+    # workers adds up, so it can exceed the duration
+    extract = after['extract'] - before['extract']
+    db = after['db'] - before['db']
+    return {
+        'extract': extract,
+        'transform': max(duration - extract - db, 0.0),
+        'db': db,
+    }
@@ -0,0 +1,51 @@
+import json
+import unittest
+
+from metrics import Histogram, Metrics, phase_times
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        h = Histogram()
+        for s in (0.00005, 0.0002, 0.0002, 0.003, 20):
+            h.observe(s)
+        self.assertEqual(h.count, 5)
+        self.assertEqual(h.quantile(0.5), 0.00025)
+        self.assertEqual(h.quantile(0.8), 0.005)
+        self.assertEqual(h.quantile(1), float('inf'))
+
+    def test_merge(self):
+        a, b = Metrics(), Metrics()
+        a.observe('insert', 'routes', 0.001)
+        b.observe('insert', 'routes', 0.002)
+        b.lookup('planes', True)
+        b.lookup('planes', False)
+        a.merge(b)
+        self.assertEqual(a.latencies[('insert', 'routes')].count, 2)
+        self.assertEqual(a.lookups['planes'], [1, 1])
+        self.assertAlmostEqual(a.db_time, 0.003)
+
+    def test_extract(self):
+        m = Metrics()
+        self.assertEqual(list(m.extract(iter(range(3)))), [0, 1, 2])
+        self.assertGreater(m.extract_time, 0)
+
+    def test_phase_times(self):
+        t = phase_times({'extract': 1, 'db': 2}, {'extract': 2, 'db': 5}, 5)
+        self.assertEqual(t, {'extract': 1, 'transform': 1, 'db': 3})
+
+    def test_dumps(self):
+        m = Metrics()
+        m.observe('copy', 'airports', 0.01)
+        m.lookup('cities', True)
+        d = json.loads(m.to_json())
+        self.assertEqual(d['latencies'][0]['count'], 1)
+        self.assertEqual(d['lookups'], {'cities': {'hits': 1, 'misses': 0}})
+
+        prom = m.to_prometheus()
+        self.assertIn('openflights_statement_seconds_bucket{kind="copy",table="airports",le="+Inf"} 1', prom)
+        self.assertIn('openflights_key_lookups_total{table="cities",result="hit"} 1', prom)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,8 @@
 
 from dataclasses import dataclass
-from typing import Iterable
+from typing import Tuple
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class CityDat:
     city_id : int
     country_id : int
@@ -12,13 +12,13 @@ class CityDat:
     city_daylight_saving : str
     city_timezone : str
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class CountryDat:
     country_name : str
     country_iso : str
     country_dafif : str
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AirportDat:
     airport_id : int
     airport_name : str
@@ -36,7 +36,7 @@ class AirportDat:
     source : str
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AirlineDat:
     airline_id : int
     airline_name : str
@@ -48,7 +48,7 @@ class AirlineDat:
     airline_active : str
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class PlaneDat:
     plane_name : str
     plane_iata : str
@@ -58,7 +58,7 @@ class PlaneDat:
         return self.plane_iata == other.plane_iata and self.plane_icao == other.plane_icao
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class RouteDat:
     airline_iata : str
     airline_icao : str
@@ -75,4 +75,4 @@ class RouteDat:
     
     route_codeshare : str
     route_stops : int
-    route_equipment_iata : Iterable[str]
\ No newline at end of file
+    route_equipment_iata : Tuple[str, ...]
\ No newline at end of file
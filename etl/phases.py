@@ -0,0 +1,116 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from time import perf_counter
+
+from metrics import phase_times
+
+
+@dataclass
+class Phase:
+    name : str
+    # called with the OpenflightsDB to load into
+    load : object
+    # tables the phase writes to
+    tables : tuple
+    # tables that have to be loaded before the phase can run
+    requires : tuple = ()
+
+    # seconds since the start of run_phases, set when the phase has run
+    start : float = None
+    end : float = None
+    # seconds spent in extract, transform and db (see metrics.phase_times),
+    # set when the phase has run
+    times : dict = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+def _dependencies(phases):
+    # phase name -> names of the phases writing the tables it requires
+    writers = {t: p.name for p in phases for t in p.tables}
+    return {p.name: {writers[t] for t in p.requires if t in writers} for p in phases}
+
+
+def run_phases(phases, db, parallel=False, done=None):
+    # Runs the phases in dependency order, in the order they're listed if
+    # there's a choice. With parallel, all phases whose required tables
+    # are loaded run at the same time, each on its own connection (see
+    # OpenflightsDB.clone). done is called with every phase once it has
+    # finished and its stats are in db.table_stats
+    deps = _dependencies(phases)
+    finished = set()
+    running = {}
+    t0 = perf_counter()
+
+    def _run(p, pdb):
+        before = pdb.metrics.times()
+        p.start = perf_counter() - t0
+        p.load(pdb)
+        pdb.flush()
+        p.end = perf_counter() - t0
+        p.times = phase_times(before, pdb.metrics.times(), p.duration)
+
+    def _ready():
+        busy = {p.name for p, _ in running.values()}
+        return [
+            p for p in phases
+            if p.name not in finished and p.name not in busy and deps[p.name] <= finished
+        ]
+
+    if not parallel:
+        while len(finished) < len(phases):
+            ready = _ready()
+            if not ready:
+                raise ValueError('phases have circular dependencies')
+
+            _run(ready[0], db)
+            finished.add(ready[0].name)
+            if done:
+                done(ready[0])
+        return
+
+    with ThreadPoolExecutor(len(phases)) as pool:
+        try:
+            while len(finished) < len(phases):
+                for p in _ready():
+                    c = db.clone()
+                    running[pool.submit(_run, p, c)] = (p, c)
+                if not running:
+                    raise ValueError('phases have circular dependencies')
+
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in completed:
+                    p, c = running.pop(f)
+                    c.close()
+                    f.result()
+
+                    db.merge_stats(c)
+                    finished.add(p.name)
+                    if done:
+                        done(p)
+        finally:
+            for f in running:
+                f.cancel()
+            wait(running)
+            for _, c in running.values():
+                c.close()
+
+
+def critical_path(phases):
+    # The chain of dependent phases that took the longest, i.e. the ones
+    # that determine the end to end time. Only valid after run_phases
+    deps = _dependencies(phases)
+    longest = {}
+    # a phase only starts after its dependencies ended, so going by end
+    # time visits the dependencies first
+    for p in sorted(phases, key=lambda p: p.end):
+        before = max(
+            (longest[d] for d in deps[p.name]),
+            key=lambda l: l[0],
+            default=(0, [])
+        )
+        longest[p.name] = (before[0] + p.duration, before[1] + [p])
+
+    return max(longest.values(), key=lambda l: l[0])[1]
@@ -0,0 +1,147 @@
+import queue
+import threading
+from time import perf_counter
+
+# Runs the steps of a phase as a pipeline: extract (reading and parsing the
+# source file) and transform (row transformations that don't need the DB,
+# e.g. cities_from_airports) run in threads of their own, and the load step
+# consumes the rows in the calling thread. The steps are connected by
+# bounded queues, a step that gets ahead of the next one blocks until
+# there's room again, so only a couple of batches are ever in flight.
+#
+# psycopg2 releases the GIL while it waits for the server, so parsing the
+# next rows overlaps with the DB working on the previous ones, and a phase
+# takes about as long as its slowest step instead of the sum of all steps.
+#
+# Rows are passed on in batches, a queue operation per row would cost
+# about as much as parsing it.
+
+_done = object()
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        # seconds spent working, waiting for rows from the previous step
+        # and waiting for room in the queue to the next step
+        self.busy = 0.0
+        self.waiting_input = 0.0
+        self.waiting_output = 0.0
+
+
+    def utilization(self, seconds):
+        return self.busy / seconds if seconds else 0.0
+
+
+class _Failed:
+    # an exception raised by a step, passed on to the consumer
+    def __init__(self, ex):
+        self.ex = ex
+
+
+class Pipeline:
+    # extract: called to get the source rows, transforms: functions taking
+    # an iterable of rows and returning one. Iterating the pipeline yields
+    # the rows that come out of the last transform. stages has the
+    # StageStats of every step once the pipeline has been consumed, seconds
+    # how long that took
+    def __init__(self, extract, transforms=(), maxsize=4, batch_size=500):
+        self._extract = extract
+        self._transforms = transforms
+        self._maxsize = maxsize
+        self._batch_size = batch_size
+        self._stop = threading.Event()
+
+        self.stages = [StageStats('extract')] + [
+            StageStats(getattr(t, '__name__', 'transform')) for t in transforms
+        ] + [StageStats('load')]
+        self.seconds = None
+
+
+    def _put(self, q, item, stats):
+        t = perf_counter()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stats.waiting_output += perf_counter() - t
+
+
+    def _get(self, q, stats):
+        # rows of the batches in q, until the previous step is done
+        while True:
+            t = perf_counter()
+            try:
+                batch = q.get(timeout=0.1)
+            except queue.Empty:
+                batch = None
+            stats.waiting_input += perf_counter() - t
+            if self._stop.is_set():
+                return
+            if batch is None:
+                continue
+            if batch is _done:
+                return
+            if isinstance(batch, _Failed):
+                raise batch.ex
+            yield from batch
+
+
+    def _run(self, step, stats, out):
+        t0 = perf_counter()
+        try:
+            batch = []
+            for r in step():
+                batch.append(r)
+                if len(batch) >= self._batch_size:
+                    stats.rows += len(batch)
+                    self._put(out, batch, stats)
+                    batch = []
+                    if self._stop.is_set():
+                        return
+            stats.rows += len(batch)
+            if batch:
+                self._put(out, batch, stats)
+            self._put(out, _done, stats)
+        except Exception as ex:
+            self._put(out, _Failed(ex), stats)
+        finally:
+            stats.busy = perf_counter() - t0 - stats.waiting_input - stats.waiting_output
+
+
+    def __iter__(self):
+        queues = [queue.Queue(self._maxsize) for _ in range(len(self.stages) - 1)]
+        steps = [self._extract]
+        for t, q, stats in zip(self._transforms, queues, self.stages[1:]):
+            steps.append(lambda t=t, q=q, stats=stats: t(self._get(q, stats)))
+
+        threads = [
+            threading.Thread(target=self._run, args=(step, stats, out), daemon=True)
+            for step, stats, out in zip(steps, self.stages, queues)
+        ]
+        for th in threads:
+            th.start()
+
+        load = self.stages[-1]
+        t0 = perf_counter()
+        try:
+            for r in self._get(queues[-1], load):
+                load.rows += 1
+                yield r
+        finally:
+            # the load step stopped, either because it's done or because it
+            # failed. Let the other steps finish or give up
+            self._stop.set()
+            for q in queues:
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+            for th in threads:
+                th.join()
+            self.seconds = perf_counter() - t0
+            load.busy = self.seconds - load.waiting_input
@@ -0,0 +1,35 @@
+import unittest
+
+from pipeline import Pipeline
+
+
+def double(rows):
+    for r in rows:
+        yield 2 * r
+
+
+class TestPipeline(unittest.TestCase):
+    def test_rows(self):
+        p = Pipeline(lambda: range(2000), (double,), maxsize=2, batch_size=7)
+        self.assertEqual(list(p), [2 * i for i in range(2000)])
+        self.assertEqual([s.name for s in p.stages], ['extract', 'double', 'load'])
+        self.assertEqual([s.rows for s in p.stages], [2000, 2000, 2000])
+
+    def test_error(self):
+        def extract():
+            yield 1
+            raise ValueError('bad row')
+
+        with self.assertRaises(ValueError):
+            list(Pipeline(extract, (double,)))
+
+    def test_stop_early(self):
+        # the steps must not stay blocked on full queues
+        p = Pipeline(lambda: range(100000), (double,), maxsize=1, batch_size=10)
+        for r in p:
+            break
+        self.assertIsNotNone(p.seconds)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+class KeyResolver:
+    # Maps the natural keys used by the source files (country name,
+    # city name, plane IATA code) to the IDs in the DB.
+    #
+    # The maps are loaded with one query per table and then kept up to
+    # date by registering every row that gets inserted. They're therefore
+    # complete, and a key that's not in a map doesn't exist in the DB
+    # either, which means lookups never have to go to the server, not even
+    # for unknown keys.
+
+    # table -> (natural key column, ID column)
+    key_columns = {
+        'countries': ('country_name', 'country_id'),
+        'cities': ('city_name', 'city_id'),
+        'planes': ('plane_iata', 'plane_id'),
+    }
+
+    def __init__(self):
+        self._maps = {t: {} for t in self.key_columns}
+
+
+    def load(self, conn):
+        with conn.cursor() as cur:
+            for table, (key, pk) in self.key_columns.items():
+                cur.execute(f'SELECT {key}, {pk} FROM {table} WHERE {key} IS NOT NULL ORDER BY {pk};')
+                m = self._maps[table] = {}
+                for k, i in cur.fetchall():
+                    # city names can repeat (they're unique per country),
+                    # the lookup query used to return the first match, so
+                    # keep that
+                    m.setdefault(k, i)
+
+
+    def add(self, table, key, row_id):
+        if key is not None:
+            self._maps[table].setdefault(key, row_id)
+
+
+    def remove(self, table, key, row_id):
+        # only if the key maps to the removed row, another row with the
+        # same key could still be there
+        if self._maps[table].get(key) == row_id:
+            del self._maps[table][key]
+
+
+    def country(self, name):
+        return self._maps['countries'].get(name)
+
+
+    def city(self, name):
+        return self._maps['cities'].get(name)
+
+
+    def plane(self, iata):
+        return self._maps['planes'].get(iata)
@@ -0,0 +1,156 @@
+import re
+from dataclasses import dataclass, field
+from os.path import dirname, join
+from typing import List, Tuple
+
+# A minimal reader of the CREATE TABLE statements in schema/create.sql, for
+# the tools that need to know the tables, their columns and constraints
+# (see dump.py). It understands what create.sql uses and not much more.
+
+
+@dataclass
+class Column:
+    name : str
+    # the column definition without inline constraints, e.g.
+    # "integer GENERATED BY DEFAULT AS IDENTITY" or "varchar(40) NOT NULL"
+    definition : str
+    not_null : bool = False
+    identity : bool = False
+
+
+@dataclass
+class Constraint:
+    name : str
+    # PRIMARY KEY, UNIQUE or FOREIGN KEY
+    kind : str
+    columns : Tuple[str, ...]
+    # FOREIGN KEY only
+    ref_table : str = None
+    ref_columns : Tuple[str, ...] = ()
+    # e.g. ON UPDATE CASCADE ON DELETE CASCADE
+    actions : str = ''
+
+    def definition(self):
+        d = f'{self.kind} ({", ".join(self.columns)})'
+        if self.kind == 'FOREIGN KEY':
+            d += f' REFERENCES {self.ref_table} ({", ".join(self.ref_columns)})'
+            if self.actions:
+                d += f' {self.actions}'
+        return d
+
+
+@dataclass
+class Table:
+    name : str
+    columns : List[Column] = field(default_factory=list)
+    constraints : List[Constraint] = field(default_factory=list)
+
+    def column(self, name):
+        return next(c for c in self.columns if c.name == name)
+
+    @property
+    def primary_key(self):
+        return next((c for c in self.constraints if c.kind == 'PRIMARY KEY'), None)
+
+    @property
+    def foreign_keys(self):
+        return [c for c in self.constraints if c.kind == 'FOREIGN KEY']
+
+
+CREATE_SQL = join(dirname(__file__), '..', 'schema', 'create.sql')
+
+_create_table = re.compile(r'CREATE\s+TABLE\s+(\w+)\s*\((.*?)\)\s*;', re.I | re.S)
+_names = re.compile(r'\(([^)]*)\)')
+_references = re.compile(r'REFERENCES\s+(\w+)\s*\(([^)]*)\)\s*(.*)$', re.I | re.S)
+
+
+def _split(body):
+    # splits the body of a CREATE TABLE at the commas outside of parentheses
+    items, depth, start = [], 0, 0
+    for i, ch in enumerate(body):
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch == ',' and depth == 0:
+            items.append(body[start:i])
+            start = i + 1
+    items.append(body[start:])
+    return [' '.join(i.split()) for i in items if i.strip()]
+
+
+def _columns(s):
+    return tuple(c.strip() for c in _names.search(s).group(1).split(','))
+
+
+def _constraint(table, name, s):
+    kind = ' '.join(s.split()[:2]).upper()
+    if kind.startswith('UNIQUE'):
+        kind = 'UNIQUE'
+    columns = _columns(s)
+
+    if kind == 'FOREIGN KEY':
+        ref_table, ref_columns, actions = _references.search(s).groups()
+        ref_columns = tuple(c.strip() for c in ref_columns.split(','))
+        return Constraint(name or f'{table}_{"_".join(columns)}_fkey', kind, columns, ref_table, ref_columns, actions.strip())
+
+    # the names Postgres gives unnamed constraints
+    default = f'{table}_pkey' if kind == 'PRIMARY KEY' else f'{table}_{"_".join(columns)}_key'
+    return Constraint(name or default, kind, columns)
+
+
+def parse_schema(sql):
+    # returns table name -> Table, in the order of the statements
+    sql = re.sub(r'--[^\n]*', '', sql)
+    tables = {}
+    for name, body in _create_table.findall(sql):
+        t = tables[name] = Table(name)
+        for item in _split(body):
+            words = item.split()
+            if words[0].upper() == 'CONSTRAINT':
+                t.constraints.append(_constraint(name, words[1], ' '.join(words[2:])))
+            elif words[0].upper() in ('PRIMARY', 'UNIQUE', 'FOREIGN'):
+                t.constraints.append(_constraint(name, None, item))
+            else:
+                col, definition = words[0], ' '.join(words[1:])
+                m = _references.search(definition)
+                if m:
+                    # inline FK, e.g. route_id integer REFERENCES routes (route_id)
+                    definition = definition[:m.start()].strip()
+                    ref_columns = tuple(c.strip() for c in m.group(2).split(','))
+                    t.constraints.append(Constraint(
+                        f'{name}_{col}_fkey', 'FOREIGN KEY', (col,), m.group(1), ref_columns, m.group(3).strip()
+                    ))
+                upper = definition.upper()
+                t.columns.append(Column(col, definition, 'NOT NULL' in upper, 'IDENTITY' in upper))
+
+        # PK columns can't be NULL either
+        if t.primary_key:
+            for c in t.primary_key.columns:
+                t.column(c).not_null = True
+    return tables
+
+
+def load_schema(path=CREATE_SQL):
+    with open(path) as f:
+        return parse_schema(f.read())
+
+
+def dependency_order(tables):
+    # table names ordered so that every table comes after the ones its FKs
+    # reference, otherwise in the order of the schema. FKs to tables that
+    # aren't in tables are ignored
+    ordered = []
+    def _visit(name, seen=()):
+        if name in ordered:
+            return
+        if name in seen:
+            raise ValueError(f'circular foreign keys at {name}')
+        for fk in tables[name].foreign_keys:
+            if fk.ref_table != name and fk.ref_table in tables:
+                _visit(fk.ref_table, seen + (name,))
+        ordered.append(name)
+
+    for name in tables:
+        _visit(name)
+    return ordered
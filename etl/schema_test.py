@@ -0,0 +1,84 @@
+import io
+import unittest
+from os.path import dirname, join
+
+from dump import _statements
+from schema import dependency_order, parse_schema
+
+create_sql = join(dirname(__file__), '..', 'schema', 'create.sql')
+
+sql = '''
+CREATE TABLE countries (
+    -- a comment
+    country_id integer GENERATED BY DEFAULT AS IDENTITY,
+    country_name varchar(40) NOT NULL,
+    PRIMARY KEY (country_id),
+    CONSTRAINT unq_country_name UNIQUE(country_name)
+);
+
+CREATE TABLE route_plane (
+    route_id integer REFERENCES routes (route_id) ON UPDATE CASCADE,
+    PRIMARY KEY (route_id)
+);
+
+CREATE TABLE routes (
+    route_id integer,
+    country_id integer NOT NULL,
+    PRIMARY KEY (route_id),
+    FOREIGN KEY (country_id) REFERENCES countries (country_id) ON DELETE CASCADE
+);
+'''
+
+
+class TestSchema(unittest.TestCase):
+    def test_parse(self):
+        tables = parse_schema(sql)
+        countries = tables['countries']
+        self.assertEqual([c.name for c in countries.columns], ['country_id', 'country_name'])
+        self.assertEqual(countries.column('country_id').definition, 'integer GENERATED BY DEFAULT AS IDENTITY')
+        self.assertTrue(countries.column('country_id').identity)
+        self.assertTrue(countries.column('country_name').not_null)
+        self.assertEqual(countries.constraints[1].definition(), 'UNIQUE (country_name)')
+
+        routes = tables['routes']
+        self.assertEqual(routes.primary_key.name, 'routes_pkey')
+        self.assertTrue(routes.column('route_id').not_null)
+        self.assertEqual(
+            routes.foreign_keys[0].definition(),
+            'FOREIGN KEY (country_id) REFERENCES countries (country_id) ON DELETE CASCADE'
+        )
+
+        fk = tables['route_plane'].foreign_keys[0]
+        self.assertEqual(fk.name, 'route_plane_route_id_fkey')
+        self.assertEqual(tables['route_plane'].column('route_id').definition, 'integer')
+
+    def test_dependency_order(self):
+        self.assertEqual(dependency_order(parse_schema(sql)), ['countries', 'routes', 'route_plane'])
+        tables = parse_schema(sql)
+        del tables['countries']
+        self.assertEqual(dependency_order(tables), ['routes', 'route_plane'])
+
+    def test_schema(self):
+        with open(create_sql) as f:
+            order = dependency_order(parse_schema(f.read()))
+        self.assertLess(order.index('airports'), order.index('routes'))
+        self.assertLess(order.index('planes'), order.index('route_plane'))
+
+
+class TestStatements(unittest.TestCase):
+    def test_statements(self):
+        f = io.StringIO(
+            '--\n-- header\n--\nSET a = 1;\n\nCREATE TABLE t (\n    x integer\n);\n\n'
+            'COPY t (x) FROM stdin;\n1\n2\n\\.\n\nALTER TABLE ONLY t ADD CONSTRAINT t_pkey PRIMARY KEY (x);\n'
+        )
+        statements = [(s, d and d.read()) for s, d in _statements(f)]
+        self.assertEqual(statements, [
+            ('SET a = 1;\n', None),
+            ('CREATE TABLE t (\n    x integer\n);\n', None),
+            ('COPY t (x) FROM stdin;\n', '1\n2\n'),
+            ('ALTER TABLE ONLY t ADD CONSTRAINT t_pkey PRIMARY KEY (x);\n', None),
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
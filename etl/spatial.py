@@ -0,0 +1,186 @@
+import heapq
+from array import array
+from math import cos, pi, radians, sin
+from os.path import dirname, join
+
+from graph import EARTH_RADIUS_KM, haversine
+
+# A k-d tree over the locations of the airports, for nearest airport and
+# radius queries without scanning all of them. Locations are points on
+# the unit sphere (x, y, z): the straight line (chord) distance between two
+# of them grows with the great circle distance, so the tree can split and
+# prune in 3D without special cases for the poles or the date line.
+# Distances returned are great circle distances in km (haversine).
+#
+# The tree is kept in arrays: the points are reordered so that every node
+# covers a contiguous range lo:hi of them, with its bounding box. Nodes of
+# up to _leaf_size points are scanned.
+#
+# schema/spatial.sql is the DB side of this, a GiST index and SQL helpers
+# (see etl/main.py --spatial-index).
+
+SPATIAL_SQL = join(dirname(__file__), '..', 'schema', 'spatial.sql')
+
+_leaf_size = 16
+
+
+def _xyz(lat, lon):
+    lat, lon = radians(lat), radians(lon)
+    return cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat)
+
+
+def _chord(km):
+    # the chord length on the unit sphere of a great circle distance
+    if km >= pi * EARTH_RADIUS_KM:
+        return 2.0
+    return 2 * sin(km / (2 * EARTH_RADIUS_KM))
+
+
+class AirportIndex:
+    def __init__(self, airports):
+        # airports: (airport ID, latitude, longitude), the ones without a
+        # location are left out
+        self.ids = array('i')
+        self.lat = array('d')
+        self.lon = array('d')
+        points = []
+        for airport_id, lat, lon in airports:
+            if airport_id is None or lat is None or lon is None:
+                continue
+            self.ids.append(airport_id)
+            self.lat.append(lat)
+            self.lon.append(lon)
+            points.append(_xyz(lat, lon))
+
+        # point index of every position in the tree order
+        self._order = array('i', range(len(points)))
+        self._xyz = [array('d', (p[d] for p in points)) for d in range(3)]
+        # node -> lo, hi, left child, right child (-1 for leaves) and bounding box
+        self._lo, self._hi = array('i'), array('i')
+        self._left, self._right = array('i'), array('i')
+        self._box = [array('d') for _ in range(6)]
+        if points:
+            self._build(0, len(points))
+
+
+    @classmethod
+    def from_airports(cls, airports):
+        # from AirportDat rows, e.g. read_airports
+        return cls((ap.airport_id, ap.latitude, ap.longitude) for ap in airports)
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def _build(self, lo, hi):
+        node = len(self._lo)
+        order = self._order
+        coords = [[c[order[i]] for i in range(lo, hi)] for c in self._xyz]
+        mins = [min(c) for c in coords]
+        maxs = [max(c) for c in coords]
+        self._lo.append(lo)
+        self._hi.append(hi)
+        self._left.append(-1)
+        self._right.append(-1)
+        for d in range(3):
+            self._box[d].append(mins[d])
+            self._box[d + 3].append(maxs[d])
+
+        if hi - lo > _leaf_size:
+            # split at the median of the widest dimension
+            dim = max(range(3), key=lambda d: maxs[d] - mins[d])
+            c = self._xyz[dim]
+            order[lo:hi] = array('i', sorted(order[lo:hi], key=c.__getitem__))
+            mid = (lo + hi) // 2
+            self._left[node] = self._build(lo, mid)
+            self._right[node] = self._build(mid, hi)
+        return node
+
+
+    def _box_dist2(self, node, x, y, z):
+        # squared distance from (x, y, z) to the bounding box of node
+        d2 = 0.0
+        box = self._box
+        for d, v in enumerate((x, y, z)):
+            lo, hi = box[d][node], box[d + 3][node]
+            if v < lo:
+                d2 += (lo - v) ** 2
+            elif v > hi:
+                d2 += (v - hi) ** 2
+        return d2
+
+
+    def _result(self, i, lat, lon):
+        return self.ids[i], haversine(lat, lon, self.lat[i], self.lon[i])
+
+
+    def nearest(self, lat, lon, k=1):
+        # the k airports nearest to (lat, lon): [(airport ID, km)], nearest first
+        if not self.ids or k <= 0:
+            return []
+        x, y, z = _xyz(lat, lon)
+        xs, ys, zs = self._xyz
+        order = self._order
+        # max heap of the best k so far, by negative squared chord
+        best = []
+        nodes = [(0.0, 0)]
+        while nodes:
+            d2, node = heapq.heappop(nodes)
+            if len(best) == k and d2 > -best[0][0]:
+                break
+            left = self._left[node]
+            if left < 0:
+                for j in range(self._lo[node], self._hi[node]):
+                    i = order[j]
+                    p2 = (xs[i] - x) ** 2 + (ys[i] - y) ** 2 + (zs[i] - z) ** 2
+                    if len(best) < k:
+                        heapq.heappush(best, (-p2, i))
+                    elif p2 < -best[0][0]:
+                        heapq.heapreplace(best, (-p2, i))
+            else:
+                for child in (left, self._right[node]):
+                    heapq.heappush(nodes, (self._box_dist2(child, x, y, z), child))
+
+        return sorted((self._result(i, lat, lon) for _, i in best), key=lambda r: r[1])
+
+
+    def within(self, lat, lon, km):
+        # the airports within km of (lat, lon): [(airport ID, km)], nearest first
+        if not self.ids:
+            return []
+        x, y, z = _xyz(lat, lon)
+        # a little slack for rounding, the haversine distance decides
+        max2 = (_chord(km) * (1 + 1e-9)) ** 2
+        xs, ys, zs = self._xyz
+        order = self._order
+        found = []
+        nodes = [0]
+        while nodes:
+            node = nodes.pop()
+            if self._box_dist2(node, x, y, z) > max2:
+                continue
+            left = self._left[node]
+            if left < 0:
+                for j in range(self._lo[node], self._hi[node]):
+                    i = order[j]
+                    if (xs[i] - x) ** 2 + (ys[i] - y) ** 2 + (zs[i] - z) ** 2 <= max2:
+                        found.append(i)
+            else:
+                nodes.append(left)
+                nodes.append(self._right[node])
+
+        results = [self._result(i, lat, lon) for i in found]
+        return sorted((r for r in results if r[1] <= km), key=lambda r: r[1])
+
+
+    def nearest_scan(self, lat, lon, k=1):
+        # nearest without the index, by computing every distance
+        results = [self._result(i, lat, lon) for i in range(len(self.ids))]
+        return sorted(results, key=lambda r: r[1])[:k]
+
+
+    def within_scan(self, lat, lon, km):
+        # within without the index, by computing every distance
+        results = [self._result(i, lat, lon) for i in range(len(self.ids))]
+        return sorted((r for r in results if r[1] <= km), key=lambda r: r[1])
@@ -0,0 +1,43 @@
+import random
+import unittest
+
+from spatial import AirportIndex
+
+
+class TestAirportIndex(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(1)
+        self.airports = [(i, rnd.uniform(-90, 90), rnd.uniform(-180, 180)) for i in range(1, 500)]
+        # on both sides of the date line, and one without a location
+        self.airports += [(1000, 0.0, 179.9), (1001, 0.0, -179.9), (1002, None, None)]
+        self.index = AirportIndex(self.airports)
+
+    def test_len(self):
+        self.assertEqual(len(self.index), 501)
+
+    def test_nearest(self):
+        rnd = random.Random(2)
+        for _ in range(50):
+            lat, lon = rnd.uniform(-90, 90), rnd.uniform(-180, 180)
+            self.assertEqual(self.index.nearest(lat, lon, 5), self.index.nearest_scan(lat, lon, 5))
+
+    def test_date_line(self):
+        self.assertEqual([a for a, _ in self.index.nearest(0.0, 180.0, 2)], [1000, 1001])
+        found = self.index.within(0.0, 179.95, 20)
+        self.assertEqual([a for a, _ in found], [1000, 1001])
+        self.assertAlmostEqual(found[0][1], 5.56, places=2)
+
+    def test_within(self):
+        rnd = random.Random(3)
+        for km in (0, 100, 1000, 25000):
+            lat, lon = rnd.uniform(-90, 90), rnd.uniform(-180, 180)
+            self.assertEqual(self.index.within(lat, lon, km), self.index.within_scan(lat, lon, km))
+        self.assertEqual(len(self.index.within(0, 0, 25000)), 501)
+
+    def test_empty(self):
+        self.assertEqual(AirportIndex([]).nearest(0, 0, 3), [])
+        self.assertEqual(AirportIndex([]).within(0, 0, 100), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
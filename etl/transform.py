@@ -1,3 +1,6 @@
+from dataclasses import replace
+
+
 def translate_country(c):
     # Some country names don't correspond with
     # entries in the countries table. This dict is used to
@@ -40,16 +43,32 @@ def translate_country(c):
 
     return c if not c in ct else ct[c]
 
+# Some plane iata codes in routes.dat don't match any
+# in planes.dat. For these we'll use an approximation
+plane_translations = {
+    'DH8': 'DH1', # De Havilland Canada DHC-8-100 Dash 8 
+    'CRJ': 'CR1', # Canadair Regional Jet 100
+    'DC9': 'D91' # Douglas DC-9-10
+}
+
 def translate_plane(iata):
-    # Some plane iata codes in routes.dat don't match any
-    # in planes.dat. For these we'll use an approximation
-    pl = {
-        'DH8': 'DH1', # De Havilland Canada DHC-8-100 Dash 8 
-        'CRJ': 'CR1', # Canadair Regional Jet 100
-        'DC9': 'D91' # Douglas DC-9-10
-    }
+    pl = plane_translations
     return iata if not iata in pl else pl[iata]
 
+def translate_equipment(routes):
+    # The routes with their plane codes translated, before they get to
+    # the DB. Routes share their equipment tuples (see extract._intern),
+    # the translated ones are shared the same way
+    translated = {}
+    for r in routes:
+        eq = r.route_equipment_iata
+        if eq not in translated:
+            t = tuple(translate_plane(p) for p in eq)
+            translated[eq] = eq if t == eq else t
+        if translated[eq] is not eq:
+            r = replace(r, route_equipment_iata=translated[eq])
+        yield r
+
 def convert_if_exists(v, t):
         return t(v) if v else None
 
@@ -0,0 +1,26 @@
+import unittest
+
+from model import RouteDat
+from transform import translate_equipment
+
+
+def _route(equipment):
+    return RouteDat('2B', None, '410', 'AER', None, '2965', 'KZN', None, '2990', None, 0, equipment)
+
+
+class TestTranslateEquipment(unittest.TestCase):
+    def test_translated(self):
+        shared = ('CRJ', '320')
+        routes = [_route(('CR2', '320')), _route(shared), _route(shared), _route(())]
+        got = list(translate_equipment(routes))
+        self.assertEqual([r.route_equipment_iata for r in got], [('CR2', '320'), ('CR1', '320'), ('CR1', '320'), ()])
+        # routes without a code to translate are passed on as they are, the
+        # translated equipment is shared like the equipment it came from
+        self.assertIs(got[0], routes[0])
+        self.assertIs(got[3], routes[3])
+        self.assertIs(got[1].route_equipment_iata, got[2].route_equipment_iata)
+        self.assertEqual(got[1].airline_id, '410')
+
+
+if __name__ == "__main__":
+    unittest.main()
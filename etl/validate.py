@@ -0,0 +1,210 @@
+import json
+import re
+import threading
+from collections import defaultdict
+
+# Checks rows against the constraints of schema/create.sql before they're
+# sent to the DB, so that rows that would fail don't cost a round trip (or
+# a failed COPY) each. Every row is checked the way Postgres checks an
+# INSERT: its values are converted to the types of their columns, then the
+# NOT NULL columns, the PK and unique constraints and the FKs are checked.
+# The keys of the unique constraints and the IDs of every table are kept
+# in hash sets, loaded from the DB once and kept up to date with every row
+# that passes.
+#
+# Rows that fail are counted in TableStats under the name of the exception
+# the DB would have raised (e.g. UniqueViolation), and written to the
+# quarantine file if there is one, one JSON object per line:
+#
+#   {"table": "routes", "error": "ForeignKeyViolation", "message": "...", "row": {...}}
+
+_true = {'t', 'tr', 'tru', 'true', 'y', 'ye', 'yes', 'on', '1'}
+_false = {'f', 'fa', 'fal', 'fals', 'false', 'n', 'no', 'of', 'off', '0'}
+
+# column types of schema/create.sql -> kind of _convert
+_kinds = {
+    'integer': 'int',
+    'int': 'int',
+    'float': 'float',
+    'real': 'float',
+    'boolean': 'bool',
+    'varchar': 'str',
+    'char': 'char',
+}
+
+# the Python type values of a kind are converted to
+_native = {'int': int, 'float': float, 'bool': bool}
+
+_type = re.compile(r'(\w+)(?:\s*\((\d+)\))?')
+
+
+class ConstraintError(Exception):
+    # a row the DB would reject, name is the psycopg2 exception it would
+    # raise (e.g. UniqueViolation)
+    def __init__(self, name, msg):
+        super().__init__(msg)
+        self.name = name
+
+
+def _convert(kind, length, v):
+    # converts v like Postgres converts input for a column of kind
+    if v is None:
+        return None
+    try:
+        if kind == 'int':
+            v = int(v)
+            if not -2**31 <= v < 2**31:
+                raise ConstraintError('NumericValueOutOfRange', f'{v} is out of range for type integer')
+        elif kind == 'float':
+            v = float(v)
+        elif kind == 'bool':
+            if type(v) is not bool:
+                s = v.strip().lower()
+                if s not in _true and s not in _false:
+                    raise ValueError(v)
+                v = s in _true
+        elif kind in ('str', 'char'):
+            if len(v) > length:
+                # excess spaces are cut off silently
+                if v[length:].strip(' '):
+                    raise ConstraintError(
+                        'StringDataRightTruncation', f'value too long for type character varying({length})'
+                    )
+                v = v[:length]
+            if kind == 'char':
+                # trailing spaces of char(n) values don't count
+                v = v.rstrip(' ')
+    except ValueError:
+        raise ConstraintError('InvalidTextRepresentation', f'invalid input syntax for type {kind}: "{v}"')
+    return v
+
+
+def column_type(definition):
+    # (kind, length) of a column definition, e.g. ('str', 40) for
+    # "varchar(40) NOT NULL". kind is None for types that aren't converted
+    name, length = _type.match(definition).groups()
+    return _kinds.get(name.lower()), length and int(length)
+
+
+class Validator:
+    # tables: name -> schema.Table. quarantine: path of the file rejected
+    # rows are written to. One instance is shared by all clones of a DB
+    def __init__(self, tables, quarantine=None):
+        self._tables = tables
+        self._types = {
+            t.name: {c.name: column_type(c.definition) for c in t.columns} for t in tables.values()
+        }
+        self._not_null = {t.name: {c.name for c in t.columns if c.not_null and not c.identity} for t in tables.values()}
+        # table -> (columns, set of their values) per PK and unique constraint
+        self._unique = {
+            t.name: [(c.columns, set()) for c in t.constraints if c.kind != 'FOREIGN KEY'] for t in tables.values()
+        }
+        # table -> IDs, for the FKs referencing it
+        self._ids = defaultdict(set)
+        # (table, columns) -> see _plan
+        self._plans = {}
+        self._lock = threading.Lock()
+        self._quarantine = quarantine and open(quarantine, 'w')
+
+
+    def load(self, conn):
+        # the keys and IDs of the rows already in the DB
+        with conn.cursor() as cur:
+            for name, t in self._tables.items():
+                for columns, keys in self._unique[name]:
+                    cur.execute(f'SELECT {", ".join(columns)} FROM {name};')
+                    keys.update(self._key(name, columns, r) for r in cur.fetchall())
+                pk = t.primary_key
+                if pk and len(pk.columns) == 1:
+                    cur.execute(f'SELECT {pk.columns[0]} FROM {name};')
+                    self._ids[name].update(r[0] for r in cur.fetchall())
+
+
+    def _key(self, table, columns, values):
+        types = self._types[table]
+        return tuple(_convert(*types[c], v) for c, v in zip(columns, values))
+
+
+    def _plan(self, table, columns):
+        # what to check for rows of table with columns, by index into the
+        # row. Built once per table and columns
+        key = (table, columns)
+        if key not in self._plans:
+            t = self._tables[table]
+            types = self._types[table]
+            idx = {c: i for i, c in enumerate(columns)}
+            pk = t.primary_key
+            self._plans[key] = (
+                # converted columns
+                [(i, *types[c], _native.get(types[c][0])) for i, c in enumerate(columns) if types[c][0]],
+                [(i, c) for i, c in enumerate(columns) if c in self._not_null[table]],
+                # the keys of constraints on columns that aren't in the row
+                # are NULL and can't conflict
+                [(tuple(idx[c] for c in cols), keys) for cols, keys in self._unique[table] if set(cols) <= idx.keys()],
+                [(idx[fk.columns[0]], self._ids[fk.ref_table], fk.name) for fk in t.foreign_keys if fk.columns[0] in idx],
+                idx.get(pk.columns[0]) if pk and len(pk.columns) == 1 else None,
+            )
+        return self._plans[key]
+
+
+    def check(self, table, columns, row):
+        # Checks row, the values of columns. Raises ConstraintError if it
+        # would fail, otherwise its keys and its ID (if it's in row) are
+        # registered
+        convert, not_null, unique, foreign_keys, pk_idx = self._plan(table, columns)
+        values = list(row)
+        for i, kind, length, native in convert:
+            v = values[i]
+            # most values have the right type already
+            if v is None or (type(v) is native and (native is not int or -2**31 <= v < 2**31)):
+                continue
+            values[i] = _convert(kind, length, v)
+
+        for i, c in not_null:
+            if values[i] is None:
+                raise ConstraintError('NotNullViolation', f'null value in column "{c}" violates not-null constraint')
+
+        with self._lock:
+            new_keys = []
+            for idx, keys in unique:
+                k = tuple([values[i] for i in idx])
+                # NULLs are never equal
+                if None in k:
+                    continue
+                if k in keys:
+                    raise ConstraintError('UniqueViolation', f'duplicate key value {k} in {table}')
+                new_keys.append((keys, k))
+
+            for i, ids, name in foreign_keys:
+                v = values[i]
+                if v is not None and v not in ids:
+                    raise ConstraintError(
+                        'ForeignKeyViolation', f'insert or update on table "{table}" violates foreign key constraint "{name}"'
+                    )
+
+            for keys, k in new_keys:
+                keys.add(k)
+            if pk_idx is not None and values[pk_idx] is not None:
+                self._ids[table].add(values[pk_idx])
+
+
+    def add_id(self, table, row_id):
+        # for rows whose ID was assigned by the DB
+        with self._lock:
+            self._ids[table].add(row_id)
+
+
+    def reject(self, table, columns, row, ex):
+        if not self._quarantine:
+            return
+        line = json.dumps(
+            {'table': table, 'error': ex.name, 'message': str(ex), 'row': dict(zip(columns, row))},
+            default=str
+        )
+        with self._lock:
+            self._quarantine.write(line + '\n')
+
+
+    def close(self):
+        if self._quarantine:
+            self._quarantine.close()
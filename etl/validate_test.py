@@ -0,0 +1,72 @@
+import json
+import tempfile
+import unittest
+from os.path import join
+
+from schema import load_schema
+from validate import ConstraintError, Validator, column_type
+
+
+class TestColumnType(unittest.TestCase):
+    def test_column_type(self):
+        self.assertEqual(column_type('varchar(40) NOT NULL'), ('str', 40))
+        self.assertEqual(column_type('char(2)'), ('char', 2))
+        self.assertEqual(column_type('integer GENERATED BY DEFAULT AS IDENTITY'), ('int', None))
+        self.assertEqual(column_type('point'), (None, None))
+
+
+class TestValidator(unittest.TestCase):
+    def _error(self, v, table, columns, row):
+        with self.assertRaises(ConstraintError) as cm:
+            v.check(table, columns, row)
+        return cm.exception.name
+
+    def test_check(self):
+        v = Validator(load_schema())
+        columns = ('country_id', 'country_name', 'country_iso', 'country_dafif')
+        v.check('countries', columns, (1, 'Papua New Guinea', 'PG', 'PP'))
+        self.assertEqual(self._error(v, 'countries', columns, (2, 'Papua New Guinea', 'PX', 'PX')), 'UniqueViolation')
+        # char(2) ignores trailing spaces
+        self.assertEqual(self._error(v, 'countries', columns, (3, 'Greenland', 'PG ', 'GL')), 'UniqueViolation')
+        self.assertEqual(self._error(v, 'countries', columns, (4, None, 'GL', 'GL')), 'NotNullViolation')
+        self.assertEqual(self._error(v, 'countries', columns, (5, 'Greenland', 'GLX', 'GL')), 'StringDataRightTruncation')
+        # the rejected rows didn't take their keys
+        v.check('countries', columns, (6, 'Greenland', 'GL', 'GL'))
+
+        # IDs come from the values or the DB
+        self.assertEqual(self._error(v, 'airlines', ('airline_name', 'country_id'), ('Air Greenland', '7')), 'ForeignKeyViolation')
+        v.add_id('countries', 7)
+        v.check('airlines', ('airline_name', 'country_id'), ('Air Greenland', '7'))
+        v.check('airlines', ('airline_name', 'country_id'), ('Air Niugini', '1'))
+
+    def test_nulls(self):
+        v = Validator(load_schema())
+        columns = ('airline_id', 'src_airport_id', 'dest_airport_id', 'route_codeshare', 'route_stops')
+        v.add_id('airports', 1)
+        v.check('routes', columns, ('410', '1', '1', None, 0))
+        v.check('routes', columns, ('410', '1', '1', None, 0))
+        v.check('routes', columns, ('410', '1', '1', 'Y', 0))
+        self.assertEqual(self._error(v, 'routes', columns, ('410', '1', '1', True, 0)), 'UniqueViolation')
+        self.assertEqual(self._error(v, 'routes', columns, ('410', '1', '2', 'N', 0)), 'ForeignKeyViolation')
+        self.assertEqual(self._error(v, 'routes', columns, ('410', '1', '1', 'maybe', 0)), 'InvalidTextRepresentation')
+
+    def test_quarantine(self):
+        with tempfile.TemporaryDirectory() as d:
+            v = Validator(load_schema(), quarantine=join(d, 'q.jsonl'))
+            columns = ('airline_id', 'src_airport_id')
+            row = ('410', '1')
+            try:
+                v.check('routes', columns, row)
+            except ConstraintError as ex:
+                v.reject('routes', columns, row, ex)
+            v.close()
+
+            with open(join(d, 'q.jsonl')) as f:
+                q = [json.loads(l) for l in f]
+        self.assertEqual(len(q), 1)
+        self.assertEqual(q[0]['error'], 'ForeignKeyViolation')
+        self.assertEqual(q[0]['row'], {'airline_id': '410', 'src_airport_id': '1'})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,5 +5,7 @@ DROP TABLE IF EXISTS airports;
 DROP TABLE IF EXISTS cities;
 DROP TABLE IF EXISTS planes;
 DROP TABLE IF EXISTS countries;
+DROP TABLE IF EXISTS etl_rows;
+DROP TABLE IF EXISTS etl_files;
 
 -- DROP DATABASE IF EXISTS openflights;
\ No newline at end of file
@@ -0,0 +1,45 @@
+-- Spatial index over the airport locations, and helpers to query it. Run
+-- by etl/main.py --spatial-index after loading, or on its own with
+-- psql <schema/spatial.sql. Needs the cube and earthdistance extensions
+-- (contrib).
+--
+-- airport_geo_location is point(latitude, longitude). earthdistance's
+-- point operator (<@>) expects point(longitude, latitude), so the cube
+-- based functions are used instead: ll_to_earth places a location on the
+-- surface of the earth, earth_distance is the great circle distance in
+-- meters (on a sphere of radius earth(), 6378.168 km, etl/spatial.py uses
+-- the mean radius of 6371 km, distances differ by about 0.1%).
+
+CREATE EXTENSION IF NOT EXISTS cube;
+CREATE EXTENSION IF NOT EXISTS earthdistance;
+
+CREATE INDEX IF NOT EXISTS airports_geo_location_idx ON airports
+    USING gist (ll_to_earth(airport_geo_location[0], airport_geo_location[1]));
+
+-- the airports within km of (lat, lon), nearest first. earth_box is a
+-- bounding cube the index can be searched with, it's a little larger than
+-- the sphere, earth_distance decides
+CREATE OR REPLACE FUNCTION airports_within(lat float8, lon float8, km float8)
+RETURNS TABLE (airport_id integer, distance_km float8) AS $$
+    SELECT a.airport_id, d.m / 1000
+    FROM airports a
+        CROSS JOIN LATERAL (
+            SELECT earth_distance(ll_to_earth(lat, lon), ll_to_earth(a.airport_geo_location[0], a.airport_geo_location[1])) m
+        ) d
+    WHERE earth_box(ll_to_earth(lat, lon), km * 1000) @> ll_to_earth(a.airport_geo_location[0], a.airport_geo_location[1])
+        AND d.m <= km * 1000
+    ORDER BY d.m;
+$$ LANGUAGE sql STABLE;
+
+-- the k airports nearest to (lat, lon), nearest first. The index returns
+-- them by the straight line distance through the earth (<->), which
+-- orders them the same way as the great circle distance
+CREATE OR REPLACE FUNCTION airports_nearest(lat float8, lon float8, k integer)
+RETURNS TABLE (airport_id integer, distance_km float8) AS $$
+    SELECT a.airport_id,
+        earth_distance(ll_to_earth(lat, lon), ll_to_earth(a.airport_geo_location[0], a.airport_geo_location[1])) / 1000
+    FROM airports a
+    WHERE a.airport_geo_location IS NOT NULL
+    ORDER BY ll_to_earth(a.airport_geo_location[0], a.airport_geo_location[1]) <-> ll_to_earth(lat, lon)
+    LIMIT k;
+$$ LANGUAGE sql STABLE;